@@ -1,20 +1,118 @@
+import os
+import random
+import threading
+import time
+from urllib.parse import urlparse
+
 import requests
+from loguru import logger
+from requests.adapters import HTTPAdapter
+
+from apis_dir.urls import ENDPOINT_TIMEOUTS
+from constants.misc import (HTTP_BACKOFF_BASE, HTTP_BACKOFF_MAX, HTTP_DEFAULT_TIMEOUT, HTTP_POOL_CONNECTIONS,
+                            HTTP_POOL_MAXSIZE, HTTP_RETRIES, HTTP_RETRY_STATUSES)
+
+# Not logged with utils.helpers.log: errors logged there are posted to the Laravel API through this module
+session = None
+session_pid = None
+session_lock = threading.Lock()
+endpoint_stats = {}
+stats_lock = threading.Lock()
+
+
+def get_session():
+    """
+        Returns the HTTP session of this process, whose connections (and TLS sessions) are reused across calls.
+        A process forked by gunicorn or RQ creates its own, sockets are not shared across processes.
+    """
+    global session, session_pid
+    if session is None or session_pid != os.getpid():
+        with session_lock:
+            if session is None or session_pid != os.getpid():
+                new_session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=HTTP_POOL_CONNECTIONS, pool_maxsize=HTTP_POOL_MAXSIZE,
+                                      max_retries=0)
+                new_session.mount("http://", adapter)
+                new_session.mount("https://", adapter)
+                session, session_pid = new_session, os.getpid()
+    return session
+
+
+def record(endpoint, duration, status=None, error=None, retries=0):
+    name = urlparse(endpoint).path or endpoint
+    with stats_lock:
+        stats = endpoint_stats.setdefault(name, {"requests": 0, "errors": 0, "timeouts": 0, "retries": 0,
+                                                 "total_seconds": 0.0, "max_seconds": 0.0})
+        stats["requests"] += 1
+        stats["retries"] += retries
+        stats["total_seconds"] += duration
+        stats["max_seconds"] = max(stats["max_seconds"], duration)
+        if error is not None or (status is not None and status >= 500):
+            stats["errors"] += 1
+        if isinstance(error, requests.exceptions.Timeout):
+            stats["timeouts"] += 1
+
+
+def get_http_stats():
+    """
+        Returns the counters of every endpoint called by this process.
+    """
+    with stats_lock:
+        return {name: {**stats, "average_seconds": round(stats["total_seconds"] / stats["requests"], 4)}
+                for name, stats in endpoint_stats.items()}
+
+
+def backoff(attempt):
+    """
+        Seconds to wait before a retry, a random time up to HTTP_BACKOFF_BASE * 2 ** attempt ("full jitter"),
+        so that workers retrying after the same failure do not all call again at the same time.
+    """
+    return random.uniform(0, min(HTTP_BACKOFF_MAX, HTTP_BACKOFF_BASE * 2 ** attempt))
+
+
+def request(method, endpoint, timeout=None, retries=0, **kwargs):
+    """
+        Sends a request with the pooled session. Connection errors, timeouts and HTTP_RETRY_STATUSES are retried
+        with a jittered backoff, only as many times as retries.
+
+        Args:
+            method (str): The HTTP method.
+            endpoint (str): The URL.
+            timeout (float or tuple, optional): (connect, read) timeout in seconds. Defaults to the timeout of the
+                endpoint in ENDPOINT_TIMEOUTS, or HTTP_DEFAULT_TIMEOUT.
+            retries (int, optional): Retries allowed, only for idempotent calls. Defaults to 0.
+            **kwargs: Passed to requests (params, json, data, headers).
+
+        Returns:
+            requests.Response: The last response. Errors of the last attempt are raised.
+    """
+    timeout = timeout if timeout is not None else ENDPOINT_TIMEOUTS.get(endpoint, HTTP_DEFAULT_TIMEOUT)
+    start = time.perf_counter()
+    attempt = 0
+    while True:
+        try:
+            response = get_session().request(method, endpoint, timeout=timeout, **kwargs)
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+            if attempt >= retries:
+                record(endpoint, time.perf_counter() - start, error=e, retries=attempt)
+                raise
+            logger.info(f"Retrying {method} {endpoint} after {type(e).__name__}")
+        else:
+            if response.status_code not in HTTP_RETRY_STATUSES or attempt >= retries:
+                record(endpoint, time.perf_counter() - start, status=response.status_code, retries=attempt)
+                return response
+            logger.info(f"Retrying {method} {endpoint} after status {response.status_code}")
+        time.sleep(backoff(attempt))
+        attempt += 1
 
 
-def post(endpoint, data):
-    return requests.post(endpoint, json=data)
+def post(endpoint, data=None, form=None, headers=None, timeout=None, idempotent=False):
+    """
+        POSTs data as JSON, or form as form fields. Only retried when the caller tells it is idempotent.
+    """
+    return request("POST", endpoint, timeout=timeout, retries=HTTP_RETRIES if idempotent else 0,
+                   json=data, data=form, headers=headers)
 
 
 def get(endpoint, params=None, headers=None, timeout=None):
-    params_string = ""
-    if params is not None:
-        for key in params.keys():
-            params_string += f"{key}={params[key]}&"
-        params_string = params_string[:-1]
-
-    endpoint_w_params = endpoint + "?" + params_string
-
-    if timeout is not None:
-        return requests.get(endpoint_w_params, timeout=10)
-    else:
-        return requests.get(endpoint_w_params)
+    return request("GET", endpoint, timeout=timeout, retries=HTTP_RETRIES, params=params, headers=headers)
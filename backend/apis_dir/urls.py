@@ -9,6 +9,27 @@ endpoint_sync_vector_data = LARAVEL_BASEURL + '/sync_vector_data'
 
 endpoint_save_error_log = LARAVEL_BASEURL + '/save_error_log'
 endpoint_save_flask_log = LARAVEL_BASEURL + '/save_flask_log'
+endpoint_store_message_sources = LARAVEL_BASEURL + '/store_message_sources'
+# Bulk variants, {"records": [...]} with the fields of the endpoints above (utils/log_shipper.py)
+endpoint_save_error_logs_bulk = LARAVEL_BASEURL + '/save_error_logs_bulk'
+endpoint_save_flask_logs_bulk = LARAVEL_BASEURL + '/save_flask_logs_bulk'
+endpoint_store_message_sources_bulk = LARAVEL_BASEURL + '/store_message_sources_bulk'
 
 endpoint_fetch_products_n_details = LARAVEL_BASEURL + "/products/fetch_products_n_details"
 endpoint_fetch_one_product_detail = LARAVEL_BASEURL + "/products/fetch_one_product_detail"
+
+endpoint_generate_next_questions = settings.BACKGROUND_FLASK_ENDPOINT + '/generate_next_questions'
+
+# (connect, read) timeouts in seconds, HTTP_DEFAULT_TIMEOUT for the other endpoints
+ENDPOINT_TIMEOUTS = {
+    endpoint_save_error_log: (2, 5),
+    endpoint_save_flask_log: (2, 5),
+    endpoint_store_message_sources: (2, 10),
+    endpoint_save_error_logs_bulk: (2, 15),
+    endpoint_save_flask_logs_bulk: (2, 15),
+    endpoint_store_message_sources_bulk: (2, 30),
+    # Product details are fetched while the user waits for the answer
+    endpoint_fetch_products_n_details: (2, 5),
+    endpoint_fetch_one_product_detail: (2, 5),
+    endpoint_generate_next_questions: (2, 30),
+}
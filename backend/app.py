@@ -2,16 +2,27 @@ import json
 import traceback
 
 from dotenv import load_dotenv
-from flask import Flask, jsonify, request, g
+from flask import Flask, Response, jsonify, request, g, stream_with_context
 from flask_cors import CORS, cross_origin
 from marshmallow import ValidationError
 
+import settings
+from apis_dir.functions import get_http_stats
 from constants.sources import CONVERSATION_STATUS, GPT_RESPONSE
+from extras.analytics_apis import (add_analytics_chunk, analytics_job_result, analytics_job_status, analytics_report,
+                                   create_analytics_job, start_analytics_job)
 from extras.apis import fetch_vectors_from_conversation
-from main_processor import respond_to_user
-from utils.helpers import (add_message_source_to_g, log, add_task_to_logging_queue, extract_values_from_request)
+from main_processor import respond_to_user, respond_to_user_stream
+from ml_models.answer_cache import invalidate_cached_answers
+from ml_models.intent_classifier import warm_seed_examples
+from pinecone_related.init import warm_pinecone_indexes
+from utils.cache import get_cache_stats
+from utils.executor import get_executor_stats
+from utils.helpers import (add_message_source_to_g, format_sse, log, extract_values_from_request)
 from utils.log_functions import save_sources_log
-from utils.schemas import ChatRequestSchema
+from utils.log_shipper import log_shipper
+from utils.products import invalidate_product_catalog
+from utils.schemas import ChatRequestSchema, InvalidateNamespaceSchema, InvalidateProductCatalogSchema
 
 load_dotenv()
 app = Flask(__name__)
@@ -19,6 +30,15 @@ app.secret_key = 'your_secret_key'
 CORS(app)
 
 
+def warm_connections():
+    """
+        Opens the Pinecone connections and embeds the intent seed examples of this worker before its first request.
+        gunicorn calls it once per worker (post_worker_init in gunicorn.conf.py), importing this module does not.
+    """
+    warm_pinecone_indexes(settings.PINECONE_WARM_INDEXES)
+    warm_seed_examples()
+
+
 @app.before_request
 def log_request_info():
     try:
@@ -35,6 +55,68 @@ def helloWorld():
 app.add_url_rule('/fetch_vectors_from_conversation',
                  view_func=fetch_vectors_from_conversation, methods=['GET'])
 
+# Analytics jobs: create, upload the messages in chunks, start, then poll the status until the result is ready
+app.add_url_rule('/analytics_jobs', view_func=create_analytics_job, methods=['POST'])
+app.add_url_rule('/analytics_jobs/<job_id>/chunks', view_func=add_analytics_chunk, methods=['POST'])
+app.add_url_rule('/analytics_jobs/<job_id>/start', view_func=start_analytics_job, methods=['POST'])
+app.add_url_rule('/analytics_jobs/<job_id>', view_func=analytics_job_status, methods=['GET'])
+app.add_url_rule('/analytics_jobs/<job_id>/result', view_func=analytics_job_result, methods=['GET'])
+app.add_url_rule('/analytics_report/<int:org_id>', view_func=analytics_report, methods=['GET'])
+
+
+@app.route('/cache_stats')
+def cache_stats():
+    return jsonify({'status': 200, 'message': 'Cache stats fetched successfully!', 'data': get_cache_stats()})
+
+
+@app.route('/http_stats')
+def http_stats():
+    return jsonify({'status': 200, 'message': 'HTTP stats fetched successfully!', 'data': get_http_stats()})
+
+
+@app.route('/log_shipper_stats')
+def log_shipper_stats():
+    return jsonify({'status': 200, 'message': 'Log shipper stats fetched successfully!', 'data': log_shipper.stats()})
+
+
+@app.route('/executor_stats')
+def executor_stats():
+    return jsonify({'status': 200, 'message': 'Executor stats fetched successfully!', 'data': get_executor_stats()})
+
+
+@app.route('/invalidate_namespace_cache', methods=['POST'])
+def invalidate_namespace_cache():
+    """
+        Invalidates the cached data of a namespace, to be called whenever its vectors are re-synced.
+    """
+    try:
+        data = InvalidateNamespaceSchema().load(request.json)
+        generation = invalidate_cached_answers(data['pinecone_index'], data['namespace'])
+        return jsonify({'status': 200, 'message': 'Namespace cache invalidated successfully!', 'data': {'generation': generation}})
+    except ValidationError as e:
+        log("Error in invalidate_namespace_cache", traceback.format_exc())
+        return jsonify({'status': 400, 'message': 'Missing required fields', 'data': e.messages}), 400
+    except Exception as e:
+        log("Error in invalidate_namespace_cache", traceback.format_exc())
+        return jsonify({'status': 500, 'message': str(e), 'data': None})
+
+
+@app.route('/invalidate_product_catalog', methods=['POST'])
+def invalidate_product_catalog_cache():
+    """
+        Invalidates the cached product tools of a host, to be called whenever its products or types of information change.
+    """
+    try:
+        data = InvalidateProductCatalogSchema().load(request.json)
+        generation = invalidate_product_catalog(data['host_url'])
+        return jsonify({'status': 200, 'message': 'Product catalog invalidated successfully!', 'data': {'generation': generation}})
+    except ValidationError as e:
+        log("Error in invalidate_product_catalog", traceback.format_exc())
+        return jsonify({'status': 400, 'message': 'Missing required fields', 'data': e.messages}), 400
+    except Exception as e:
+        log("Error in invalidate_product_catalog", traceback.format_exc())
+        return jsonify({'status': 500, 'message': str(e), 'data': None})
+
 
 @cross_origin()
 @app.route('/send_message', methods=['POST'])
@@ -80,8 +162,7 @@ def chat_with_gpt():
         log(final_json.get_json())
         add_message_source_to_g(CONVERSATION_STATUS, conversation_status)
         add_message_source_to_g(GPT_RESPONSE, response)
-        add_task_to_logging_queue(
-            save_sources_log, message_id, g.get("sources", {}))
+        save_sources_log(message_id, g.get("sources", {}))
         return final_json
 
     except ValidationError as e:
@@ -93,5 +174,66 @@ def chat_with_gpt():
         return jsonify({'status': 500, 'message': str(e), 'data': None})
 
 
+@cross_origin()
+@app.route('/send_message_stream', methods=['POST'])
+def chat_with_gpt_stream():
+    """
+        Same as /send_message, but the response is streamed as Server-Sent Events.
+        A 'sentence' event is sent for every sentence of the AI response, followed by an 'end' event
+        carrying the conversation_status, action_id and unanswered fields.
+    """
+    try:
+        schema = ChatRequestSchema()
+        data = schema.load(request.json)
+        # extracting values from the request
+        messages, message_id, host_url, filters, org_id, prompt, pinecone_index, namespace, closure_msg, unsure_msg, sender_country, sender_city, conversation_status, buckets, org_description = extract_values_from_request(
+            data)
+
+        log(f"----SEND_MESSAGE_STREAM_PARAM for {message_id}----")
+        log(json.dumps(request.json, indent=4))
+
+        if filters is not None and not isinstance(filters, dict):
+            filters = None
+    except ValidationError as e:
+        log("Error in send_message_stream", traceback.format_exc())
+        return jsonify({'status': 400, 'message': 'Missing required fields', 'data': e.messages}), 400
+
+    except Exception as e:
+        log("Error in send_message_stream", traceback.format_exc())
+        return jsonify({'status': 500, 'message': str(e), 'data': None})
+
+    def generate_events():
+        try:
+            ai_response = []
+            for event in respond_to_user_stream(messages, message_id=message_id,
+                                                host_url=host_url,
+                                                org_id=org_id,
+                                                filters=filters,
+                                                pinecone_index=pinecone_index,
+                                                prompt=prompt, closure_msg=closure_msg,
+                                                namespace=namespace,
+                                                conversation_status=conversation_status,
+                                                unsure_msg=unsure_msg,
+                                                sender_city=sender_city,
+                                                sender_country=sender_country,
+                                                buckets=buckets, org_description=org_description
+                                                ):
+                if event["event"] == "sentence":
+                    ai_response.append(event["data"])
+                else:
+                    log({"ai_response": ai_response, **event["data"]})
+                    add_message_source_to_g(CONVERSATION_STATUS, event["data"].get("conversation_status"))
+                yield format_sse(event["event"], event["data"])
+
+            add_message_source_to_g(GPT_RESPONSE, ai_response)
+            save_sources_log(message_id, g.get("sources", {}))
+        except Exception as e:
+            log("Error in send_message_stream", traceback.format_exc())
+            yield format_sse("error", {'status': 500, 'message': str(e)})
+
+    return Response(stream_with_context(generate_events()), mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=8000, debug=True)
@@ -0,0 +1,105 @@
+import asyncio
+import json
+import traceback
+
+from dotenv import load_dotenv
+from marshmallow import ValidationError
+from starlette.applications import Starlette
+from starlette.middleware import Middleware
+from starlette.middleware.cors import CORSMiddleware
+from starlette.responses import JSONResponse, PlainTextResponse
+from starlette.routing import Route
+
+import settings
+from constants.sources import CONVERSATION_STATUS, GPT_RESPONSE
+from main_processor import respond_to_user_async
+from ml_models.intent_classifier import warm_seed_examples
+from pinecone_related.init import warm_pinecone_indexes
+from utils.helpers import (add_message_source_to_g, extract_values_from_request, log,
+                           message_sources)
+from utils.log_functions import save_sources_log
+from utils.schemas import ChatRequestSchema
+
+load_dotenv()
+
+# Async entry point, served next to the Flask app in app.py while the endpoints are migrated.
+# Run with: uvicorn asgi:app --host 0.0.0.0 --port 8001
+
+
+async def warm_connections():
+    # Every uvicorn worker imports this module, so connections are opened once per worker
+    await asyncio.gather(asyncio.to_thread(warm_pinecone_indexes, settings.PINECONE_WARM_INDEXES),
+                         asyncio.to_thread(warm_seed_examples))
+
+
+async def hello_world(request):
+    return PlainTextResponse("ASGI App Running")
+
+
+async def chat_with_gpt(request):
+    # Sources of this request are collected here instead of flask's g, see add_message_source_to_g
+    message_sources.set({})
+    try:
+        log(f'Request: {request.method} {request.url} from {request.headers.get("X-Forwarded-For")} using {request.headers.get("User-Agent")}')
+        request_json = await request.json()
+        schema = ChatRequestSchema()
+        data = schema.load(request_json)
+        # extracting values from the request
+        messages, message_id, host_url, filters, org_id, prompt, pinecone_index, namespace, closure_msg, unsure_msg, sender_country, sender_city, conversation_status, buckets, org_description = extract_values_from_request(
+            data)
+
+        log(f"----SEND_MESSAGE_PARAM for {message_id}----")
+        log(json.dumps(request_json, indent=4))
+
+        if filters is not None and not isinstance(filters, dict):
+            filters = None
+
+        response, conversation_status, is_answered, action_id = await respond_to_user_async(messages, message_id=message_id,
+                                                                                 host_url=host_url,
+                                                                                 org_id=org_id,
+                                                                                 filters=filters,
+                                                                                 pinecone_index=pinecone_index,
+                                                                                 prompt=prompt, closure_msg=closure_msg,
+                                                                                 namespace=namespace,
+                                                                                 conversation_status=conversation_status,
+                                                                                 unsure_msg=unsure_msg,
+                                                                                 sender_city=sender_city,
+                                                                                 sender_country=sender_country,
+                                                                                 buckets=buckets, org_description=org_description
+                                                                                 )
+        # preparing the response json
+        res_json = {
+            "ai_response": response,
+            'conversation_status': conversation_status,
+        }
+        if int(is_answered) == 0:
+            res_json["unanswered"] = 1
+        if action_id != -1:
+            res_json['action_id'] = action_id
+        final_json = {'status': 200, 'message': 'Chat fetched successfully!', 'data': res_json}
+
+        log(final_json)
+        add_message_source_to_g(CONVERSATION_STATUS, conversation_status)
+        add_message_source_to_g(GPT_RESPONSE, response)
+        save_sources_log(message_id, message_sources.get())
+        return JSONResponse(final_json)
+
+    except ValidationError as e:
+        log("Error in send_message", traceback.format_exc())
+        return JSONResponse({'status': 400, 'message': 'Missing required fields', 'data': e.messages}, status_code=400)
+
+    except Exception as e:
+        log("Error in send_message", traceback.format_exc())
+        return JSONResponse({'status': 500, 'message': str(e), 'data': None})
+
+
+app = Starlette(
+    routes=[
+        Route('/', hello_world),
+        Route('/send_message', chat_with_gpt, methods=['POST']),
+    ],
+    middleware=[
+        Middleware(CORSMiddleware, allow_origins=['*'], allow_methods=['*'], allow_headers=['*']),
+    ],
+    on_startup=[warm_connections],
+)
@@ -0,0 +1,103 @@
+"""
+    Micro-benchmark of CitationResolver on long responses, whole and fed by chunks like a token stream, and a
+    randomized check that both give the same output. See the Benchmarks section of README.md.
+
+    python -m benchmarks.citations --iterations 50 --checks 20000
+"""
+import argparse
+import random
+import sys
+import time
+from pathlib import Path
+
+BACKEND_DIR = Path(__file__).parent.parent
+SECTIONS = [
+    {"id": 100, "score": 0.9, "read_more_link": "https://docs.example.com/a", "action_id": 5},
+    {"id": 101, "score": 0.8, "read_more_link": "https://docs.example.com/b"},
+    {"id": 102, "score": 0.7, "read_more_link": "https://docs.example.com/a", "action_id": 7},
+    {"id": 103, "score": 0.6, "read_more_link": ""},
+    {"id": 1, "score": 0.5, "read_more_link": "http://l1", "action_id": 9},
+]
+# Pieces of responses, chosen to put citations, Markdown links and unclosed brackets next to each other
+FRAGMENTS = ["[100]", "[101]", "[1]", "[9]", "[102, 103]", "[100 ,1]", "[a, 101]", "[see [100]", "[x]", "[1](u)",
+             "[101](https://z.com)", "[100]()", "[1](", "(u)", "()", "(", ")", "]", "[", "\n", " ", ".", ",", "word"]
+SENTENCE = "Refunds are processed within 5-7 business days after the request is approved [{}]."
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Citation rewriting time (median) of long responses.")
+    parser.add_argument("--iterations", type=int, default=20, help="Runs of every response.")
+    parser.add_argument("--lengths", type=int, nargs="+", default=[1000, 5000, 20000],
+                        help="Approximate lengths of the responses, in characters.")
+    parser.add_argument("--checks", type=int, default=10000, help="Random responses compared whole and by chunks.")
+    parser.add_argument("--seed", type=int, default=0)
+    return parser.parse_args()
+
+
+def resolve_by_chunks(response, rng, max_chunk=6):
+    from extras.citations import CitationResolver
+
+    resolver = CitationResolver(SECTIONS)
+    parts = []
+    position = 0
+    while position < len(response):
+        size = rng.randint(1, max_chunk)
+        parts.append(resolver.feed(response[position:position + size]))
+        position += size
+    parts.append(resolver.flush())
+    return "".join(parts), resolver.action_id, list(resolver.source_ids)
+
+
+def resolve_whole(response):
+    from extras.citations import CitationResolver
+
+    resolver = CitationResolver(SECTIONS)
+    return resolver.resolve(response), resolver.action_id, list(resolver.source_ids)
+
+
+def check_chunks(checks, rng):
+    """
+        Exits with the first random response rewritten differently when it is fed by chunks.
+    """
+    for _ in range(checks):
+        response = "".join(rng.choice(FRAGMENTS) for _ in range(rng.randint(0, 14)))
+        whole = resolve_whole(response)
+        chunked = resolve_by_chunks(response, rng)
+        if whole != chunked:
+            sys.exit(f"{response!r} is rewritten\n  {whole} whole\n  {chunked} by chunks")
+
+
+def measure(function, response, iterations):
+    durations = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        function(response)
+        durations.append(time.perf_counter() - start)
+    return sorted(durations)[len(durations) // 2] * 1000
+
+
+def main():
+    args = parse_args()
+    sys.path.insert(0, str(BACKEND_DIR))
+    from loguru import logger
+    logger.remove()
+    from benchmarks.run import install_credentials
+    install_credentials()
+
+    rng = random.Random(args.seed)
+    check_chunks(args.checks, rng)
+    print(f"{args.checks} random responses rewritten the same whole and by chunks")
+    print(f"{'length':>8}{'citations':>11}{'whole ms':>11}{'chunks ms':>11}")
+    for length in args.lengths:
+        sentences = [SENTENCE.format(", ".join(str(rng.choice([100, 101, 102, 103, 104])) for _ in range(rng.randint(1, 3))))
+                     for _ in range(length // len(SENTENCE) + 1)]
+        response = " ".join(sentences)
+        if resolve_whole(response) != resolve_by_chunks(response, rng):
+            sys.exit(f"The {length} characters response is rewritten differently by chunks")
+        whole = measure(resolve_whole, response, args.iterations)
+        chunks = measure(lambda text: resolve_by_chunks(text, random.Random(0), 8), response, args.iterations)
+        print(f"{len(response):>8}{len(sentences):>11}{whole:>11.2f}{chunks:>11.2f}")
+
+
+if __name__ == '__main__':
+    main()
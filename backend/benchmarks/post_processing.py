@@ -0,0 +1,107 @@
+"""
+    Micro-benchmark of the post-processing of long answers (post_process_response, then split_sentences) against
+    the previous implementation: a substitution over the whole answer per URL and email, and a PySBD segmenter
+    per call. Both must give the same output. See the Benchmarks section of README.md.
+
+    python -m benchmarks.post_processing --iterations 50
+"""
+import argparse
+import random
+import re
+import sys
+import time
+from pathlib import Path
+
+BACKEND_DIR = Path(__file__).parent.parent
+SENTENCES = [
+    "Our premium plan includes priority support and a dedicated account manager [[{citation}]]({link}).",
+    "You can read the full pricing details at {url} before upgrading.",
+    "For billing questions, please write to {email} and we will answer within a day.",
+    "The setup takes about 10 minutes (see the installation guide) #onboarding.",
+    "Refunds are processed within 5-7 business days after the request is approved [[{citation}]]({link}).",
+    "Dr. Smith's team at Example Inc. reviews every request, e.g. custom integrations.",
+    "Contact {email} or visit {url} for the enterprise offer #sales #enterprise.",
+    "All plans can be cancelled at any time from the account settings page.",
+]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Post-processing time (median) of long answers, before and after.")
+    parser.add_argument("--iterations", type=int, default=20, help="Runs of every answer.")
+    parser.add_argument("--lengths", type=int, nargs="+", default=[1000, 5000, 20000],
+                        help="Approximate lengths of the answers, in characters.")
+    parser.add_argument("--seed", type=int, default=0)
+    return parser.parse_args()
+
+
+def generate_answer(length, rng):
+    """
+        An answer made of SENTENCES with citations, URLs and emails, at least length characters long.
+    """
+    sentences = []
+    size = 0
+    while size < length:
+        number = len(sentences)
+        sentence = rng.choice(SENTENCES).format(
+            citation=number % 7 + 1, link=f"https://docs.example.com/articles/{number % 7}",
+            url=f"https://www.example.com/pricing/{number}", email=f"support{number}@example.com")
+        sentences.append(sentence)
+        size += len(sentence) + 1
+    return " ".join(sentences)
+
+
+def previous_format(text):
+    """
+        post_process_response as it was: the patterns are looked up on every call and URLs and emails are
+        formatted one by one.
+    """
+    from utils.helpers import format_links_and_emails_one_by_one
+
+    text = re.sub(r'(?<![\w/.-])(#\w+)(?![\w.-])', '', text)
+    text = re.sub(r'\s+', ' ', text).strip()
+    return format_links_and_emails_one_by_one(text)
+
+
+def previous_split(text):
+    """
+        split_sentences as it was, with a segmenter per call.
+    """
+    from pysbd import Segmenter
+
+    return Segmenter(language='en', clean=False).segment(text)
+
+
+def measure(function, text, iterations):
+    durations = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        function(text)
+        durations.append(time.perf_counter() - start)
+    return sorted(durations)[len(durations) // 2] * 1000
+
+
+def main():
+    args = parse_args()
+    sys.path.insert(0, str(BACKEND_DIR))
+    from loguru import logger
+    logger.remove()
+    from utils.helpers import get_markdown_replacements, post_process_response, remove_hashtags, split_sentences
+
+    rng = random.Random(args.seed)
+    print(f"{'length':>8}{'links':>7}{'format ms':>20}{'speedup':>9}{'split ms':>20}{'speedup':>9}  single pass")
+    for length in args.lengths:
+        text = generate_answer(length, rng)
+        formatted = post_process_response(text)
+        if previous_format(text) != formatted or previous_split(formatted) != split_sentences(formatted):
+            sys.exit(f"The post-processing of the {length} characters answer changed")
+        links = len(re.findall(r"https?://|@", text))
+        format_times = [measure(function, text, args.iterations) for function in [previous_format, post_process_response]]
+        split_times = [measure(function, formatted, args.iterations) for function in [previous_split, split_sentences]]
+        single_pass = get_markdown_replacements(remove_hashtags(text)) is not None
+        print(f"{len(text):>8}{links:>7}"
+              f"{format_times[0]:>10.2f} ->{format_times[1]:>7.2f}{format_times[0] / format_times[1]:>8.1f}x"
+              f"{split_times[0]:>10.2f} ->{split_times[1]:>7.2f}{split_times[0] / split_times[1]:>8.1f}x  {single_pass}")
+
+
+if __name__ == '__main__':
+    main()
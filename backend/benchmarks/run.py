@@ -0,0 +1,239 @@
+"""
+    Offline benchmark of respond_to_user against local stand-ins of OpenAI, Pinecone and the Laravel API.
+    See the Benchmarks section of README.md.
+
+    python -m benchmarks.run --profile production --iterations 20
+    python -m benchmarks.run --profile structure --save-baseline benchmarks/baselines/structure.json
+    python -m benchmarks.run --profile structure --compare benchmarks/baselines/structure.json
+"""
+import argparse
+import contextvars
+import json
+import math
+import os
+import sys
+import time
+import types
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+BENCHMARKS_DIR = Path(__file__).parent
+BACKEND_DIR = BENCHMARKS_DIR.parent
+BENCHMARK_INDEX = "benchmark-index"
+REQUEST = {
+    "host_url": "benchmark.example.com",
+    "prompt": "You are a helpful assistant of the organization.",
+    "pinecone_index": BENCHMARK_INDEX,
+    "namespace": "benchmark",
+    "unsure_msg": "I'm sorry, I'm not sure how to respond to that. Can you please rephrase?",
+}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Per stage latency of respond_to_user against local stand-ins.")
+    parser.add_argument("--profile", default="production", help="Latency profile of benchmarks/profiles.json.")
+    parser.add_argument("--scale", type=float, default=1, help="Factor applied to every stand-in latency.")
+    parser.add_argument("--iterations", type=int, default=10, help="Runs of every conversation.")
+    parser.add_argument("--warmup", type=int, default=1, help="Runs of every conversation that are not measured.")
+    parser.add_argument("--concurrency", type=int, default=1, help="Conversations answered at the same time.")
+    parser.add_argument("--stream", action="store_true", help="Benchmark respond_to_user_stream instead.")
+    parser.add_argument("--warm-caches", action="store_true", help="Keep the caches between runs.")
+    parser.add_argument("--conversations", default=str(BENCHMARKS_DIR / "conversations.json"))
+    parser.add_argument("--save-baseline", metavar="PATH", help="Save the results as a baseline.")
+    parser.add_argument("--compare", metavar="PATH", help="Compare the results with a baseline, exit 1 on regression.")
+    parser.add_argument("--tolerance", type=float, default=0.15, help="Allowed relative slowdown of a percentile.")
+    parser.add_argument("--slack-ms", type=float, default=5, help="Allowed absolute slowdown of a percentile.")
+    parser.add_argument("--verbose", action="store_true", help="Keep the application logs on stderr.")
+    return parser.parse_args()
+
+
+def install_credentials():
+    """
+        The stand-ins do not check keys, placeholder credentials are used when constants/credentials.py does not exist.
+    """
+    try:
+        import constants.credentials
+    except ImportError:
+        import constants
+        credentials = types.ModuleType("constants.credentials")
+        for name in ["OPENAI_API_KEY", "OPENAI_ORGANIZATION", "PINECONE_API_KEY", "PINECONE_ENV", "GEMINI_API_KEY"]:
+            setattr(credentials, name, "benchmark")
+        sys.modules["constants.credentials"] = credentials
+        constants.credentials = credentials
+
+
+def percentile(values, percent):
+    """
+        Nearest-rank percentile.
+    """
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(percent / 100 * len(ordered)) - 1)]
+
+
+def summarize(durations):
+    return {
+        "runs": len(durations),
+        "p50": round(percentile(durations, 50) * 1000, 2),
+        "p95": round(percentile(durations, 95) * 1000, 2),
+        "p99": round(percentile(durations, 99) * 1000, 2),
+    }
+
+
+def run_conversation(conversation, stream):
+    """
+        Answers the last message of a conversation, in a fresh context like a request would.
+
+        Returns:
+            Run: Durations and call counts of the run.
+    """
+    from benchmarks.stages import Run, current_run
+    from main_processor import respond_to_user, respond_to_user_stream
+    from utils.helpers import message_sources
+
+    run = Run()
+
+    def answer():
+        current_run.set(run)
+        message_sources.set({})
+        # process_messages edits the messages in place
+        messages = json.loads(json.dumps(conversation["messages"]))
+        start = time.perf_counter()
+        if stream:
+            for event in respond_to_user_stream(messages, message_id=-1, **REQUEST):
+                if event["event"] == "sentence" and "first_sentence" not in run.durations:
+                    run.record("first_sentence", time.perf_counter() - start)
+        else:
+            respond_to_user(messages, message_id=-1, **REQUEST)
+        run.record("pipeline", time.perf_counter() - start)
+
+    contextvars.copy_context().run(answer)
+    return run
+
+
+def clear_caches():
+    from utils.cache import caches
+
+    for cache in caches.values():
+        if hasattr(cache, "clear"):
+            cache.clear()
+
+
+def benchmark(conversations, args):
+    """
+        Runs every conversation args.iterations times.
+
+        Returns:
+            dict: Percentiles (milliseconds) per stage and per conversation, and upstream calls per run.
+    """
+    jobs = [conversation for _ in range(args.warmup) for conversation in conversations]
+    measured = [conversation for _ in range(args.iterations) for conversation in conversations]
+
+    def run_job(conversation):
+        if not args.warm_caches:
+            clear_caches()
+        return conversation["name"], run_conversation(conversation, args.stream)
+
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        list(executor.map(run_job, jobs))
+        runs = list(executor.map(run_job, measured))
+
+    stages = {}
+    per_conversation = {}
+    calls = {}
+    for name, run in runs:
+        for stage, duration in run.durations.items():
+            stages.setdefault(stage, []).append(duration)
+        per_conversation.setdefault(name, []).append(run.durations["pipeline"])
+        for call, count in run.counts.items():
+            calls[call] = calls.get(call, 0) + count
+    return {
+        "profile": args.profile,
+        "scale": args.scale,
+        "stream": args.stream,
+        "stages": {stage: summarize(durations) for stage, durations in sorted(stages.items())},
+        "conversations": {name: summarize(durations) for name, durations in per_conversation.items()},
+        "calls_per_run": {call: round(count / len(runs), 2) for call, count in sorted(calls.items())},
+    }
+
+
+def print_results(results):
+    print(f"\n{'stage':<28}{'runs':>6}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for title, rows in [("", results["stages"]), ("conversation pipelines", results["conversations"])]:
+        if title:
+            print(f"\n{title}")
+        for name, summary in rows.items():
+            print(f"{name:<28}{summary['runs']:>6}{summary['p50']:>10}{summary['p95']:>10}{summary['p99']:>10}")
+    print("\nupstream calls per run")
+    for call, count in results["calls_per_run"].items():
+        print(f"{call:<28}{count:>6}")
+
+
+def compare(results, baseline, tolerance, slack_ms):
+    """
+        Lists the regressions of results against baseline: a p50 or p95 slower than allowed,
+        or more upstream calls per run (typically an added sequential call).
+    """
+    regressions = []
+    for group in ["stages", "conversations"]:
+        for name, base in baseline.get(group, {}).items():
+            current = results[group].get(name)
+            if current is None:
+                continue
+            for key in ["p50", "p95"]:
+                allowed = base[key] * (1 + tolerance) + slack_ms
+                if current[key] > allowed:
+                    regressions.append(f"{name} {key}: {current[key]} ms, baseline {base[key]} ms (allowed {allowed:.2f} ms)")
+    for call, base in baseline.get("calls_per_run", {}).items():
+        current = results["calls_per_run"].get(call, 0)
+        if current > base + 0.5:
+            regressions.append(f"{call}: {current} per run, baseline {base}")
+    return regressions
+
+
+def main():
+    args = parse_args()
+    sys.path.insert(0, str(BACKEND_DIR))
+    os.chdir(BACKEND_DIR)
+    if not args.verbose:
+        from loguru import logger
+        logger.remove()
+
+    from benchmarks.stubs import StubState, install_stub_pinecone, load_latencies, start_stub_server
+
+    profiles = json.loads((BENCHMARKS_DIR / "profiles.json").read_text())
+    conversations = json.loads(Path(args.conversations).read_text())
+    latencies = load_latencies(profiles[args.profile], args.scale)
+    intents = {conversation["messages"][-1]["message"]: conversation["intent"] for conversation in conversations}
+    state = StubState(latencies, intents)
+    base_url = start_stub_server(state)
+
+    # The stand-ins have to be in place before the application modules create their clients
+    os.environ["OPENAI_BASE_URL"] = base_url + "/v1"
+    install_credentials()
+    import settings
+    settings.LARAVEL_BASEURL = base_url + "/api"
+    settings.BACKGROUND_FLASK_ENDPOINT = base_url
+    import pinecone_related.init
+    install_stub_pinecone(pinecone_related.init.pc_client, BENCHMARK_INDEX, latencies["pinecone_query"])
+    from benchmarks.stages import instrument_stages
+    instrument_stages()
+
+    results = benchmark(conversations, args)
+    print_results(results)
+
+    if args.save_baseline:
+        Path(args.save_baseline).parent.mkdir(parents=True, exist_ok=True)
+        Path(args.save_baseline).write_text(json.dumps(results, indent=4))
+        print(f"\nBaseline saved to {args.save_baseline}")
+    if args.compare:
+        regressions = compare(results, json.loads(Path(args.compare).read_text()), args.tolerance, args.slack_ms)
+        if regressions:
+            print("\nRegressions:")
+            for regression in regressions:
+                print(f"  {regression}")
+            sys.exit(1)
+        print("\nNo regression against the baseline")
+
+
+if __name__ == '__main__':
+    main()
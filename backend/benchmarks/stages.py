@@ -0,0 +1,103 @@
+import contextvars
+import functools
+import importlib
+import inspect
+import threading
+import time
+
+# Stage name -> (module, function) of the call site that is timed. Call sites are patched rather than the
+# definitions, since most modules import the functions by name.
+STAGES = {
+    "intent": ("main_processor", "estimate_intent"),
+    "standalone_question": ("main_processor", "make_standalone_question"),
+    "query_embedding": ("main_processor", "create_embedding"),
+    "small_talk": ("main_processor", "answer_query_generic"),
+    "small_talk_stream": ("main_processor", "answer_query_generic_stream"),
+    "answer_with_context": ("main_processor", "answer_query_with_context"),
+    "answer_with_context_stream": ("main_processor", "answer_query_with_context_stream"),
+    "prompt_context": ("ml_models.user_facing", "fetch_prompt_context"),
+    "retrieval": ("pinecone_related.query_pinecone", "query_from_pinecone"),
+    "citations": ("ml_models.user_facing", "get_response_with_citations"),
+    "citations_stream": ("ml_models.user_facing", "stream_response_with_citations"),
+}
+# Upstream calls (module, attribute path), counted per run so that an added call shows up even when it is fast
+CALLS = {
+    "llm_calls": [("ml_models.common", "chat_w_openai"), ("ml_models.common", "chat_w_openai_stream")],
+    "embedding_api_calls": [("ml_models.gpt_helpers", "client.embeddings.create")],
+}
+
+current_run = contextvars.ContextVar("benchmark_run", default=None)
+
+
+class Run:
+    """
+        Durations (seconds) and call counts of one pipeline run. Shared with the pipeline threads through the
+        context, so stages running in parallel are recorded in the same run.
+    """
+
+    def __init__(self):
+        self.durations = {}
+        self.counts = {}
+        self._lock = threading.Lock()
+
+    def record(self, name, duration):
+        with self._lock:
+            self.durations[name] = self.durations.get(name, 0) + duration
+
+    def count(self, name):
+        with self._lock:
+            self.counts[name] = self.counts.get(name, 0) + 1
+
+
+def timed(name, function):
+    """
+        Wraps function so that its duration is added to the current run. Generators are timed until exhausted.
+    """
+    if inspect.isgeneratorfunction(function):
+        @functools.wraps(function)
+        def timed_generator(*args, **kwargs):
+            run = current_run.get()
+            start = time.perf_counter()
+            try:
+                return (yield from function(*args, **kwargs))
+            finally:
+                if run is not None:
+                    run.record(name, time.perf_counter() - start)
+        return timed_generator
+
+    @functools.wraps(function)
+    def timed_function(*args, **kwargs):
+        run = current_run.get()
+        start = time.perf_counter()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            if run is not None:
+                run.record(name, time.perf_counter() - start)
+    return timed_function
+
+
+def counted(name, function):
+    @functools.wraps(function)
+    def counted_function(*args, **kwargs):
+        run = current_run.get()
+        if run is not None:
+            run.count(name)
+        return function(*args, **kwargs)
+    return counted_function
+
+
+def instrument_stages():
+    """
+        Patches the call sites of STAGES and CALLS. Must be called after the stand-ins are installed.
+    """
+    for name, (module_name, attribute) in STAGES.items():
+        module = importlib.import_module(module_name)
+        setattr(module, attribute, timed(name, getattr(module, attribute)))
+    for name, call_sites in CALLS.items():
+        for module_name, path in call_sites:
+            owner = importlib.import_module(module_name)
+            *parents, attribute = path.split(".")
+            for parent in parents:
+                owner = getattr(owner, parent)
+            setattr(owner, attribute, counted(name, getattr(owner, attribute)))
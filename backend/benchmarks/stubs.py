@@ -0,0 +1,255 @@
+import hashlib
+import json
+import math
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+EMBEDDING_DIMENSION = 1536
+
+
+class Latency:
+    """
+        Log-normal latency distribution, described by its median and 95th percentile.
+
+        Args:
+            median_ms (float): Median latency in milliseconds.
+            p95_ms (float): 95th percentile latency in milliseconds, at least the median.
+            scale (float, optional): Factor applied to every sample, to shorten runs without changing their shape. Defaults to 1.
+    """
+
+    def __init__(self, median_ms, p95_ms, scale=1):
+        self.median_ms = median_ms
+        self.sigma = math.log(max(p95_ms, median_ms) / median_ms) / 1.645 if median_ms > 0 else 0
+        self.scale = scale
+        self._random = random.Random(0)
+        self._lock = threading.Lock()
+
+    def sample(self):
+        """
+            Returns a latency in seconds.
+        """
+        with self._lock:
+            factor = self._random.lognormvariate(0, self.sigma) if self.sigma > 0 else 1
+        return self.median_ms * factor * self.scale / 1000
+
+    def wait(self):
+        time.sleep(self.sample())
+
+
+def load_latencies(profile, scale=1):
+    """
+        Builds the Latency of every upstream of a profile of benchmarks/profiles.json.
+    """
+    return {name: Latency(value["median_ms"], value["p95_ms"], scale) for name, value in profile.items()}
+
+
+def fake_embedding(text):
+    """
+        Deterministic unit vector of a text, so that identical texts get identical embeddings.
+    """
+    generator = random.Random(hashlib.sha256(text.encode()).hexdigest())
+    vector = [generator.gauss(0, 1) for _ in range(EMBEDDING_DIMENSION)]
+    norm = math.sqrt(sum(value * value for value in vector))
+    return [value / norm for value in vector]
+
+
+class StubState:
+    """
+        What the stand-in servers answer and how slowly, shared by every request handler.
+
+        Args:
+            latencies (dict): Latency per upstream, see profiles.json.
+            intents (dict): Last user message -> intent the intent model answers for it.
+    """
+
+    def __init__(self, latencies, intents):
+        self.latencies = latencies
+        self.intents = intents
+        self.requests = {}
+        self._lock = threading.Lock()
+
+    def count(self, route):
+        with self._lock:
+            self.requests[route] = self.requests.get(route, 0) + 1
+
+
+def source_ids_in(content):
+    """
+        Numbers of the sources sent in a citation prompt, after the examples of the template.
+    """
+    sources = re.split(r"Now it'?s your turn", content)[-1]
+    return re.findall(r'^(\d+):$', sources, re.MULTILINE)
+
+
+def fake_chat_reply(messages, state):
+    """
+        Answers a chat completion the way the pipeline expects, based on which prompt it was sent.
+    """
+    system = messages[0].get("content", "") if messages else ""
+    last = messages[-1].get("content", "") if messages else ""
+    content = "\n".join(message.get("content", "") or "" for message in messages)
+
+    if "conversation starts here" in last:
+        for message, intent in state.intents.items():
+            if message in last:
+                return str(intent)
+        return "2"
+    if "STANDALONE QUESTION" in last:
+        question = re.search(r'Follow up message Begin\s*(?:USER: )?(.*?)\s*Follow up message End', last, re.DOTALL)
+        return json.dumps({"STANDALONE QUESTION": question.group(1) if question else last[-100:],
+                           "justification": "stand-in"})
+    source_ids = source_ids_in(content)[:3]
+    if '"sentences"' in system:
+        return json.dumps({"sentences": [
+            {"text": f"This is what source {source_id} says about the question.", "source_ids": [int(source_id)]}
+            for source_id in source_ids]})
+    if "Existing Answer" in last or "numbered sources" in system:
+        return " ".join(f"This is what source {source_id} says about the question [{source_id}]."
+                        for source_id in source_ids)
+    return "Hello! How can I help you today?"
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """
+        Stand-in for the OpenAI API (/v1/chat/completions, /v1/embeddings) and the Laravel API (/api/...).
+    """
+    protocol_version = "HTTP/1.1"
+    state: StubState = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def read_json(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        return json.loads(self.rfile.read(length) or b"{}")
+
+    def send_json(self, data, status=200):
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        self.handle_laravel()
+
+    def do_POST(self):
+        path = self.path.split("?")[0]
+        if path.endswith("/chat/completions"):
+            self.handle_chat(self.read_json())
+        elif path.endswith("/embeddings"):
+            self.handle_embeddings(self.read_json())
+        else:
+            self.read_json()
+            self.handle_laravel()
+
+    def handle_chat(self, request):
+        self.state.count("chat")
+        reply = fake_chat_reply(request.get("messages", []), self.state)
+        self.state.latencies["chat"].wait()
+        usage = {"prompt_tokens": 100, "completion_tokens": len(reply.split()), "total_tokens": 100 + len(reply.split())}
+        if not request.get("stream"):
+            self.send_json({
+                "id": "chatcmpl-stub", "object": "chat.completion", "created": int(time.time()), "model": request.get("model"),
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": reply}, "finish_reason": "stop"}],
+                "usage": usage,
+            })
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        for index, token in enumerate(re.findall(r'\S+\s*', reply)):
+            if index > 0:
+                self.state.latencies["chat_token"].wait()
+            chunk = {"id": "chatcmpl-stub", "object": "chat.completion.chunk", "created": int(time.time()),
+                     "model": request.get("model"),
+                     "choices": [{"index": 0, "delta": {"content": token}, "finish_reason": None}]}
+            self.write_chunk(f"data: {json.dumps(chunk)}\n\n")
+        self.write_chunk("data: [DONE]\n\n")
+        self.write_chunk("")
+
+    def write_chunk(self, text):
+        data = text.encode()
+        self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+        self.wfile.flush()
+
+    def handle_embeddings(self, request):
+        self.state.count("embeddings")
+        inputs = request.get("input")
+        inputs = inputs if isinstance(inputs, list) else [inputs]
+        self.state.latencies["embeddings"].wait()
+        self.send_json({
+            "object": "list", "model": request.get("model"),
+            "data": [{"object": "embedding", "index": index, "embedding": fake_embedding(text)}
+                     for index, text in enumerate(inputs)],
+            "usage": {"prompt_tokens": len(inputs), "total_tokens": len(inputs)},
+        })
+
+    def handle_laravel(self):
+        self.state.count("laravel")
+        self.state.latencies["laravel"].wait()
+        self.send_json({"status": 200, "message": "stand-in", "data": []})
+
+
+def start_stub_server(state):
+    """
+        Starts the stand-in HTTP server on a free local port, in a daemon thread.
+
+        Returns:
+            str: The base URL of the server.
+    """
+    handler = type("BoundStubHandler", (StubHandler,), {"state": state})
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f"http://127.0.0.1:{server.server_address[1]}"
+
+
+class StubIndex:
+    """
+        Stand-in for a Pinecone Index handle. Pinecone is queried over gRPC, so it is replaced in process
+        rather than by an HTTP server. Matches are drawn from a synthetic corpus, deterministically per query vector.
+
+        Args:
+            latency (Latency): Latency of a query.
+            sections (int, optional): Number of sections in the corpus. Defaults to 200.
+    """
+
+    def __init__(self, latency, sections=200):
+        self.latency = latency
+        self.sections = [{
+            "id": str(section_id),
+            "metadata": {
+                "id": section_id,
+                "text": f"Section {section_id} of the stand-in corpus. " * 12,
+                "tokens": 120,
+                "read_more_link": f"https://example.com/articles/{section_id}",
+                **({"action_id": section_id} if section_id % 10 == 0 else {}),
+            },
+        } for section_id in range(1, sections + 1)]
+
+    def query(self, vector=None, top_k=10, include_metadata=True, namespace="", filter=None, **kwargs):
+        self.latency.wait()
+        generator = random.Random(hashlib.sha256(json.dumps(vector[:8]).encode()).hexdigest())
+        chosen = generator.sample(self.sections, min(top_k, len(self.sections)))
+        scores = sorted((generator.uniform(0.65, 0.95) for _ in chosen), reverse=True)
+        return {"matches": [{**section, "score": score} for section, score in zip(chosen, scores)], "namespace": namespace}
+
+    def describe_index_stats(self, **kwargs):
+        return {"dimension": EMBEDDING_DIMENSION, "namespaces": {}}
+
+
+def install_stub_pinecone(pc_client, index_name, latency):
+    """
+        Points the Pinecone client of pinecone_related/init.py to a StubIndex named index_name.
+    """
+    index = StubIndex(latency)
+    pc_client.list_indexes = lambda: [{"name": index_name, "host": "stub"}]
+    pc_client.Index = lambda *args, **kwargs: index
+    return index
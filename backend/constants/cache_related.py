@@ -0,0 +1,25 @@
+EMBEDDING_CACHE_MAXSIZE = 20000  # entries kept in each process, ~12KB each for text-embedding-ada-002
+EMBEDDING_CACHE_TTL = 6 * 60 * 60  # seconds, in-process tier
+EMBEDDING_CACHE_REDIS_TTL = 7 * 24 * 60 * 60  # seconds, shared Redis tier
+
+ANSWER_CACHE_SIMILARITY = 0.97  # minimum cosine similarity between standalone questions to reuse an answer
+ANSWER_CACHE_TTL = 30 * 60  # seconds
+ANSWER_CACHE_MAX_SCOPES = 1000  # (index, namespace, prompt, buckets) combinations kept in each process
+ANSWER_CACHE_MAX_ENTRIES_PER_SCOPE = 500
+
+NAMESPACE_GENERATION_TTL = 5  # seconds a process trusts its copy of a namespace generation
+
+RETRIEVAL_CACHE_MAXSIZE = 5000  # query results kept in each process
+RETRIEVAL_CACHE_TTL = 15 * 60  # seconds
+RETRIEVAL_CACHE_QUANTIZATION = 256  # query vectors are rounded to 1/256 before hashing
+
+PINECONE_INDEX_HOSTS_TTL = 10 * 60  # seconds before the list of indexes and their hosts is fetched again
+PINECONE_INDEX_MISS_REFRESH = 30  # seconds, an unknown index triggers a refresh at most this often
+PINECONE_INDEX_HANDLE_TTL = 30 * 60  # seconds before an Index handle (gRPC channel) is recreated
+
+PRODUCT_CATALOG_MAXSIZE = 1000  # hosts whose product tools are kept in each process
+PRODUCT_CATALOG_FRESH_TTL = 15 * 60  # seconds the tools of a host are used without asking Laravel
+PRODUCT_CATALOG_MAX_STALE = 24 * 60 * 60  # seconds stale tools are still used while they are revalidated in the background
+
+PRODUCT_DETAIL_CACHE_MAXSIZE = 5000  # (host, product, type of information) results kept in each process
+PRODUCT_DETAIL_CACHE_TTL = 10 * 60  # seconds
@@ -1,2 +1,8 @@
 EMBEDDING_MODEL = "text-embedding-ada-002"  # TODO: switch to text-embedding-3-small
-INTENT_PREDICTION_MODEL = "ft:gpt-3.5-turbo-0613:beyondexams::8ihQPPDQ"
\ No newline at end of file
+INTENT_PREDICTION_MODEL = "ft:gpt-3.5-turbo-0613:beyondexams::8ihQPPDQ"
+# Micro-batching of the embedding requests (ml_models/embedding_batcher.py)
+EMBEDDING_BATCH_WAIT = 0.005  # seconds the first request of a batch waits for others
+EMBEDDING_BATCH_MAX_INPUTS = 64  # a batch is sent as soon as it has this many inputs
+EMBEDDING_BATCH_WORKERS = 8  # batches sent at the same time
+EMBEDDING_BATCH_TIMEOUT = 30  # seconds a caller waits for its embedding
+EMBEDDING_BULK_MAX_INPUTS = 512  # inputs per call of create_embeddings (the API accepts up to 2048)
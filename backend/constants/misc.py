@@ -8,9 +8,52 @@ ARTICLE_MAX_TOKENS = 600
 CHATGPT_MAX_TOKENS = 1500
 MAX_TOKEN_BUFFER = 50
 
+# Context packing (pinecone_related/context_packing.py)
+CONTEXT_DUPLICATE_SIMILARITY = 0.9  # sections at least this similar to a better section are dropped
+CONTEXT_DIVERSITY_PENALTY = 0.3  # share of a section's relevance lost at similarity 1 with a better section
+CONTEXT_BUCKET_DECAY = 0.8  # relevance factor per bucket priority level below the first
+CONTEXT_HASH_DIMENSION = 4096  # size of the hashed term vectors the similarities are computed on
+
+PIPELINE_MAX_WORKERS = 8  # threads shared by the concurrent stages of respond_to_user
+TOOL_CALL_MAX_WORKERS = 8  # threads running the tool calls of the model, see utils/products.py
+TOOL_CALL_TIMEOUT = 6  # seconds the model's tool calls of a turn are waited for, a late call gets TOOL_CALL_FALLBACK
+TOOL_CALL_FALLBACK = "This information is not available right now."
+
 VECTOR_DATAS_DIR = "data"
 STEP_SIZE = 1000
 
+# In-process vector indexes (pinecone_related/local_index.py), stored under settings.VECTOR_DATAS_DIR
+LOCAL_INDEX_PREFIX = "local:"  # a pinecone_index starting with this prefix is served from the local index
+LOCAL_INDEX_IVF_MIN_VECTORS = 20000  # namespaces with fewer vectors are searched by brute force
+LOCAL_INDEX_IVF_NPROBE = 8  # IVF lists scored per query
+LOCAL_INDEX_KMEANS_ITERATIONS = 20
+LOCAL_INDEX_KMEANS_SAMPLE = 100000  # vectors the IVF centroids are trained on
+LOCAL_INDEX_FILTER_CACHE_SIZE = 64  # metadata filter masks kept per namespace
+
+# Near duplicate questions of the analytics (utils/analytics.py)
+QUESTION_CLUSTER_SIMILARITY = 0.88  # minimum cosine similarity of two questions counted as the same question
+QUESTION_CLUSTER_BLOCK_SIZE = 2048  # questions per side of a block of similarities, 16MB of float32
+QUESTION_CLUSTER_IVF_MIN = 20000  # above this many distinct questions, only the neighbouring k-means lists are compared
+QUESTION_CLUSTER_NPROBE = 4  # k-means lists every question is compared with
+QUESTION_CLUSTER_KMEANS_ITERATIONS = 8
+QUESTION_CLUSTER_KMEANS_SAMPLE = 10000  # questions the k-means lists are trained on
+
+# Analytics jobs (utils/analytics_jobs.py)
+ANALYTICS_EMBEDDING_CHUNK = 4096  # questions embedded between two progress updates
+ANALYTICS_MAX_CHUNK_MESSAGES = 5000  # messages accepted per uploaded chunk
+ANALYTICS_JOB_TIMEOUT = 60 * 60  # seconds the queue worker lets a job run
+ANALYTICS_JOB_TTL = 24 * 60 * 60  # seconds a job and its result are kept after its last update
+
+# Hybrid retrieval (pinecone_related/hybrid_search.py), for namespaces with a local copy
+HYBRID_SEARCH_ENABLED = True
+HYBRID_DENSE_TOP_K = 20  # dense matches fused, instead of the top_k of query_from_pinecone
+HYBRID_SPARSE_TOP_K = 20  # BM25 matches fused
+HYBRID_RRF_K = 60  # reciprocal rank fusion constant, score = sum of 1 / (HYBRID_RRF_K + rank)
+HYBRID_SPARSE_MIN_SCORE = 0.6  # relative BM25 score above which a match is relevant whatever its dense score
+BM25_K1 = 1.2
+BM25_B = 0.75
+BM25_RARE_TERM_IDF = 3.0  # a lexical match needs a term found in at most ~5% of the sections
+
 MAX_SECTION_LEN = 1000
 SEPARATOR = "\n* "
 TIkTOKEN_ENCODING = "cl100k_base"  # encoding for text-embedding-ada-002
@@ -21,4 +64,29 @@ version = 2
 dataset_csv_file = "dataset_qa_final_processed_w_tokens.csv"
 
 ERROR_LOG_PATH="logs/error_{time:DD-MM-YYYY}.log"
-INFO_LOG_PATH="logs/info_{time:DD-MM-YYYY}.log"
\ No newline at end of file
+INFO_LOG_PATH="logs/info_{time:DD-MM-YYYY}.log"
+TRACES_LOG_PATH="logs/traces_{date}.jsonl"  # OTLP/JSON, one trace per line, see utils/tracing.py
+
+# Pooled HTTP client of the Laravel API and the background Flask app (apis_dir/functions.py)
+HTTP_POOL_CONNECTIONS = 4  # hosts with a connection pool
+HTTP_POOL_MAXSIZE = 32  # idle connections kept per host
+HTTP_DEFAULT_TIMEOUT = (3.05, 10)  # seconds (connect, read), see ENDPOINT_TIMEOUTS in apis_dir/urls.py
+HTTP_RETRIES = 2  # retries of idempotent calls
+HTTP_RETRY_STATUSES = [429, 502, 503, 504]
+HTTP_BACKOFF_BASE = 0.2  # seconds, the n-th retry waits a random time up to HTTP_BACKOFF_BASE * 2 ** n
+HTTP_BACKOFF_MAX = 2
+
+# Log shipping to the Laravel API (utils/log_shipper.py)
+LOG_SHIPPER_BATCH_SIZE = 100  # records of a kind sent in one bulk call, a full batch is flushed at once
+LOG_SHIPPER_MAX_AGE = 2  # seconds a record waits for its batch to fill
+LOG_SHIPPER_MAX_BUFFER = 10000  # records kept in memory, the overflow goes to the spool
+LOG_SHIPPER_SPOOL_DIR = "logs/spool"  # batches that could not be sent, replayed once the Laravel API answers again
+LOG_SHIPPER_REPLAY_INTERVAL = 30  # seconds between looks for spool files left by other processes
+
+# Background threads of a process (utils/executor.py), per lane: threads, tasks waiting, policy once the queue is full
+BACKGROUND_LANES = {
+    "default": {"workers": 4, "max_queue": 100, "overflow": "drop_newest"},
+    "next_questions": {"workers": 4, "max_queue": 200, "overflow": "drop_oldest"},  # stale suggestions are worthless
+    "analytics": {"workers": 1, "max_queue": 20, "overflow": "reject"},
+}
+BACKGROUND_DRAIN_TIMEOUT = 20  # seconds a worker waits for its background tasks when shutting down
@@ -25,6 +25,42 @@ Respond with {SMALL_TALK} if user is making small talk unrelated to the organiza
 {END_CONVERSATION} if user is ending the conversation.
 """
 
+# Local intent classifier (ml_models/intent_classifier.py), the intent model is only called below the threshold
+INTENT_CONFIDENCE_THRESHOLD = 0.8
+INTENT_RULE_MAX_WORDS = 5  # keyword rules are only trusted for messages this short
+INTENT_RULE_CONFIDENCE = 0.95
+INTENT_KNN_NEIGHBOURS = 5
+INTENT_KNN_MIN_SIMILARITY = 0.92  # cosine similarity for a labelled message to count as a neighbour
+INTENT_KNN_MIN_AGREEING = 2  # neighbours of the predicted intent for full confidence, one alone gives half
+INTENT_REMEMBER_MIN_WORDS = 4  # shorter messages ("yes", "how much?") depend on their conversation, never stored
+INTENT_EXAMPLES_MAX_SCOPES = 1000  # host_urls whose labelled messages are kept in each process
+INTENT_EXAMPLES_MAX_PER_SCOPE = 2000
+
+# Labelled messages every organization shares, product related labels are learnt per host_url
+INTENT_SEED_EXAMPLES = [
+    ("hi", SMALL_TALK),
+    ("hello", SMALL_TALK),
+    ("hey there", SMALL_TALK),
+    ("good morning", SMALL_TALK),
+    ("how are you?", SMALL_TALK),
+    ("yo bro", SMALL_TALK),
+    ("what's up", SMALL_TALK),
+    ("nice to meet you", SMALL_TALK),
+    ("you are stupid", SMALL_TALK),
+    ("are you a bot?", SMALL_TALK),
+    ("this was very helpful", SHARING_FEEDBACK),
+    ("great service, loved it", SHARING_FEEDBACK),
+    ("your answers are not helpful at all", SHARING_FEEDBACK),
+    ("i had a bad experience last time", SHARING_FEEDBACK),
+    ("ok thanks", END_CONVERSATION),
+    ("thank you so much", END_CONVERSATION),
+    ("bye", END_CONVERSATION),
+    ("that's all for now", END_CONVERSATION),
+    ("no more questions", END_CONVERSATION),
+    ("see you later", END_CONVERSATION),
+    ("Ok. I will consult Dr Malpani clinic for this", END_CONVERSATION),
+]
+
 ANSWER_WITH_CONTEXT_STRICT_PROMPT= "Respond with the following JSON format:\n {\n\"response\": \"<Insert your response here>\",\n\"CONTEXT adherence\": \"<Explain whether the response was generated using info mentioned in CONTEXT or not. Explain why you think so.>\",\n\"prompt adherence\": \"<Explain whether your response adheres to the instructions in the system prompt. Explain why you think so.>\",\n\"is_answered\": \"<True/False>// Was the response able to answer user's query satisfactorily or not. No explanation needed.>\"\n}" # type: ignore
 
 
@@ -51,6 +87,37 @@ CITATION_QA_TEMPLATE = (
 )
 
 
+# Single pass mode: the answer and its citations are generated as JSON and validated locally,
+# CITATION_REFINE_TEMPLATE is only used when the validation fails. It saves the refine call of /send_message, but
+# nothing of a JSON answer can be sent before it is complete and validated, so /send_message_stream always uses
+# the refine mode and streams the refine pass
+CITATION_MODE_REFINE = "refine"
+CITATION_MODE_JSON = "json"
+CITATION_MODE = CITATION_MODE_JSON
+# Characters of a streamed response kept back while they could be a citation ("[12, 13]") or its Markdown link
+CITATION_LOOKAHEAD = 200
+
+CITATION_JSON_QA_TEMPLATE = (
+    "Please provide an answer based solely on the provided sources. "
+    "Split the answer into sentences and, for every sentence, list the numbers of the sources it is based on. "
+    "Every sentence should cite at least one source, and only cite the sources it explicitly references. "
+    "Respond with the following JSON format: "
+    '{{"sentences": [{{"text": "<sentence without citations>", "source_ids": [<source numbers>]}}]}}. '
+    'If none of the sources are helpful, respond with {{"sentences": []}}.'
+    "For example:\n"
+    "154:\n"
+    "The sky is red in the evening and blue in the morning.\n"
+    "657:\n"
+    "Water is wet when the sky is red.\n"
+    "Query: When is water wet?\n"
+    'Answer: {{"sentences": [{{"text": "Water will be wet when the sky is red, which occurs in the evening.", "source_ids": [657, 154]}}]}}\n'
+    "Now it's your turn. Below are several numbered sources of information:"
+    "\n------\n"
+    "{context_str}"
+    "\n------\n"
+)
+
+
 CITATION_REFINE_TEMPLATE = (
     "You are provided with an existing answer and its sources."
     "Please refine the answer, ensuring that the citations are correct and appropriately placed. "
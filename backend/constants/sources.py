@@ -1,6 +1,7 @@
 VECTOR_IDS = "vector_ids"
 STANDALONE_QUESTION = "standalone_question"
 INTENT = "intent"
+INTENT_PREDICTION = "intent_prediction"
 GPT_RESPONSE = "gpt_response"
 TOOL_CALLS = "tool_calls"
 CONVERSATION_STATUS = "conversation_status"
@@ -10,4 +11,9 @@ BUCKETS_USED = "buckets_used"
 VECTORS_INFO = "vectors_info"
 GPT_RESPONSE_WITH_CITATION = "gpt_response_with_citation"
 GPT_RESPONSE_REFINED = "gpt_response_refined"
-VECTORS_USED="vectors_used"
\ No newline at end of file
+CITATION_ERRORS = "citation_errors"
+VECTORS_USED="vectors_used"
+ANSWER_CACHE_HIT = "answer_cache_hit"
+
+RETRIEVAL_CACHE_HIT = "retrieval_cache_hit"
+LEXICAL_MATCHES = "lexical_matches"
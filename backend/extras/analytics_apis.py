@@ -0,0 +1,94 @@
+import traceback
+
+from flask import request, jsonify
+from marshmallow import ValidationError
+
+from utils.analytics_jobs import JobError, add_chunk, create_job, get_job, get_job_result, start_job
+from utils.analytics_state import get_report
+from utils.executor import LaneFullError
+from utils.helpers import log
+from utils.schemas import AnalyticsChunkSchema, AnalyticsReportSchema, CreateAnalyticsJobSchema, StartAnalyticsJobSchema
+
+
+def create_analytics_job():
+    """
+        Creates an analytics job. The messages are then sent in chunks to add_analytics_chunk, and the job started
+        with start_analytics_job.
+    """
+    try:
+        data = CreateAnalyticsJobSchema().load(request.get_json(silent=True) or {})
+        return jsonify({'status': 200, 'message': 'Analytics job created successfully!', 'data': create_job(data['org_id'])})
+    except ValidationError as e:
+        return jsonify({'status': 400, 'message': 'Invalid fields', 'data': e.messages}), 400
+    except Exception as e:
+        log("Error in create_analytics_job", traceback.format_exc())
+        return jsonify({'status': 500, 'message': str(e), 'data': None}), 500
+
+
+def add_analytics_chunk(job_id):
+    try:
+        data = AnalyticsChunkSchema().load(request.json)
+        job = add_chunk(job_id, data['index'], data['messages'])
+        return jsonify({'status': 200, 'message': 'Chunk added successfully!', 'data': job})
+    except ValidationError as e:
+        return jsonify({'status': 400, 'message': 'Invalid fields', 'data': e.messages}), 400
+    except JobError as e:
+        return jsonify({'status': e.status, 'message': str(e), 'data': None}), e.status
+    except Exception as e:
+        log("Error in add_analytics_chunk", traceback.format_exc())
+        return jsonify({'status': 500, 'message': str(e), 'data': None}), 500
+
+
+def start_analytics_job(job_id):
+    try:
+        data = StartAnalyticsJobSchema().load(request.json)
+        job = start_job(job_id, data['chunks'])
+        return jsonify({'status': 202, 'message': 'Analytics job started successfully!', 'data': job}), 202
+    except ValidationError as e:
+        return jsonify({'status': 400, 'message': 'Invalid fields', 'data': e.messages}), 400
+    except JobError as e:
+        return jsonify({'status': e.status, 'message': str(e), 'data': None}), e.status
+    except LaneFullError as e:
+        return jsonify({'status': 503, 'message': 'Too many analytics jobs running, try again later', 'data': None}), 503
+    except Exception as e:
+        log("Error in start_analytics_job", traceback.format_exc())
+        return jsonify({'status': 500, 'message': str(e), 'data': None}), 500
+
+
+def analytics_job_status(job_id):
+    """
+        Returns the status ("uploading", "queued", "running", "done" or "failed"), stage and progress of a job.
+    """
+    try:
+        return jsonify({'status': 200, 'message': 'Analytics job fetched successfully!', 'data': get_job(job_id)})
+    except JobError as e:
+        return jsonify({'status': e.status, 'message': str(e), 'data': None}), e.status
+    except Exception as e:
+        log("Error in analytics_job_status", traceback.format_exc())
+        return jsonify({'status': 500, 'message': str(e), 'data': None}), 500
+
+
+def analytics_job_result(job_id):
+    try:
+        return jsonify({'status': 200, 'message': 'Analytics fetched successfully!', 'data': get_job_result(job_id)})
+    except JobError as e:
+        return jsonify({'status': e.status, 'message': str(e), 'data': None}), e.status
+    except Exception as e:
+        log("Error in analytics_job_result", traceback.format_exc())
+        return jsonify({'status': 500, 'message': str(e), 'data': None}), 500
+
+
+def analytics_report(org_id):
+    """
+        The analytics of an organization from its daily rollups, optionally between the ?start= and ?end= days.
+    """
+    try:
+        data = AnalyticsReportSchema().load(request.args)
+        start, end = [data[day].isoformat() if data[day] else None for day in ['start', 'end']]
+        report = get_report(org_id, start, end, data['limit'])
+        return jsonify({'status': 200, 'message': 'Analytics fetched successfully!', 'data': report})
+    except ValidationError as e:
+        return jsonify({'status': 400, 'message': 'Invalid fields', 'data': e.messages}), 400
+    except Exception as e:
+        log("Error in analytics_report", traceback.format_exc())
+        return jsonify({'status': 500, 'message': str(e), 'data': None}), 500
@@ -8,7 +8,7 @@ from constants.model_related import SMALL_TALK, ANSWERING_QUESTION, SHARING_FEED
 from constants.sources import INTENT, STANDALONE_QUESTION, VECTOR_IDS
 from ml_models.user_facing import estimate_intent, make_standalone_question
 from pinecone_related.query_pinecone import fetch_prompt_context_array
-from utils.helpers import log, process_messages, start_background_thread
+from utils.helpers import log, process_messages
 from utils.log_functions import save_sources_log
 
 
@@ -53,7 +53,7 @@ def fetch_vectors_from_conversation():
         formatted_chosen_sections = []
 
         # save logs to the database
-        start_background_thread(save_sources_log, message_id, {
+        save_sources_log(message_id, {
             INTENT: intent_map[intent],
             STANDALONE_QUESTION: standalone_question,
             VECTOR_IDS: [section["id"] for section in chosen_sections] if chosen_sections else [],
@@ -1,12 +1,23 @@
+import json
 import traceback
 import re
 
-from ml_models.common import chat_w_model
-from utils.helpers import (generate_final_prompt, log, add_message_source_to_g)
-from constants.model_related import (CITATION_QA_TEMPLATE, CITATION_REFINE_TEMPLATE)
-from constants.sources import (GPT_RESPONSE_REFINED, GPT_RESPONSE_WITH_CITATION, VECTORS_USED)
+from ml_models.common import chat_w_model, chat_w_model_async, chat_w_model_stream
+from utils.helpers import (generate_final_prompt, log, add_message_source_to_g, stream_sentences)
+from utils.tracing import set_span_attributes, traced
+from constants.model_related import (CITATION_JSON_QA_TEMPLATE, CITATION_LOOKAHEAD, CITATION_MODE, CITATION_MODE_JSON,
+                                     CITATION_MODE_REFINE, CITATION_QA_TEMPLATE, CITATION_REFINE_TEMPLATE)
+from constants.sources import (CITATION_ERRORS, GPT_RESPONSE_REFINED, GPT_RESPONSE_WITH_CITATION, VECTORS_USED)
 
+# Square brackets, "[12]" or "[12, 13]", on one line
+SQUARE_BRACKET_PATTERN = re.compile(r'\[(.*?)\]')
+# The "(url)" of a Markdown link "[text](url)", whose text is not a citation
+MARKDOWN_URL_PATTERN = re.compile(r'\((.*?)\)')
+# An item of square brackets that ends with a citation: "12", or "see [12" in "[see [12, 13]"
+CITATION_ITEM_PATTERN = re.compile(r'(.*\[)?(\d+)')
 
+
+@traced("get_response_with_citations")
 def get_response_with_citations(prompt:str, standalone_question:str, messages:list, conversation: str, relevant_sections:list, unsure_msg:str):
     """
         Retrieve a response with citations from relevant sections.
@@ -23,27 +34,21 @@ def get_response_with_citations(prompt:str, standalone_question:str, messages:li
                 a flag indicating if the response is answered, and an action ID.
     """
     try:
-        context_msg = ""
-        for source in relevant_sections:
-            context_msg += f"{source['id']}:\n{source['text']}\n\n"
-        strict_prompt = prompt + "\n" + CITATION_QA_TEMPLATE.format(
-            context_str = context_msg,
-            unsure_msg=unsure_msg,
-        )
-        final_prompt = generate_final_prompt(messages, strict_prompt)
-        response = chat_w_model(final_prompt, frequency_penalty=0)
-        add_message_source_to_g(GPT_RESPONSE_WITH_CITATION, response)
+        context_msg = build_citation_context(relevant_sections)
+        set_span_attributes(citation_mode=CITATION_MODE, sections=len(relevant_sections))
+        if CITATION_MODE == CITATION_MODE_JSON:
+            response = chat_w_model(build_citation_json_prompt(prompt, messages, context_msg), frequency_penalty=0, is_json=True)
+            add_message_source_to_g(GPT_RESPONSE_WITH_CITATION, response)
+            response, is_valid = check_json_citations(response, relevant_sections, unsure_msg)
+        else:
+            response = chat_w_model(build_citation_prompt(prompt, messages, context_msg, unsure_msg), frequency_penalty=0)
+            add_message_source_to_g(GPT_RESPONSE_WITH_CITATION, response)
+            is_valid = False
         if response == unsure_msg:
             return unsure_msg, -1
-        refined_strict_prompt = CITATION_REFINE_TEMPLATE.format(
-            existing_answer = response,
-            context_msg = context_msg,
-            # conversation=conversation
-        )
-        final_prompt = [{
-            "role": "user",
-            "content": refined_strict_prompt
-        }]
+        if is_valid:
+            return replace_ids_with_links(response, relevant_sections)
+        final_prompt = build_refine_prompt(response, context_msg)
         refined_response = chat_w_model(final_prompt, temperature=1, presence_penalty=0, frequency_penalty=0)
         add_message_source_to_g(GPT_RESPONSE_REFINED, refined_response)
         formatted_response, action_id = replace_ids_with_links(refined_response, relevant_sections)
@@ -53,67 +58,292 @@ def get_response_with_citations(prompt:str, standalone_question:str, messages:li
             raise e
 
 
-def replace_ids_with_links(response, relevant_sections):
+@traced("get_response_with_citations_async")
+async def get_response_with_citations_async(prompt:str, standalone_question:str, messages:list, conversation: str, relevant_sections:list, unsure_msg:str):
+    """
+        Async variant of get_response_with_citations, takes the same arguments.
+    """
+    try:
+        context_msg = build_citation_context(relevant_sections)
+        set_span_attributes(citation_mode=CITATION_MODE, sections=len(relevant_sections))
+        if CITATION_MODE == CITATION_MODE_JSON:
+            response = await chat_w_model_async(build_citation_json_prompt(prompt, messages, context_msg), frequency_penalty=0, is_json=True)
+            add_message_source_to_g(GPT_RESPONSE_WITH_CITATION, response)
+            response, is_valid = check_json_citations(response, relevant_sections, unsure_msg)
+        else:
+            response = await chat_w_model_async(build_citation_prompt(prompt, messages, context_msg, unsure_msg), frequency_penalty=0)
+            add_message_source_to_g(GPT_RESPONSE_WITH_CITATION, response)
+            is_valid = False
+        if response == unsure_msg:
+            return unsure_msg, -1
+        if is_valid:
+            return replace_ids_with_links(response, relevant_sections)
+        final_prompt = build_refine_prompt(response, context_msg)
+        refined_response = await chat_w_model_async(final_prompt, temperature=1, presence_penalty=0, frequency_penalty=0)
+        add_message_source_to_g(GPT_RESPONSE_REFINED, refined_response)
+        formatted_response, action_id = replace_ids_with_links(refined_response, relevant_sections)
+        return formatted_response, action_id
+    except Exception as e:
+            log(f"Error in get_response_with_citations_async", traceback.format_exc())
+            raise e
+
+
+@traced("stream_response_with_citations")
+def stream_response_with_citations(prompt:str, standalone_question:str, messages:list, conversation: str, relevant_sections:list, unsure_msg:str):
+    """
+        Streaming variant of get_response_with_citations.
+
+        The first answer is generated as before, the refine pass is streamed and its sentences are yielded as soon as
+        they are complete, with the vector IDs already replaced by links. Streaming always uses the refine mode
+        whatever CITATION_MODE is: a JSON answer can only be validated, and so sent, once it is complete.
+
+        Args:
+            prompt (str): The initial prompt.
+            standalone_question (str): A standalone question.
+            messages (list): List of messages.
+            conversation (str): Conversation between user and model.
+            relevant_sections (list): List of relevant sections with 'id' and 'description'.
+
+        Yields:
+            str: Sentences of the formatted response with citations.
+
+        Returns:
+            int or None: The action ID, -1 if the question could not be answered.
+    """
+    try:
+        context_msg = build_citation_context(relevant_sections)
+        set_span_attributes(citation_mode=CITATION_MODE_REFINE, sections=len(relevant_sections))
+        response = chat_w_model(build_citation_prompt(prompt, messages, context_msg, unsure_msg), frequency_penalty=0)
+        add_message_source_to_g(GPT_RESPONSE_WITH_CITATION, response)
+        if response == unsure_msg:
+            yield unsure_msg
+            return -1
+        refined_tokens = chat_w_model_stream(build_refine_prompt(response, context_msg), temperature=1, presence_penalty=0, frequency_penalty=0)
+        refined_sentences = []
+        # Shared by the sentences, so that they are numbered consistently and action_id covers all the citations
+        resolver = CitationResolver(relevant_sections)
+        for sentence in stream_sentences(refined_tokens):
+            refined_sentences.append(sentence.strip())
+            yield resolver.resolve(sentence)
+        add_message_source_to_g(GPT_RESPONSE_REFINED, " ".join(refined_sentences))
+        add_message_source_to_g(VECTORS_USED, list(resolver.source_ids))
+        return resolver.action_id
+    except Exception as e:
+            log(f"Error in stream_response_with_citations", traceback.format_exc())
+            raise e
+
+
+def build_citation_context(relevant_sections):
+    context_msg = ""
+    for source in relevant_sections:
+        context_msg += f"{source['id']}:\n{source['text']}\n\n"
+    return context_msg
+
+
+def build_citation_prompt(prompt, messages, context_msg, unsure_msg):
+    strict_prompt = prompt + "\n" + CITATION_QA_TEMPLATE.format(
+        context_str = context_msg,
+        unsure_msg=unsure_msg,
+    )
+    return generate_final_prompt(messages, strict_prompt)
+
+
+def build_citation_json_prompt(prompt, messages, context_msg):
+    strict_prompt = prompt + "\n" + CITATION_JSON_QA_TEMPLATE.format(
+        context_str = context_msg,
+    )
+    return generate_final_prompt(messages, strict_prompt)
+
+
+def check_json_citations(response, relevant_sections, unsure_msg):
+    """
+        Validates an answer generated with CITATION_JSON_QA_TEMPLATE: the response must be valid JSON,
+        every sentence must cite at least one source and every cited source must be one of relevant_sections.
+
+        Args:
+            response (str): The JSON response of the model.
+            relevant_sections (list): List of relevant sections with 'id'.
+            unsure_msg (str): Message returned when none of the sources are helpful.
+
+        Returns:
+            tuple: The answer with its citations in the square bracket format ("sentence [id]."), to be refined
+                if it is not valid, and whether it is valid.
+    """
+    try:
+        sentences = json.loads(response)["sentences"]
+        if len(sentences) == 0:
+            return unsure_msg, True
+        section_ids = {str(section.get("id")) for section in relevant_sections}
+        errors = []
+        answer = []
+        for sentence in sentences:
+            text = sentence.get("text", "").strip()
+            source_ids = [str(source_id).strip() for source_id in sentence.get("source_ids", [])]
+            if not source_ids:
+                errors.append(f"Sentence without citation: {text}")
+            unknown_ids = [source_id for source_id in source_ids if source_id not in section_ids]
+            if unknown_ids:
+                errors.append(f"Unknown sources {unknown_ids} in: {text}")
+            # Citations go before the closing punctuation, so that they stay with their sentence when it is split
+            body, punctuation = re.match(r'(.*?)([.!?]*)$', text, re.DOTALL).groups()
+            citations = "".join(f" [{source_id}]" for source_id in source_ids)
+            answer.append(f"{body}{citations}{punctuation}")
+        answer = " ".join(answer)
+        if answer == unsure_msg:
+            return unsure_msg, True
+        if errors:
+            log(f"--citations need to be refined: {errors}")
+            add_message_source_to_g(CITATION_ERRORS, errors)
+        set_span_attributes(citation_errors=len(errors))
+        return answer, len(errors) == 0
+    except Exception as e:
+        log("Error in check_json_citations", traceback.format_exc())
+        add_message_source_to_g(CITATION_ERRORS, ["Invalid JSON response"])
+        # The refine pass rewrites the answer from the raw response
+        return response, False
+
+
+def build_refine_prompt(existing_answer, context_msg):
+    refined_strict_prompt = CITATION_REFINE_TEMPLATE.format(
+        existing_answer = existing_answer,
+        context_msg = context_msg,
+        # conversation=conversation
+    )
+    return [{
+        "role": "user",
+        "content": refined_strict_prompt
+    }]
+
+
+class CitationResolver:
+    """
+        Replaces the vector IDs cited in a response, "[12]" or "[12, 13]", with numbered links to their sections,
+        "[[1]](link)", and removes the citations of unknown sections or sections without read_more_link.
+        The sections are indexed by id once, and every square bracket is rewritten by one substitution callback.
+
+        Numbers are given to the links in the order of their first citation, seen_links keeps them between the
+        parts of a response (resolve() per sentence, or feed() per chunk of a token stream). action_id is the one
+        of the last section with an action_id, in the order of first citation. A bracket followed by a non empty
+        "(url)" is a Markdown link, its last item is not a citation.
+
+        Args:
+            relevant_sections (list): List of relevant sections with 'id', 'score', and optionally 'action_id' and 'read_more_link'.
+            seen_links (dict, optional): Link -> citation number mapping. Defaults to None.
+    """
+
+    def __init__(self, relevant_sections, seen_links=None):
+        self.sections = {}
+        for section in relevant_sections:
+            self.sections.setdefault(section.get("id", None), section)
+        self.seen_links = {} if seen_links is None else seen_links
+        # Cited vector IDs, in the order of their first citation
+        self.source_ids = {}
+        self.action_id = None
+        self.buffer = ""
+
+    def resolve(self, response):
+        """
+            Returns the response with its citations replaced.
+        """
+        return SQUARE_BRACKET_PATTERN.sub(self.replace_square_brackets, response)
+
+    def replace_square_brackets(self, match):
+        """
+            Converts [12, 13] -> [12] [13], with the citations replaced.
+        """
+        url = MARKDOWN_URL_PATTERN.match(match.string, match.end())
+        items = match.group(1).split(',')
+        replaced = []
+        for position, item in enumerate(items):
+            item = item.strip()
+            citation = CITATION_ITEM_PATTERN.fullmatch(item)
+            if citation is None or (position == len(items) - 1 and url is not None and url.group(1)):
+                replaced.append(f"[{item}]")
+            else:
+                prefix, source_id = citation.groups()
+                replaced.append(("[" + prefix[:-1] if prefix else "") + self.cite(source_id))
+        return ' '.join(replaced)
+
+    def cite(self, source_id):
+        section = self.sections.get(int(source_id))
+        if source_id not in self.source_ids:
+            self.source_ids[source_id] = True
+            if section and section.get('action_id', None) and section['score'] > -1:
+                self.action_id = int(section['action_id'])
+        link = section.get("read_more_link", "") if section else ""
+        if not link:
+            return ""
+        if link not in self.seen_links:
+            self.seen_links[link] = len(self.seen_links) + 1
+        return f"[[{self.seen_links[link]}]]({link})"
+
+    def feed(self, chunk):
+        """
+            Adds the next chunk of a streamed response.
+
+            Returns:
+                str: The part of the response that is complete, with its citations replaced. What could still be a
+                citation or a Markdown link, from an unclosed "[" or "(" of the last line, is kept for the next
+                chunks, up to CITATION_LOOKAHEAD characters: the chunks are rewritten like the whole response
+                unless a citation or a link is longer than that.
+        """
+        self.buffer += chunk
+        line_start = self.buffer.rfind("\n") + 1
+        matches = list(SQUARE_BRACKET_PATTERN.finditer(self.buffer, line_start))
+        end = len(self.buffer)
+        opening = self.buffer.find("[", matches[-1].end() if matches else line_start)
+        if opening != -1:
+            end = opening
+        elif matches and matches[-1].end() == len(self.buffer):
+            end = matches[-1].start()
+        # Whether "(url)" follows a bracket, making it a Markdown link, is only known once its ")" is kept with it
+        held = True
+        while held:
+            held = False
+            for match in matches:
+                if match.start() >= end:
+                    break
+                if self.buffer.startswith("(", match.end()) and not 0 <= self.buffer.find(")", match.end()) < end:
+                    end = match.start()
+                    held = True
+                    break
+        if len(self.buffer) - end > CITATION_LOOKAHEAD:
+            end = len(self.buffer)
+        response, self.buffer = self.buffer[:end], self.buffer[end:]
+        return self.resolve(response) if response else ""
+
+    def flush(self):
+        """
+            Returns the rest of a streamed response, once its last chunk was fed.
+        """
+        response, self.buffer = self.buffer, ""
+        return self.resolve(response) if response else ""
+
+
+def replace_ids_with_links(response, relevant_sections, seen_links=None):
     """
         Process citations in the response, extract source vectors from relevant sections,
-        format citations, and replace vector IDs with links.
+        format citations, and replace vector IDs with links, see CitationResolver.
 
         Args:
             response (str): The response containing vector IDs.
             relevant_sections (list): List of relevant sections with 'id', 'score', and optionally 'action_id' and 'read_more_link'.
+            seen_links (dict, optional): Link -> citation number mapping shared between calls, so that the
+                parts of a streamed response are numbered consistently. Defaults to None.
 
         Returns:
             tuple: A tuple containing the formatted response with replaced links and an action ID.
     """
     try:
-        square_bracket_pattern = r'\[(.*?)\]'
-        # Converting [12, 23] -> [12] [23] etc.
-        response = re.sub(square_bracket_pattern, lambda x: ' '.join([f"[{item.strip()}]" for item in x.group(1).split(',')]), response)
-
-        # Avoid matching markdown texts
-        markdown_pattern = r'\[([^\[\]]*)\](\((.*?)\))?'
-        matches = re.findall(markdown_pattern, response)
-        id_filter = [text for text, _, url in matches if url]
-
-        int_inside_square_bracket_pattern = r'\[(\d+)\]'
-        source_ids = re.findall(int_inside_square_bracket_pattern, response)
-        source_ids = [id for id in source_ids if id not in id_filter]
-        unique_source_ids = list(dict.fromkeys(source_ids))
-
+        resolver = CitationResolver(relevant_sections, seen_links)
+        formatted_response = resolver.resolve(response)
+        source_ids = list(resolver.source_ids)
         log(f"--matches in response: {source_ids}")
-        add_message_source_to_g(VECTORS_USED, list(unique_source_ids))
-        log(f"--total citations in response: {len(unique_source_ids)}")
-        action_id = None
-        seen_links = {}
-        counter = 1
-        for v_id in unique_source_ids:
-            max_score = -1
-            section = None
-            try:
-                section = next((relevant_section for relevant_section in relevant_sections if relevant_section.get("id", None) == int(v_id)), None)
-            except:
-                log("Error in replace_ids_with_links", traceback.format_exc())
-            if section:
-                link = section.get("read_more_link", "")
-                if section.get('action_id', None):
-                    if section['score'] > max_score:
-                        max_score = section['score']
-                        action_id = int(section['action_id'])
-                if link:
-                    if link in seen_links:
-                        response = response.replace(f"[{v_id}]", f"{[[seen_links[link]]]}({link})")
-                    else:
-                        response = response.replace(f"[{v_id}]", f"{[[counter]]}({link})")
-                        seen_links[link] = counter
-                        counter += 1
-                else:
-                    response = response.replace(f"[{v_id}]", "")
-            else:
-                response = response.replace(f"[{v_id}]", "")
-                
-        return response, action_id
+        add_message_source_to_g(VECTORS_USED, source_ids)
+        log(f"--total citations in response: {len(source_ids)}")
+        return formatted_response, resolver.action_id
 
     except Exception as e:
         log(f"Error in replace_ids_with_links", traceback.format_exc())
         # TODO: remove all sources brackets
-        return response, None
\ No newline at end of file
+        return response, None
@@ -0,0 +1,8 @@
+# gunicorn settings of the Flask app, loaded from the working directory (see pm2.config.js)
+
+
+def post_worker_init(worker):
+    # Runs in every worker once app.py is loaded, before the worker accepts requests
+    from app import warm_connections
+
+    warm_connections()
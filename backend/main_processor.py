@@ -1,19 +1,113 @@
+import asyncio
+import contextvars
 import traceback
+from concurrent.futures import Future, ThreadPoolExecutor
 
+from constants.misc import PIPELINE_MAX_WORKERS
 from constants.model_related import (ANSWERING_QUESTION, END_CONVERSATION, intent_map,
-                                      PRODUCT_RELATED_QUERY, SMALL_TALK)
+                                      NON_PRODUCT_RELATED_QUERY, PRODUCT_RELATED_QUERY, SMALL_TALK)
 from constants.sources import GPT_RESPONSE, INTENT
 from ml_models.common import chat_w_model_w_tools
+from ml_models.gpt_helpers import create_embedding, create_embedding_async
 from ml_models.post_processing import generate_next_questions
-from ml_models.user_facing import (answer_query_generic, answer_query_generic_ncert,
-  answer_query_with_context, estimate_intent, get_second_last_user_intent,
-  make_standalone_question)
-from utils.helpers import (add_message_source_to_g, format_links_and_emails_as_markdown, log,
-  process_messages, remove_hashtags, split_sentences, start_background_thread)
+from ml_models.user_facing import (answer_query_generic, answer_query_generic_async,
+  answer_query_generic_ncert, answer_query_generic_stream, answer_query_with_context,
+  answer_query_with_context_async, answer_query_with_context_stream, estimate_intent,
+  estimate_intent_async, get_second_last_user_intent, make_standalone_question,
+  make_standalone_question_async)
+from utils.helpers import (add_message_source_to_g, log, post_process_response, process_messages,
+  split_sentences, start_background_thread, stream_sentences, submit_in_context)
+from utils.tracing import set_span_attributes, traced
 
 training = False
 
+pipeline_executor = ThreadPoolExecutor(max_workers=PIPELINE_MAX_WORKERS, thread_name_prefix="pipeline")
 
+
+def start_pipeline_stages(formatted_messages, conversation, org_description=None, messages=None, host_url=None):
+    """
+        Starts the stages of the pipeline that only depend on the conversation at the same time,
+        instead of waiting for the intent before making the standalone question.
+        The embedding of the standalone question is started as soon as the standalone question is ready.
+
+        Args:
+            formatted_messages (list): List of formatted messages ("SENDER: message").
+            conversation (str): The formatted messages joined by new lines.
+            org_description (str, optional): Description of the organization. Defaults to None.
+            messages (list, optional): The messages of the conversation, for the local intent prediction. Defaults to None.
+            host_url (str, optional): URL of the host, scope of the local intent prediction. Defaults to None.
+
+        Returns:
+            dict: Futures of the 'intent', 'standalone_question' and 'query_embedding' stages.
+    """
+    standalone_question = submit_in_context(
+        pipeline_executor, make_standalone_question, formatted_messages, formatted_messages[-1])
+    return {
+        "intent": submit_in_context(pipeline_executor, estimate_intent, conversation, org_description, messages, host_url),
+        "standalone_question": standalone_question,
+        "query_embedding": chain_stage(standalone_question, create_embedding),
+    }
+
+
+def chain_stage(future, function):
+    """
+        Runs function on the result of future as soon as it is available, in the thread that completed future.
+
+        Args:
+            future (concurrent.futures.Future): The stage this stage depends on.
+            function (callable): The function to run on the result of future.
+
+        Returns:
+            concurrent.futures.Future: The future of the function's result. Cancelling it before future
+            completes skips the function.
+    """
+    chained = Future()
+    context = contextvars.copy_context()
+
+    def run(done):
+        if not chained.set_running_or_notify_cancel():
+            return
+        try:
+            chained.set_result(context.run(function, done.result()))
+        except Exception as e:
+            chained.set_exception(e)
+
+    future.add_done_callback(run)
+    return chained
+
+
+def uses_retrieval(intent, host_url):
+    """
+        Whether the message is answered with retrieval (RAG), mirrors the intent branches of respond_to_user.
+    """
+    if intent in [SMALL_TALK, ANSWERING_QUESTION, END_CONVERSATION]:
+        return False
+    if host_url == "multibhashi" and intent == PRODUCT_RELATED_QUERY:  # TODO: Remove multibhashi
+        return False
+    return host_url != "ncertexplained"
+
+
+def discard_pipeline_stages(stages, *names):
+    """
+        Cancels the stages the routed intent does not need. Stages that are already running finish in the
+        background and their results are ignored.
+    """
+    for name in names:
+        stages[name].cancel()
+
+
+def get_stage_result(stages, name, default=None):
+    """
+        Waits for a stage and returns its result, or default if the stage failed.
+    """
+    try:
+        return stages[name].result()
+    except Exception as e:
+        log(f"Error in pipeline stage {name}", traceback.format_exc())
+        return default
+
+
+@traced("respond_to_user", root=True)
 def respond_to_user(messages, message_id=None, host_url=None, org_id=None, prompt=None, pinecone_index=None,
                     closure_msg="Is there anything else I can assist you with?",
                     namespace='',
@@ -54,6 +148,7 @@ def respond_to_user(messages, message_id=None, host_url=None, org_id=None, promp
     if namespace is None:
         namespace = ""
     messages = process_messages(messages)
+    set_span_attributes(message_id=message_id, host_url=host_url, pinecone_index=pinecone_index, namespace=namespace)
 
     conversation_status = "ongoing"
     gpt_response = None
@@ -62,8 +157,12 @@ def respond_to_user(messages, message_id=None, host_url=None, org_id=None, promp
     try:
         formatted_messages = [(f"{message.get('sender')}: {message.get('message')}") for message in messages]
         conversation = "\n".join(formatted_messages)
-        intent = estimate_intent(conversation, org_description)
+        stages = start_pipeline_stages(formatted_messages, conversation, org_description, messages, host_url)
+        intent = get_stage_result(stages, "intent", NON_PRODUCT_RELATED_QUERY)
         add_message_source_to_g(INTENT, intent_map[intent])
+        set_span_attributes(intent=intent_map[intent])
+        if not uses_retrieval(intent, host_url):
+            discard_pipeline_stages(stages, "query_embedding", "standalone_question")
 
         # Performing intent actions
         # TODO: Implement Yogasa style response for Answering Question
@@ -86,7 +185,7 @@ def respond_to_user(messages, message_id=None, host_url=None, org_id=None, promp
 
         else:
             # Handling standalone question
-            standalone_question = make_standalone_question(formatted_messages, formatted_messages[-1])
+            standalone_question = get_stage_result(stages, "standalone_question", formatted_messages[-1])
 
             gpt_response, relevant_sections, action_id = answer_query_with_context(
                 messages,
@@ -100,7 +199,8 @@ def respond_to_user(messages, message_id=None, host_url=None, org_id=None, promp
                 sender_city,
                 sender_country,
                 unsure_msg,
-                buckets)
+                buckets,
+                get_stage_result(stages, "query_embedding"))
 
 
             log("FINAL OUTPUT DETAILS")
@@ -108,12 +208,13 @@ def respond_to_user(messages, message_id=None, host_url=None, org_id=None, promp
 
             # generate next questions
             start_background_thread(
-                generate_next_questions, formatted_messages, gpt_response, relevant_sections, message_id)
+                generate_next_questions, formatted_messages, gpt_response, relevant_sections, message_id,
+                lane="next_questions")
             # If the question is not answered
             if gpt_response == unsure_msg:
                 log("Question not answered")
 
-        gpt_response = format_links_and_emails_as_markdown(remove_hashtags(gpt_response))
+        gpt_response = post_process_response(gpt_response)
         if len(gpt_response) == 0 and intent != END_CONVERSATION:
             gpt_response = unsure_msg
         gpt_response = split_sentences(gpt_response)
@@ -124,3 +225,231 @@ def respond_to_user(messages, message_id=None, host_url=None, org_id=None, promp
         log("Error in respond_to_user", traceback.format_exc())
         raise e
         # return "some error occurred!", "ended"
+
+
+@traced("respond_to_user_async", root=True)
+async def respond_to_user_async(messages, message_id=None, host_url=None, org_id=None, prompt=None, pinecone_index=None,
+                                closure_msg="Is there anything else I can assist you with?",
+                                namespace='',
+                                conversation_status="ongoing",
+                                unsure_msg: str = "",
+                                filters: dict = None,
+                                sender_city=None, sender_country=None, buckets=None, org_description=None):
+    """
+        Async variant of respond_to_user, takes the same arguments and returns the same values.
+        The intent, standalone question and query embedding stages run as concurrent tasks.
+    """
+    if buckets is None:
+        buckets = []
+    if namespace is None:
+        namespace = ""
+    messages = process_messages(messages)
+    set_span_attributes(message_id=message_id, host_url=host_url, pinecone_index=pinecone_index, namespace=namespace)
+
+    conversation_status = "ongoing"
+    gpt_response = None
+    is_answered = True
+    action_id = None
+    try:
+        formatted_messages = [(f"{message.get('sender')}: {message.get('message')}") for message in messages]
+        conversation = "\n".join(formatted_messages)
+        intent_task = asyncio.create_task(estimate_intent_async(conversation, org_description, messages, host_url))
+        standalone_task = asyncio.create_task(make_standalone_question_async(formatted_messages, formatted_messages[-1]))
+        embedding_task = asyncio.create_task(embed_standalone_question_async(standalone_task))
+        intent = await intent_task
+        add_message_source_to_g(INTENT, intent_map[intent])
+        set_span_attributes(intent=intent_map[intent])
+        if not uses_retrieval(intent, host_url):
+            embedding_task.cancel()
+            standalone_task.cancel()
+
+        if intent in [SMALL_TALK, ANSWERING_QUESTION]:
+            gpt_response = await answer_query_generic_async(messages, prompt)
+            add_message_source_to_g(GPT_RESPONSE, gpt_response)
+        elif intent == END_CONVERSATION:
+            previous_intent = get_second_last_user_intent(messages)
+            if previous_intent == intent_map[END_CONVERSATION]:
+                gpt_response = ''
+            else:
+                gpt_response = closure_msg
+            conversation_status = "ended"
+        elif host_url == "multibhashi" and intent == PRODUCT_RELATED_QUERY:  # TODO: Remove multibhashi
+            gpt_response = await asyncio.to_thread(chat_w_model_w_tools, messages, host_url, prompt)
+            add_message_source_to_g(GPT_RESPONSE, gpt_response)
+        elif host_url == "ncertexplained":
+            gpt_response = await answer_query_generic_async(messages, prompt, small_talk=False)
+
+        else:
+            try:
+                standalone_question = await standalone_task
+            except Exception as e:
+                log("Error in pipeline stage standalone_question", traceback.format_exc())
+                standalone_question = formatted_messages[-1]
+            try:
+                query_embedding = await embedding_task
+            except Exception as e:
+                log("Error in pipeline stage query_embedding", traceback.format_exc())
+                query_embedding = None
+
+            gpt_response, relevant_sections, action_id = await answer_query_with_context_async(
+                messages,
+                conversation,
+                standalone_question,
+                pinecone_index,
+                filters,
+                host_url,
+                prompt,
+                namespace,
+                sender_city,
+                sender_country,
+                unsure_msg,
+                buckets,
+                query_embedding)
+
+            log("FINAL OUTPUT DETAILS")
+
+            start_background_thread(
+                generate_next_questions, formatted_messages, gpt_response, relevant_sections, message_id,
+                lane="next_questions")
+            if gpt_response == unsure_msg:
+                log("Question not answered")
+
+        gpt_response = post_process_response(gpt_response)
+        if len(gpt_response) == 0 and intent != END_CONVERSATION:
+            gpt_response = unsure_msg
+        gpt_response = split_sentences(gpt_response)
+
+        return gpt_response, conversation_status, is_answered, action_id
+
+    except Exception as e:
+        log("Error in respond_to_user_async", traceback.format_exc())
+        raise e
+
+
+async def embed_standalone_question_async(standalone_task):
+    """
+        Embeds the standalone question as soon as its task is done.
+    """
+    return await create_embedding_async(await standalone_task)
+
+
+@traced("respond_to_user_stream", root=True)
+def respond_to_user_stream(messages, message_id=None, host_url=None, org_id=None, prompt=None, pinecone_index=None,
+                           closure_msg="Is there anything else I can assist you with?",
+                           namespace='',
+                           conversation_status="ongoing",
+                           unsure_msg: str = "",
+                           filters: dict = None,
+                           sender_city=None, sender_country=None, buckets=None, org_description=None):
+    """
+        Streaming variant of respond_to_user, takes the same arguments.
+        Sentences are yielded as soon as the model has generated them, instead of after the whole pipeline has finished.
+
+        Yields:
+            dict: Events with the following format:
+                - {"event": "sentence", "data": str} for every sentence of the response.
+                - {"event": "end", "data": dict} once the response is complete. The data contains
+                  'conversation_status', and 'action_id' and 'unanswered' when applicable.
+    """
+    if buckets is None:
+        buckets = []
+    if namespace is None:
+        namespace = ""
+    messages = process_messages(messages)
+    set_span_attributes(message_id=message_id, host_url=host_url, pinecone_index=pinecone_index, namespace=namespace)
+
+    conversation_status = "ongoing"
+    is_answered = True
+    action_id = None
+    response_sentences = []
+    try:
+        formatted_messages = [(f"{message.get('sender')}: {message.get('message')}") for message in messages]
+        conversation = "\n".join(formatted_messages)
+        stages = start_pipeline_stages(formatted_messages, conversation, org_description, messages, host_url)
+        intent = get_stage_result(stages, "intent", NON_PRODUCT_RELATED_QUERY)
+        add_message_source_to_g(INTENT, intent_map[intent])
+        set_span_attributes(intent=intent_map[intent])
+        if not uses_retrieval(intent, host_url):
+            discard_pipeline_stages(stages, "query_embedding", "standalone_question")
+
+        if intent in [SMALL_TALK, ANSWERING_QUESTION]:
+            yield from stream_sentence_events(
+                stream_sentences(answer_query_generic_stream(messages, prompt)), response_sentences)
+        elif intent == END_CONVERSATION:
+            previous_intent = get_second_last_user_intent(messages)
+            if previous_intent != intent_map[END_CONVERSATION]:
+                yield from stream_sentence_events(split_sentences(closure_msg) or [], response_sentences)
+            conversation_status = "ended"
+        elif host_url == "multibhashi" and intent == PRODUCT_RELATED_QUERY:  # TODO: Remove multibhashi
+            gpt_response = chat_w_model_w_tools(messages, host_url, prompt)
+            yield from stream_sentence_events(split_sentences(gpt_response) or [], response_sentences)
+        elif host_url == "ncertexplained":
+            yield from stream_sentence_events(
+                stream_sentences(answer_query_generic_stream(messages, prompt, small_talk=False)), response_sentences)
+        else:
+            standalone_question = get_stage_result(stages, "standalone_question", formatted_messages[-1])
+
+            relevant_sections, action_id = yield from stream_sentence_events(
+                answer_query_with_context_stream(
+                    messages,
+                    conversation,
+                    standalone_question,
+                    pinecone_index,
+                    filters,
+                    host_url,
+                    prompt,
+                    namespace,
+                    sender_city,
+                    sender_country,
+                    unsure_msg,
+                    buckets,
+                    get_stage_result(stages, "query_embedding")),
+                response_sentences)
+
+            gpt_response = " ".join(response_sentences)
+            start_background_thread(
+                generate_next_questions, formatted_messages, gpt_response, relevant_sections, message_id,
+                lane="next_questions")
+            if gpt_response == unsure_msg:
+                log("Question not answered")
+
+        if len(response_sentences) == 0 and intent != END_CONVERSATION:
+            yield from stream_sentence_events(split_sentences(unsure_msg) or [], response_sentences)
+
+        add_message_source_to_g(GPT_RESPONSE, response_sentences)
+        end_data = {'conversation_status': conversation_status}
+        if int(is_answered) == 0:
+            end_data["unanswered"] = 1
+        if action_id != -1:
+            end_data['action_id'] = action_id
+        yield {"event": "end", "data": end_data}
+
+    except Exception as e:
+        log("Error in respond_to_user_stream", traceback.format_exc())
+        raise e
+
+
+def stream_sentence_events(sentences, response_sentences):
+    """
+        Formats the sentences of a streamed response and wraps them in sentence events.
+
+        Args:
+            sentences (iterable): Sentences of the response, can be a generator with a return value.
+            response_sentences (list): Every formatted sentence is appended to this list.
+
+        Yields:
+            dict: {"event": "sentence", "data": str} for every non empty sentence.
+
+        Returns:
+            The return value of the sentences generator, if any.
+    """
+    iterator = iter(sentences)
+    while True:
+        try:
+            sentence = next(iterator)
+        except StopIteration as stop:
+            return stop.value
+        sentence = post_process_response(sentence)
+        if sentence:
+            response_sentences.append(sentence)
+            yield {"event": "sentence", "data": sentence}
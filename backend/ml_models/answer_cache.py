@@ -0,0 +1,157 @@
+import hashlib
+import json
+import threading
+import time
+import traceback
+from collections import OrderedDict
+
+import numpy as np
+
+from constants.cache_related import (ANSWER_CACHE_MAX_ENTRIES_PER_SCOPE, ANSWER_CACHE_MAX_SCOPES,
+                                     ANSWER_CACHE_SIMILARITY, ANSWER_CACHE_TTL)
+from constants.sources import ANSWER_CACHE_HIT
+from utils.cache import bump_namespace_generation, caches, get_namespace_generation
+from utils.helpers import add_message_source_to_g, log
+from utils.tracing import set_span_attributes
+
+
+class SemanticAnswerCache:
+    """
+        In-process cache of cited answers, looked up by the similarity of the standalone question's embedding.
+        Entries are grouped in scopes, an answer is only reused within the scope it was generated in.
+
+        Args:
+            threshold (float): Minimum cosine similarity between two questions to reuse an answer.
+            ttl (int): Seconds an answer stays valid.
+            max_scopes (int): Maximum number of scopes, the least recently used scope is evicted first.
+            max_entries (int): Maximum number of answers per scope, the oldest answer is evicted first.
+    """
+
+    def __init__(self, threshold, ttl, max_scopes, max_entries):
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_scopes = max_scopes
+        self.max_entries = max_entries
+        self._scopes = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        caches["semantic_answers"] = self
+
+    def lookup(self, scope, embedding):
+        """
+            Returns the cached answer of the most similar question in the scope, or None.
+        """
+        query = normalize(embedding)
+        with self._lock:
+            entries = self._scopes.get(scope)
+            if entries is not None:
+                self._scopes.move_to_end(scope)
+                self._drop_expired(entries)
+            if not entries:
+                self.misses += 1
+                return None
+            vectors = np.stack([vector for vector, _, _ in entries])
+            similarities = vectors @ query
+            best = int(np.argmax(similarities))
+            if similarities[best] < self.threshold:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return {**entries[best][1], "similarity": float(similarities[best])}
+
+    def store(self, scope, embedding, value):
+        with self._lock:
+            entries = self._scopes.setdefault(scope, [])
+            self._scopes.move_to_end(scope)
+            self._drop_expired(entries)
+            entries.append((normalize(embedding), value, time.monotonic() + self.ttl))
+            del entries[:-self.max_entries]
+            while len(self._scopes) > self.max_scopes:
+                self._scopes.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._scopes.clear()
+
+    def invalidate(self, pinecone_index, namespace):
+        """
+            Drops the scopes of a namespace in this process. Other processes stop using them once the
+            namespace generation is bumped.
+        """
+        with self._lock:
+            for scope in [scope for scope in self._scopes if scope[:2] == (pinecone_index, namespace)]:
+                del self._scopes[scope]
+
+    def _drop_expired(self, entries):
+        now = time.monotonic()
+        entries[:] = [entry for entry in entries if entry[2] >= now]
+
+    def stats(self):
+        return {
+            "scopes": len(self._scopes),
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+
+def normalize(embedding):
+    vector = np.asarray(embedding, dtype=np.float32)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm > 0 else vector
+
+
+answer_cache = SemanticAnswerCache(ANSWER_CACHE_SIMILARITY, ANSWER_CACHE_TTL,
+                                   ANSWER_CACHE_MAX_SCOPES, ANSWER_CACHE_MAX_ENTRIES_PER_SCOPE)
+
+
+def answer_cache_scope(pinecone_index, namespace, prompt, buckets):
+    """
+        Scope of the cached answers: the index, namespace and its generation, and hashes of the prompt and buckets.
+    """
+    prompt_hash = hashlib.sha256((prompt or "").encode("utf-8")).hexdigest()
+    buckets_hash = hashlib.sha256(json.dumps(buckets or [], sort_keys=True, default=str).encode("utf-8")).hexdigest()
+    generation = get_namespace_generation(pinecone_index, namespace)
+    return (pinecone_index, namespace, generation, prompt_hash, buckets_hash)
+
+
+def get_cached_answer(scope, embedding):
+    """
+        Looks up an answer for a near-duplicate of the standalone question.
+
+        Args:
+            scope (tuple): The scope returned by answer_cache_scope.
+            embedding (list): The embedding of the standalone question.
+
+        Returns:
+            dict or None: The cached 'response', 'relevant_sections' and 'action_id', or None.
+    """
+    try:
+        cached = answer_cache.lookup(scope, embedding)
+        add_message_source_to_g(ANSWER_CACHE_HIT, cached is not None)
+        set_span_attributes(answer_cache_hit=cached is not None)
+        if cached is not None:
+            log(f"--answer cache hit, similarity: {cached['similarity']}")
+        return cached
+    except Exception as e:
+        log("Error in get_cached_answer", traceback.format_exc())
+        return None
+
+
+def cache_answer(scope, embedding, response, relevant_sections, action_id):
+    try:
+        answer_cache.store(scope, embedding, {
+            "response": response,
+            "relevant_sections": relevant_sections,
+            "action_id": action_id,
+        })
+    except Exception as e:
+        log("Error in cache_answer", traceback.format_exc())
+
+
+def invalidate_cached_answers(pinecone_index, namespace):
+    """
+        Invalidates the cached answers of a namespace in every process, by bumping its generation.
+    """
+    answer_cache.invalidate(pinecone_index, namespace)
+    return bump_namespace_generation(pinecone_index, namespace)
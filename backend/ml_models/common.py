@@ -1,4 +1,4 @@
-from openai import OpenAI
+from openai import AsyncOpenAI, OpenAI
 from openai.types.chat import ChatCompletionMessageParam
 from typing import Literal, Union, Iterable
 from constants.credentials import GEMINI_API_KEY, OPENAI_API_KEY, OPENAI_ORGANIZATION
@@ -7,13 +7,17 @@ import constants.openai_related as openai_constants
 import constants.gemini_related as gemini_constants
 import traceback
 from utils.helpers import add_message_source_to_g, generate_final_prompt, log
+from utils.tracing import set_span_attributes, traced
 from utils.products import make_tool_call, make_tool
 from ml_models.gpt_helpers import openai_prompt_to_gemini
 from constants.sources import TOOL_CALLS
 
 client = OpenAI(api_key=OPENAI_API_KEY,
                 organization=OPENAI_ORGANIZATION)
+async_client = AsyncOpenAI(api_key=OPENAI_API_KEY,
+                           organization=OPENAI_ORGANIZATION)
 
+@traced("chat_w_openai")
 def chat_w_openai(
     final_prompt,
     temperature,
@@ -48,6 +52,7 @@ def chat_w_openai(
                                                 presence_penalty=presence_penalty,
                                                 stop=stop)
 
+        set_chat_span_attributes(response, is_json)
         log("----PROMPT----")
         log(final_prompt)
         log("---RESPONSE---")
@@ -57,7 +62,111 @@ def chat_w_openai(
     except Exception as e:
         log("Error in chat_w_openai", traceback.format_exc())
         raise e
-    
+
+
+@traced("chat_w_openai_async")
+async def chat_w_openai_async(
+    final_prompt,
+    temperature,
+    is_json,
+    max_tokens,
+    top_p,
+    frequency_penalty,
+    presence_penalty,
+    stop,
+    model,
+):
+    """
+        Async variant of chat_w_openai, takes the same arguments.
+    """
+    try:
+        response = await async_client.chat.completions.create(model="gpt-4o-mini",
+                                                              messages=final_prompt,
+                                                              temperature=temperature,
+                                                              max_tokens=max_tokens,
+                                                              top_p=top_p,
+                                                              response_format={ "type": "json_object" if is_json else "text" },
+                                                              frequency_penalty=frequency_penalty,
+                                                              presence_penalty=presence_penalty,
+                                                              stop=stop)
+
+        set_chat_span_attributes(response, is_json)
+        log("----PROMPT----")
+        log(final_prompt)
+        log("---RESPONSE---")
+        log(response.choices[0].message.content.strip(" \n"))
+
+        return response.choices[0].message.content.strip(" \n")
+    except Exception as e:
+        log("Error in chat_w_openai_async", traceback.format_exc())
+        raise e
+
+
+@traced("chat_w_openai_stream")
+def chat_w_openai_stream(
+    final_prompt,
+    temperature,
+    max_tokens,
+    top_p,
+    frequency_penalty,
+    presence_penalty,
+    stop,
+    model,
+):
+    """
+        Chat with OpenAI's language model and yield the response tokens as they arrive.
+
+        Args:
+        - final_prompt (list): List containing dictionaries representing parts of the prompt.
+        - temperature (float): Sampling temperature for generating responses.
+
+        Yields:
+        - str: Text tokens of the response, in the order they are generated.
+    """
+    try:
+        stream = client.chat.completions.create(model="gpt-4o-mini",
+                                                messages=final_prompt,
+                                                temperature=temperature,
+                                                max_tokens=max_tokens,
+                                                top_p=top_p,
+                                                frequency_penalty=frequency_penalty,
+                                                presence_penalty=presence_penalty,
+                                                stop=stop,
+                                                stream=True)
+
+        set_span_attributes(**{"gen_ai.request.model": "gpt-4o-mini", "stream": True})
+        log("----PROMPT----")
+        log(final_prompt)
+
+        response = ""
+        for chunk in stream:
+            if len(chunk.choices) == 0:
+                continue
+            token = chunk.choices[0].delta.content
+            if token:
+                response += token
+                yield token
+
+        log("---RESPONSE---")
+        log(response.strip(" \n"))
+    except Exception as e:
+        log("Error in chat_w_openai_stream", traceback.format_exc())
+        raise e
+
+
+def set_chat_span_attributes(response, is_json):
+    """
+        Records the model and the token counts of a chat completion on the current span.
+    """
+    attributes = {"gen_ai.request.model": "gpt-4o-mini", "gen_ai.response.model": getattr(response, "model", None),
+                  "is_json": is_json}
+    usage = getattr(response, "usage", None)
+    if usage is not None:
+        attributes["gen_ai.usage.input_tokens"] = usage.prompt_tokens
+        attributes["gen_ai.usage.output_tokens"] = usage.completion_tokens
+    set_span_attributes(**attributes)
+
+
 def chat_w_model(
     final_prompt:Iterable[ChatCompletionMessageParam],
     frequency_penalty=1.2,
@@ -107,6 +216,82 @@ def chat_w_model(
         log("Error in chat_w_model", traceback.format_exc())
 
 
+async def chat_w_model_async(
+    final_prompt:Iterable[ChatCompletionMessageParam],
+    frequency_penalty=1.2,
+    presence_penalty=1,
+    stop=["\n**\n"],
+    max_tokens=400,
+    top_p=1,
+    temperature=0.5,
+    is_json=False,
+    provider:Literal["openai"] = "openai",
+    model: str = openai_constants.COMPLETIONS_MODEL_STABLE,
+    _fallback=False
+):
+    """
+        Async variant of chat_w_model, takes the same arguments.
+
+        Returns:
+            str: The response from the chat model.
+            None: If the model fails.
+    """
+    response=None
+    try:
+        if provider == "openai":
+            response = await chat_w_openai_async(
+                final_prompt=final_prompt,
+                temperature=temperature,
+                is_json=is_json,
+                stop=stop,
+                frequency_penalty=frequency_penalty,
+                max_tokens=max_tokens,
+                presence_penalty=presence_penalty,
+                top_p=top_p,
+                model=model,
+            )
+        return response
+    except Exception as e:
+        log("Error in chat_w_model_async", traceback.format_exc())
+
+
+def chat_w_model_stream(
+    final_prompt:Iterable[ChatCompletionMessageParam],
+    frequency_penalty=1.2,
+    presence_penalty=1,
+    stop=["\n**\n"],
+    max_tokens=400,
+    top_p=1,
+    temperature=0.5,
+    provider:Literal["openai"] = "openai",
+    model: str = openai_constants.COMPLETIONS_MODEL_STABLE,
+):
+    """
+        Streaming variant of chat_w_model, yields the response tokens as they arrive from the chat model.
+
+        Args:
+            final_prompt (list): The final prompt to be sent to the chat model.
+            temperature (float, optional): The temperature parameter for the model. Defaults to 0.5.
+
+        Yields:
+            str: Text tokens of the response. Nothing more is yielded if the model fails.
+    """
+    try:
+        if provider == "openai":
+            yield from chat_w_openai_stream(
+                final_prompt=final_prompt,
+                temperature=temperature,
+                stop=stop,
+                frequency_penalty=frequency_penalty,
+                max_tokens=max_tokens,
+                presence_penalty=presence_penalty,
+                top_p=top_p,
+                model=model,
+            )
+    except Exception as e:
+        log("Error in chat_w_model_stream", traceback.format_exc())
+
+
 
 def chat_w_model_w_tools(messages, host_url, prompt=None):
     """
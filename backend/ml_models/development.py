@@ -21,6 +21,18 @@ def prompt_chaining(question, context):
     return chat_w_model(final_prompt)
 
 
+# Refined patterns, also used by the keyword rules of ml_models.intent_classifier
+SMALL_TALK_PATTERNS = [r"\bhi\b", r"\bhello\b", r"\bhey\b", r"\byo\b", r"\bhow's it going\b", r"\bhow are you\b",
+                       r"\bwhat's up\b", r"\bfeeling .+", r"you are .+", r"are you .+"]
+SEEKING_INFO_PATTERNS = [r"\bwhat\b", r"\bhow\b", r"\bwhy\b", r"\bwhere\b", r"\bwhen\b", r"\bwhich\b", r"\bwho\b",
+                         r"\bcan\b", r"\bcould\b", r"\bshould\b", r"\bwould\b", r"\bdo\b", r"\bdoes\b", r"\bdid\b",
+                         r"\bhave\b", r"\bhas\b", r"\bhad\b", r"\bshare\b", r"\bneed\b", r"\bwant\b", r"\bi have\b",
+                         r"\bi'm looking for\b", r"\binterested in\b"]
+ENDING_CONVERSATION_PATTERNS = [r"\bok\b", r"\bokay\b", r"\bthanks\b", r"\bthank you\b", r"\bbye\b", r"\bsee you\b",
+                                r"\bgoodbye\b", r"\btalk later\b", r"\bcatch you later\b", r"\bthat's all\b",
+                                r"\bthat's it\b", r"\bno more questions\b", r"\bi'll leave now\b"]
+
+
 def refine_intent_estimator(user_input):
     """
     Refined version of the intent estimator to better distinguish between small talk, seeking information, and ending the conversation.
@@ -28,23 +40,12 @@ def refine_intent_estimator(user_input):
     # TODO: Test this and if better, then use this
     user_input = user_input.lower()
 
-    # Refined patterns
-    small_talk_patterns = [r"\bhi\b", r"\bhello\b", r"\bhey\b", r"\byo\b", r"\bhow's it going\b", r"\bhow are you\b",
-                           r"\bwhat's up\b", r"\bfeeling .+", r"you are .+", r"are you .+"]
-    seeking_info_patterns = [r"\bwhat\b", r"\bhow\b", r"\bwhy\b", r"\bwhere\b", r"\bwhen\b", r"\bwhich\b", r"\bwho\b",
-                             r"\bcan\b", r"\bcould\b", r"\bshould\b", r"\bwould\b", r"\bdo\b", r"\bdoes\b", r"\bdid\b",
-                             r"\bhave\b", r"\bhas\b", r"\bhad\b", r"\bshare\b", r"\bneed\b", r"\bwant\b", r"\bi have\b",
-                             r"\bi'm looking for\b", r"\binterested in\b"]
-    ending_conversation_patterns = [r"\bok\b", r"\bokay\b", r"\bthanks\b", r"\bthank you\b", r"\bbye\b", r"\bsee you\b",
-                                    r"\bgoodbye\b", r"\btalk later\b", r"\bcatch you later\b", r"\bthat's all\b",
-                                    r"\bthat's it\b", r"\bno more questions\b", r"\bi'll leave now\b"]
-
     # Check patterns
-    if any(re.search(pattern, user_input) for pattern in small_talk_patterns):
+    if any(re.search(pattern, user_input) for pattern in SMALL_TALK_PATTERNS):
         return 0
-    elif any(re.search(pattern, user_input) for pattern in seeking_info_patterns):
+    elif any(re.search(pattern, user_input) for pattern in SEEKING_INFO_PATTERNS):
         return 1
-    elif any(re.search(pattern, user_input) for pattern in ending_conversation_patterns):
+    elif any(re.search(pattern, user_input) for pattern in ENDING_CONVERSATION_PATTERNS):
         return 2
     else:
         return 1  # Default to seeking information
@@ -0,0 +1,93 @@
+import contextvars
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from constants.common import EMBEDDING_BATCH_MAX_INPUTS, EMBEDDING_BATCH_WAIT, EMBEDDING_BATCH_WORKERS
+
+
+class EmbeddingBatcher:
+    """
+        Collects the embedding requests of concurrent callers into batches, sent as a single embeddings API call.
+        A batch is sent max_wait seconds after its first request, or as soon as it has max_inputs inputs.
+
+        Args:
+            embed (function): Embeds a list of texts, returns their embeddings in the same order.
+            max_wait (float, optional): Seconds the first request of a batch waits. Defaults to EMBEDDING_BATCH_WAIT.
+            max_inputs (int, optional): Maximum inputs of a batch. Defaults to EMBEDDING_BATCH_MAX_INPUTS.
+            workers (int, optional): Batches sent at the same time. Defaults to EMBEDDING_BATCH_WORKERS.
+    """
+
+    def __init__(self, embed, max_wait=EMBEDDING_BATCH_WAIT, max_inputs=EMBEDDING_BATCH_MAX_INPUTS,
+                 workers=EMBEDDING_BATCH_WORKERS):
+        self.embed = embed
+        self.max_wait = max_wait
+        self.max_inputs = max_inputs
+        self.workers = workers
+        self.requests = 0
+        self.batches = 0
+        self._pending = []
+        self._condition = threading.Condition()
+        self._thread = None
+        self._executor = None
+
+    def submit(self, text):
+        """
+            Queues a text for the next batch.
+
+            Returns:
+                concurrent.futures.Future: Resolves to the embedding of the text.
+        """
+        future = Future()
+        with self._condition:
+            self._start()
+            # The batch is sent in the context of its first request, so that it is traced under that request
+            self._pending.append((text, future, contextvars.copy_context(), time.monotonic()))
+            self.requests += 1
+            self._condition.notify()
+        return future
+
+    def _start(self):
+        # Started on first use, after gunicorn forked the worker
+        if self._thread is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="embedding-batch")
+            self._thread = threading.Thread(target=self._run, name="embedding-batcher", daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._pending:
+                    self._condition.wait()
+                deadline = self._pending[0][3] + self.max_wait
+                while len(self._pending) < self.max_inputs and time.monotonic() < deadline:
+                    self._condition.wait(deadline - time.monotonic())
+                batch, self._pending = self._pending[:self.max_inputs], self._pending[self.max_inputs:]
+                self.batches += 1
+            self._executor.submit(self._send, batch)
+
+    def _send(self, batch):
+        # Callers that timed out cancelled their future, their texts are not embedded
+        batch = [entry for entry in batch if not entry[1].cancelled()]
+        if not batch:
+            return
+        texts = list(dict.fromkeys(text for text, _, _, _ in batch))
+        try:
+            embeddings = batch[0][2].run(self.embed, texts)
+        except Exception as e:
+            for _, future, _, _ in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        embeddings_by_text = dict(zip(texts, embeddings))
+        for text, future, _, _ in batch:
+            # A caller may also time out while the batch is being embedded
+            if not future.done():
+                future.set_result(embeddings_by_text[text])
+
+    def stats(self):
+        return {
+            "requests": self.requests,
+            "batches": self.batches,
+            "pending": len(self._pending),
+        }
@@ -0,0 +1,49 @@
+import hashlib
+from array import array
+
+from constants.cache_related import EMBEDDING_CACHE_MAXSIZE, EMBEDDING_CACHE_REDIS_TTL, EMBEDDING_CACHE_TTL
+from constants.common import EMBEDDING_MODEL
+from utils.cache import RedisCache, TTLCache
+
+local_embeddings = TTLCache("embeddings", maxsize=EMBEDDING_CACHE_MAXSIZE, ttl=EMBEDDING_CACHE_TTL)
+shared_embeddings = RedisCache("embeddings_redis", ttl=EMBEDDING_CACHE_REDIS_TTL)
+
+
+def embedding_cache_key(text):
+    """
+        Key of an embedding, the text is expected to be normalized the same way as before calling the embeddings API.
+    """
+    return hashlib.sha256(f"{EMBEDDING_MODEL}\0{text}".encode("utf-8")).hexdigest()
+
+
+def get_cached_embedding(text):
+    """
+        Looks up the embedding of the text in the in-process tier, then in the shared Redis tier.
+
+        Args:
+            text (str): The normalized text.
+
+        Returns:
+            list or None: The embedding, or None if it is not cached.
+    """
+    key = embedding_cache_key(text)
+    embedding = local_embeddings.get(key)
+    if embedding is not None:
+        return embedding
+
+    value = shared_embeddings.get(key)
+    if value is None:
+        return None
+    # Stored as doubles, so the cached embedding is identical to the one returned by the API
+    embedding = array('d', value).tolist()
+    local_embeddings.set(key, embedding)
+    return embedding
+
+
+def cache_embedding(text, embedding):
+    """
+        Stores the embedding of the normalized text in both tiers.
+    """
+    key = embedding_cache_key(text)
+    local_embeddings.set(key, embedding)
+    shared_embeddings.set(key, array('d', embedding).tobytes())
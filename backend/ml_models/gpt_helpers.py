@@ -1,8 +1,12 @@
 from openai import OpenAI
 from constants.credentials import OPENAI_API_KEY, OPENAI_ORGANIZATION
+import asyncio
 import re
 import tiktoken
-from constants.common import EMBEDDING_MODEL
+from constants.common import EMBEDDING_BATCH_TIMEOUT, EMBEDDING_BULK_MAX_INPUTS, EMBEDDING_MODEL
+from ml_models.embedding_batcher import EmbeddingBatcher
+from ml_models.embedding_cache import cache_embedding, get_cached_embedding
+from utils.tracing import set_span_attributes, span, traced
 
 tokenizer = None
 
@@ -49,11 +53,36 @@ def openai_prompt_to_gemini(openai_final_prompt):
     
     return gemini_final_prompt, history
 
+def normalize_text(text):
+    return re.sub(r'\s+', ' ', text)
+
+
+def embed_texts(texts):
+    """
+        Embeds a list of texts with a single call of the embeddings API.
+
+        Args:
+            texts (list): The normalized texts, at most 2048.
+
+        Returns:
+            list: The embeddings, in the order of texts.
+    """
+    with span("embeddings.create", {"inputs": len(texts)}):
+        embed_data = client.embeddings.create(input=texts, model=EMBEDDING_MODEL).data
+    return [record.embedding for record in sorted(embed_data, key=lambda record: record.index)]
+
+
+embedding_batcher = EmbeddingBatcher(embed_texts)
+
+
 # TODO: Surround with tru catch, look for fallback if openai is down
+@traced("create_embedding")
 def create_embedding(text):
     """
         This function takes a string of text, removes newline characters by replacing them with spaces,
         and then generates an embedding using the specified embedding model from OpenAI.
+        Embeddings are cached in process and in Redis, see ml_models/embedding_cache.py. Cache misses of
+        concurrent requests are sent together, see ml_models/embedding_batcher.py.
 
         Args:
             text (str): The input text to generate an embedding for.
@@ -61,18 +90,73 @@ def create_embedding(text):
         Returns:
             list: The embedding vector generated by the OpenAI API.
     """
-    text = re.sub(r'\s+', ' ',text)
-    return client.embeddings.create(input=text, model=EMBEDDING_MODEL).data[0].embedding
+    text = normalize_text(text)
+    embedding = get_cached_embedding(text)
+    set_span_attributes(embedding_cache_hit=embedding is not None)
+    if embedding is None:
+        future = embedding_batcher.submit(text)
+        try:
+            embedding = future.result(timeout=EMBEDDING_BATCH_TIMEOUT)
+        except TimeoutError:
+            # A batch not sent yet skips the text, result() alone leaves the future pending
+            future.cancel()
+            raise
+        cache_embedding(text, embedding)
+    return embedding
+
+
+@traced("create_embedding_async")
+async def create_embedding_async(text):
+    """
+        Async variant of create_embedding.
 
+        Args:
+            text (str): The input text to generate an embedding for.
 
-def create_embedding_for_list(text_list):
-    for _, i in enumerate(text_list):
-        text_list[i] = re.sub(r'\s+', ' ', text_list[i])
+        Returns:
+            list: The embedding vector generated by the OpenAI API.
+    """
+    text = normalize_text(text)
+    embedding = get_cached_embedding(text)
+    set_span_attributes(embedding_cache_hit=embedding is not None)
+    if embedding is None:
+        embedding = await asyncio.wait_for(asyncio.wrap_future(embedding_batcher.submit(text)),
+                                           EMBEDDING_BATCH_TIMEOUT)
+        cache_embedding(text, embedding)
+    return embedding
+
+
+def create_embeddings(texts, max_inputs=EMBEDDING_BULK_MAX_INPUTS):
+    """
+        Bulk variant of create_embedding, for ingestion and analytics: cached embeddings are reused and the other
+        texts are embedded max_inputs at a time, each distinct text once.
 
-    embed_data = client.embeddings.create(input=text_list, model=EMBEDDING_MODEL).data
-    return [record.embedding for record in embed_data]
+        Args:
+            texts (list): The input texts.
+            max_inputs (int, optional): Inputs per API call. Defaults to EMBEDDING_BULK_MAX_INPUTS.
+
+        Returns:
+            list: The embeddings, in the order of texts.
+    """
+    texts = [normalize_text(text) for text in texts]
+    embeddings = {}
+    for text in texts:
+        if text not in embeddings:
+            embeddings[text] = get_cached_embedding(text)
+    missing = [text for text, embedding in embeddings.items() if embedding is None]
+    for start in range(0, len(missing), max_inputs):
+        batch = missing[start:start + max_inputs]
+        for text, embedding in zip(batch, embed_texts(batch)):
+            embeddings[text] = embedding
+            cache_embedding(text, embedding)
+    return [embeddings[text] for text in texts]
 
 
+def create_embedding_for_list(text_list):
+    """
+        Embeddings of a list of texts, see create_embeddings.
+    """
+    return create_embeddings(text_list)
 
 
 def count_tokens_tiktoken(text):
@@ -0,0 +1,293 @@
+import asyncio
+import hashlib
+import re
+import threading
+import traceback
+from collections import OrderedDict
+
+import numpy as np
+
+from constants.model_related import (END_CONVERSATION, INTENT_EXAMPLES_MAX_PER_SCOPE, INTENT_EXAMPLES_MAX_SCOPES,
+                                     INTENT_KNN_MIN_AGREEING, INTENT_KNN_MIN_SIMILARITY, INTENT_KNN_NEIGHBOURS,
+                                     INTENT_REMEMBER_MIN_WORDS, INTENT_RULE_CONFIDENCE, INTENT_RULE_MAX_WORDS,
+                                     INTENT_SEED_EXAMPLES, SMALL_TALK, intent_map)
+from ml_models.development import ENDING_CONVERSATION_PATTERNS, SMALL_TALK_PATTERNS
+from ml_models.gpt_helpers import create_embedding, create_embedding_async, create_embeddings
+from utils.cache import caches
+from utils.helpers import log, start_background_thread
+
+# Only the patterns matching a whole phrase, "are you .+" would also match "are you open on sunday?"
+RULE_PATTERNS = [(re.compile(pattern), SMALL_TALK) for pattern in SMALL_TALK_PATTERNS if ".+" not in pattern] + \
+                [(re.compile(pattern), END_CONVERSATION) for pattern in ENDING_CONVERSATION_PATTERNS]
+# After a question from the AI, "ok" can be an answer rather than the end of the conversation
+AFTER_QUESTION_RULE_PATTERNS = [(pattern, intent) for pattern, intent in RULE_PATTERNS
+                                if pattern.pattern not in [r"\bok\b", r"\bokay\b"]]
+FILLER_WORDS = {"a", "again", "all", "and", "bro", "buddy", "dear", "for", "guys", "lot", "much", "now", "so", "sir",
+                "there", "very"}
+HISTORY_EXAMPLES = 10  # labelled messages of the conversation used as neighbours
+intent_ids = {name: intent for intent, name in intent_map.items()}
+
+
+class LabelledMessages:
+    """
+        In-process store of the embeddings of messages labelled by the intent model, grouped in scopes (host_url),
+        since whether a question is product related depends on the organization.
+
+        Args:
+            max_scopes (int): Maximum number of scopes, the least recently used scope is evicted first.
+            max_entries (int): Maximum number of messages per scope, the oldest message is evicted first.
+    """
+
+    def __init__(self, max_scopes, max_entries):
+        self.max_scopes = max_scopes
+        self.max_entries = max_entries
+        self._scopes = OrderedDict()
+        self._matrices = {}
+        self._lock = threading.Lock()
+        caches["intent_examples"] = self
+
+    def add(self, scope, text, embedding, intent):
+        key = hashlib.sha256(text.encode()).hexdigest()
+        with self._lock:
+            entries = self._scopes.setdefault(scope, OrderedDict())
+            self._scopes.move_to_end(scope)
+            entries[key] = (normalize(embedding), intent)
+            entries.move_to_end(key)
+            while len(entries) > self.max_entries:
+                entries.popitem(last=False)
+            self._matrices.pop(scope, None)
+            while len(self._scopes) > self.max_scopes:
+                evicted, _ = self._scopes.popitem(last=False)
+                self._matrices.pop(evicted, None)
+
+    def get(self, scope):
+        """
+            Returns the vectors (one row per message) and intents of a scope, or None if the scope is empty.
+        """
+        with self._lock:
+            entries = self._scopes.get(scope)
+            if not entries:
+                return None
+            self._scopes.move_to_end(scope)
+            if scope not in self._matrices:
+                self._matrices[scope] = (np.stack([vector for vector, _ in entries.values()]),
+                                         [intent for _, intent in entries.values()])
+            return self._matrices[scope]
+
+    def clear(self):
+        with self._lock:
+            self._scopes.clear()
+            self._matrices.clear()
+
+    def stats(self):
+        return {
+            "scopes": len(self._scopes),
+            "size": sum(len(entries) for entries in self._scopes.values()),
+        }
+
+
+def normalize(embedding):
+    vector = np.asarray(embedding, dtype=np.float32)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm > 0 else vector
+
+
+labelled_messages = LabelledMessages(INTENT_EXAMPLES_MAX_SCOPES, INTENT_EXAMPLES_MAX_PER_SCOPE)
+seed_examples = None
+seed_lock = threading.Lock()
+
+
+def warm_seed_examples():
+    """
+        Embeds INTENT_SEED_EXAMPLES, to be called when a worker starts so that no request waits for them.
+    """
+    global seed_examples
+    # Another thread is already embedding them
+    if not seed_lock.acquire(blocking=False):
+        return
+    try:
+        if seed_examples is None:
+            seed_examples = (np.stack([normalize(vector) for vector in
+                                       create_embeddings([text for text, _ in INTENT_SEED_EXAMPLES])]),
+                             [intent for _, intent in INTENT_SEED_EXAMPLES])
+            log(f"Embedded {len(INTENT_SEED_EXAMPLES)} intent seed examples")
+    except Exception as e:
+        log("Error in warm_seed_examples", traceback.format_exc())
+    finally:
+        seed_lock.release()
+
+
+def get_seed_examples():
+    """
+        Returns the seed examples embedded by warm_seed_examples. Until then (or if it failed) they are embedded in
+        the background and the prediction does without them.
+
+        Returns:
+            tuple or None: The vectors (one row per example) and intents of the seed examples.
+    """
+    if seed_examples is None:
+        start_background_thread(warm_seed_examples)
+    return seed_examples
+
+
+def get_last_user_message(messages):
+    user_messages = [message for message in messages if message.get("sender") == "USER"]
+    return user_messages[-1].get("message", "") if user_messages else None
+
+
+def ai_asked_question(messages):
+    """
+        Whether the message before the last message is a question from the AI.
+    """
+    return len(messages) > 1 and messages[-2].get("sender") == "AI" and \
+        messages[-2].get("message", "").rstrip().endswith("?")
+
+
+def get_history_examples(messages):
+    """
+        Returns the user messages of the conversation that carry an intent, as (text, intent) pairs.
+    """
+    examples = [(message.get("message", ""), intent_ids[message["intent"]]) for message in messages[:-1]
+                if message.get("sender") == "USER" and message.get("intent") in intent_ids]
+    return examples[-HISTORY_EXAMPLES:]
+
+
+def classify_with_rules(text, after_question=False):
+    """
+        Keyword rules of refine_intent_estimator, only trusted for short messages made of greetings or closings.
+
+        Args:
+            text (str): The message of the user.
+            after_question (bool, optional): Whether the AI asked a question just before. Defaults to False.
+
+        Returns:
+            dict or None: The prediction ('intent', 'confidence', 'method'), or None if the rules do not apply.
+    """
+    if len(text.split()) > INTENT_RULE_MAX_WORDS:
+        return None
+    residual = text.lower().replace("’", "'")
+    matched = set()
+    for pattern, intent in (AFTER_QUESTION_RULE_PATTERNS if after_question else RULE_PATTERNS):
+        residual, count = pattern.subn(" ", residual)
+        if count:
+            matched.add(intent)
+    if len(matched) != 1 or any(word not in FILLER_WORDS for word in re.findall(r"[a-z']+", residual)):
+        return None
+    return {"intent": matched.pop(), "confidence": INTENT_RULE_CONFIDENCE, "method": "rules"}
+
+
+def classify_with_neighbours(embedding, examples):
+    """
+        Similarity weighted vote of the nearest labelled messages. The share of the votes is scaled down when fewer
+        than INTENT_KNN_MIN_AGREEING neighbours agree, a single similar message is not enough to skip the intent model.
+
+        Args:
+            embedding (list): Embedding of the message of the user.
+            examples (list): (vectors, intents) tuples of labelled messages.
+
+        Returns:
+            dict or None: The prediction ('intent', 'confidence', 'method', 'neighbours', 'similarity'), or None if
+            no labelled message is similar enough.
+    """
+    examples = [example for example in examples if example is not None]
+    if not examples:
+        return None
+    vectors = np.concatenate([vectors for vectors, _ in examples])
+    intents = [intent for _, example_intents in examples for intent in example_intents]
+    similarities = vectors @ normalize(embedding)
+    votes = {}
+    counts = {}
+    for index in np.argsort(-similarities)[:INTENT_KNN_NEIGHBOURS]:
+        if similarities[index] < INTENT_KNN_MIN_SIMILARITY:
+            break
+        votes[intents[index]] = votes.get(intents[index], 0) + float(similarities[index])
+        counts[intents[index]] = counts.get(intents[index], 0) + 1
+    if not votes:
+        return None
+    intent = max(votes, key=votes.get)
+    confidence = votes[intent] / sum(votes.values()) * min(1, counts[intent] / INTENT_KNN_MIN_AGREEING)
+    return {"intent": intent, "confidence": confidence, "method": "neighbours", "neighbours": counts[intent],
+            "similarity": float(similarities.max())}
+
+
+def predict_intent(messages, scope=None):
+    """
+        Predicts the intent of the last user message without calling the intent model: keyword rules first,
+        then the nearest labelled messages (seed examples, messages labelled by the intent model for this scope
+        and the labelled messages of the conversation).
+
+        Args:
+            messages (list): The messages of the conversation.
+            scope (str, optional): The scope of the labelled messages, the host_url. Defaults to None.
+
+        Returns:
+            tuple: The prediction (None if no local prediction could be made) and the embedding of the last
+            user message (None if it was not needed), to be passed to remember_intent.
+    """
+    try:
+        text = get_last_user_message(messages)
+        if not text:
+            return None, None
+        prediction = classify_with_rules(text, ai_asked_question(messages))
+        if prediction is not None:
+            return prediction, None
+
+        # The message goes through the embedding batcher with the other requests, only the history in bulk
+        embedding = create_embedding(text)
+        history = get_history_examples(messages)
+        history_vectors = create_embeddings([example for example, _ in history]) if history else []
+        history_examples = (np.stack([normalize(vector) for vector in history_vectors]),
+                            [intent for _, intent in history]) if history else None
+        return classify_with_neighbours(
+            embedding, [get_seed_examples(), labelled_messages.get(scope), history_examples]), embedding
+    except Exception as e:
+        log("Error in predict_intent", traceback.format_exc())
+        return None, None
+
+
+async def predict_intent_async(messages, scope=None):
+    """
+        Async variant of predict_intent, takes the same arguments and returns the same values.
+    """
+    try:
+        text = get_last_user_message(messages)
+        if not text:
+            return None, None
+        prediction = classify_with_rules(text, ai_asked_question(messages))
+        if prediction is not None:
+            return prediction, None
+
+        history = get_history_examples(messages)
+        if history:
+            embedding, history_vectors = await asyncio.gather(
+                create_embedding_async(text),
+                asyncio.to_thread(create_embeddings, [example for example, _ in history]))
+        else:
+            embedding, history_vectors = await create_embedding_async(text), []
+        history_examples = (np.stack([normalize(vector) for vector in history_vectors]),
+                            [intent for _, intent in history]) if history else None
+        return classify_with_neighbours(
+            embedding, [get_seed_examples(), labelled_messages.get(scope), history_examples]), embedding
+    except Exception as e:
+        log("Error in predict_intent_async", traceback.format_exc())
+        return None, None
+
+
+def remember_intent(scope, messages, embedding, intent):
+    """
+        Stores the intent predicted by the intent model for the last user message, so that similar messages
+        of the same scope are classified locally. Answers to a question of the AI and messages shorter than
+        INTENT_REMEMBER_MIN_WORDS words take their meaning from the conversation, they are not stored.
+
+        Args:
+            scope (str): The scope of the labelled messages, the host_url.
+            messages (list): The messages of the conversation.
+            embedding (list): Embedding of the last user message, as returned by predict_intent.
+            intent (int): The intent predicted by the intent model.
+    """
+    if embedding is None or intent not in intent_map:
+        return
+    text = get_last_user_message(messages)
+    if ai_asked_question(messages) or len(text.split()) < INTENT_REMEMBER_MIN_WORDS:
+        return
+    labelled_messages.add(scope, text, embedding, intent)
@@ -5,10 +5,11 @@ from openai import OpenAI
 import constants.credentials as creds
 client = OpenAI(api_key=creds.OPENAI_API_KEY,
                 organization=creds.OPENAI_ORGANIZATION)
-import requests
 from scipy.spatial.distance import cosine
 
 import settings
+from apis_dir.functions import post
+from apis_dir.urls import endpoint_generate_next_questions
 from ml_models.common import chat_w_model
 from ml_models.gpt_helpers import create_embedding
 from utils.helpers import log
@@ -86,7 +87,7 @@ def generate_next_questions(prev_conversation, current_message, relevant_section
       else:
           conversation = prev_conversation + f"\nAI: {current_message}"
       context = "\n".join([section['text'] for section in relevant_sections])
-      resp = requests.post(f"{settings.BACKGROUND_FLASK_ENDPOINT}/generate_next_questions", data={
+      resp = post(endpoint_generate_next_questions, form={
                       "message_id": message_id,
                       "context": context,
                       "conversation": conversation                                             
@@ -4,23 +4,40 @@ import traceback
 from openai import OpenAI
 
 import constants.credentials as creds
-from constants.model_related import (INTENT_ESTIMATOR_PROMPT as PROMPT, intent_map, NON_PRODUCT_RELATED_QUERY)
+from constants.model_related import (INTENT_CONFIDENCE_THRESHOLD, INTENT_ESTIMATOR_PROMPT as PROMPT, intent_map,
+                                     NON_PRODUCT_RELATED_QUERY)
 from utils.helpers import add_message_source_to_g
 
 client = OpenAI(api_key=creds.OPENAI_API_KEY,
                 organization=creds.OPENAI_ORGANIZATION)
 
 try:
-    from ml_models.common import chat_w_model
+    from ml_models.common import chat_w_model, chat_w_model_async, chat_w_model_stream
 except ImportError:
     pass
-from pinecone_related.query_pinecone import fetch_prompt_context
-from extras.citations import get_response_with_citations
-from utils.helpers import (convert_to_int, generate_final_prompt, log)
-from constants.sources import GPT_RESPONSE, STANDALONE_QUESTION
+from pinecone_related.query_pinecone import fetch_prompt_context, fetch_prompt_context_async
+from extras.citations import (get_response_with_citations, get_response_with_citations_async,
+                              stream_response_with_citations)
+from utils.helpers import (convert_to_int, generate_final_prompt, log, split_sentences)
+from utils.tracing import set_span_attributes, traced
+from ml_models.answer_cache import answer_cache_scope, cache_answer, get_cached_answer
+from ml_models.gpt_helpers import create_embedding, create_embedding_async
+from ml_models.intent_classifier import predict_intent, predict_intent_async, remember_intent
+from constants.sources import GPT_RESPONSE, INTENT_PREDICTION, STANDALONE_QUESTION
 from constants.common import INTENT_PREDICTION_MODEL
 
+INTENT_MODEL_PARAMS = {
+    "temperature": 0.1,
+    "max_tokens": 60,
+    "frequency_penalty": 0,
+    "presence_penalty": 0,
+    "stop": ["\n"],
+    "model": INTENT_PREDICTION_MODEL,
+}
+SMALL_TALK_INSTRUCTION = "\nONLY MAKE SMALL TALK to continue the conversation. Avoid mentioning specific details like address, phone number, cost, etc."
 
+
+@traced("make_standalone_question")
 def make_standalone_question(querylist, current_message):
     """
         Reformulates a follow-up message in a chat into a standalone message with enough context on its own.
@@ -36,10 +53,24 @@ def make_standalone_question(querylist, current_message):
         Returns:
         str: The reformulated standalone message or the original follow-up message if reformulation fails.
     """
+    response = chat_w_model(build_standalone_question_prompt(querylist, current_message), 0.2, is_json=True)
+    return parse_standalone_question(response, current_message)
+
+
+@traced("make_standalone_question_async")
+async def make_standalone_question_async(querylist, current_message):
+    """
+        Async variant of make_standalone_question, takes the same arguments.
+    """
+    response = await chat_w_model_async(build_standalone_question_prompt(querylist, current_message), 0.2, is_json=True)
+    return parse_standalone_question(response, current_message)
+
+
+def build_standalone_question_prompt(querylist, current_message):
     chat_history = "\n".join(
         querylist[:-1]) if len(querylist) > 1 else "No chat history available"
 
-    final_prompt = [{
+    return [{
         "role": "user",
         "content": f"""Given the following conversation between a user and a sales assistant and a follow up message, rephrase the follow up message sent by the user as a standalone message that carries enough context on its own.
         Conversation History Begin
@@ -54,7 +85,9 @@ def make_standalone_question(querylist, current_message):
         3) Correct any spelling errors while processing text.
     """
     }]
-    response = chat_w_model(final_prompt, 0.2, is_json=True)
+
+
+def parse_standalone_question(response, current_message):
     try:
         loaded_response = json.loads(response)
         add_message_source_to_g(STANDALONE_QUESTION, loaded_response)
@@ -71,14 +104,21 @@ def make_standalone_question(querylist, current_message):
         return current_message
 
 
-def estimate_intent(conversation, org_description=None):
+@traced("estimate_intent")
+def estimate_intent(conversation, org_description=None, messages=None, scope=None):
     """
         Attempts to find out what the user wishes to achieve by the conversation or user's intent.
+        The intent is predicted locally first (see ml_models/intent_classifier.py), the intent model is only
+        called when the local prediction is missing or below INTENT_CONFIDENCE_THRESHOLD.
 
         Args:
             query (list of str): List of formatted messages representing conversation between user and the system.
 
             org_description (str, optional): Description of the organization that the user is currently talking to.
+
+            messages (list, optional): The messages of the conversation, needed for the local prediction.
+
+            scope (str, optional): Scope of the messages labelled by the intent model, the host_url.
         
         Returns:
             int: An integer representing the estimated intent of the user query. The possible values and their meanings are:
@@ -90,38 +130,83 @@ def estimate_intent(conversation, org_description=None):
             - 5: End Conversation
     """
     try:
-        if org_description is not None:
-            org_prompt = "Here are the details of the organization that user is currently talking to: \"\"\"" + org_description + ".\"\"\"\nUse this information and user's conversation to decide.\n"
-        else:
-            org_prompt = ""
-        final_prompt = [{
-            "role": "system",
-            "content": org_prompt + PROMPT
-        },
-            {
-                "role": "user",
-                "content": f"conversation starts here\n\"\"\"{conversation}\"\"\"\nconversation ends here\n"
-            }]
-        
+        prediction, embedding = predict_intent(messages, scope) if messages else (None, None)
+        if is_confident(prediction):
+            return prediction["intent"]
+
         response = chat_w_model(
-            final_prompt=final_prompt,
-            temperature=0.1,
-            max_tokens=60,
-            frequency_penalty=0,
-            presence_penalty=0,
-            stop=["\n"],
-            model=INTENT_PREDICTION_MODEL
+            final_prompt=build_intent_prompt(conversation, org_description),
+            **INTENT_MODEL_PARAMS
             )
 
         output = convert_to_int(
             response)
         log(f"ESTIMATING INTENT OF USER: {intent_map[output]}")
+        add_message_source_to_g(INTENT_PREDICTION, {"intent": output, "method": "model", "local": prediction})
+        set_span_attributes(intent=intent_map[output], intent_method="model")
+        remember_intent(scope, messages, embedding, output)
         return output
     except Exception as e:
         log("Error in estimating intent", traceback.format_exc())
         return NON_PRODUCT_RELATED_QUERY
 
 
+@traced("estimate_intent_async")
+async def estimate_intent_async(conversation, org_description=None, messages=None, scope=None):
+    """
+        Async variant of estimate_intent, takes the same arguments.
+    """
+    try:
+        prediction, embedding = await predict_intent_async(messages, scope) if messages else (None, None)
+        if is_confident(prediction):
+            return prediction["intent"]
+
+        response = await chat_w_model_async(
+            final_prompt=build_intent_prompt(conversation, org_description),
+            **INTENT_MODEL_PARAMS
+            )
+
+        output = convert_to_int(
+            response)
+        log(f"ESTIMATING INTENT OF USER: {intent_map[output]}")
+        add_message_source_to_g(INTENT_PREDICTION, {"intent": output, "method": "model", "local": prediction})
+        set_span_attributes(intent=intent_map[output], intent_method="model")
+        remember_intent(scope, messages, embedding, output)
+        return output
+    except Exception as e:
+        log("Error in estimating intent", traceback.format_exc())
+        return NON_PRODUCT_RELATED_QUERY
+
+
+def is_confident(prediction):
+    """
+        Whether a local intent prediction is trusted without calling the intent model, logs it if so.
+    """
+    if prediction is None or prediction["confidence"] < INTENT_CONFIDENCE_THRESHOLD:
+        return False
+    log(f"ESTIMATING INTENT OF USER LOCALLY ({prediction['method']}): {intent_map[prediction['intent']]}")
+    add_message_source_to_g(INTENT_PREDICTION, prediction)
+    set_span_attributes(intent=intent_map[prediction["intent"]], intent_method=prediction["method"],
+                        intent_confidence=prediction["confidence"])
+    return True
+
+
+def build_intent_prompt(conversation, org_description=None):
+    if org_description is not None:
+        org_prompt = "Here are the details of the organization that user is currently talking to: \"\"\"" + org_description + ".\"\"\"\nUse this information and user's conversation to decide.\n"
+    else:
+        org_prompt = ""
+    return [{
+        "role": "system",
+        "content": org_prompt + PROMPT
+    },
+        {
+            "role": "user",
+            "content": f"conversation starts here\n\"\"\"{conversation}\"\"\"\nconversation ends here\n"
+        }]
+
+
+@traced("answer_query_generic")
 def answer_query_generic(messages, prompt=""):
     """
         Generates a generic response to continue the conversation based on the given messages and prompt.
@@ -139,13 +224,58 @@ def answer_query_generic(messages, prompt=""):
             str: The generated response for the given messages and prompt, or None if an error occurs.
     """
     try:
-        prompt += "\nONLY MAKE SMALL TALK to continue the conversation. Avoid mentioning specific details like address, phone number, cost, etc."
-        final_prompt = generate_final_prompt(messages, prompt)
+        final_prompt = generate_final_prompt(messages, prompt + SMALL_TALK_INSTRUCTION)
         return chat_w_model(final_prompt)
     except Exception as e:
         log("Error in answer_query_generic", traceback.format_exc())
         return None
 
+
+@traced("answer_query_generic_async")
+async def answer_query_generic_async(messages, prompt="", small_talk=True):
+    """
+        Async variant of answer_query_generic and answer_query_generic_ncert.
+
+        Args:
+            messages (list): A list of messages representing the conversation history.
+            prompt (str, optional): An optional prompt to guide the response generation. Defaults to an empty string.
+            small_talk (bool, optional): Whether to restrict the response to small talk. Defaults to True.
+
+        Returns:
+            str: The generated response for the given messages and prompt, or None if an error occurs.
+    """
+    try:
+        if small_talk:
+            prompt += SMALL_TALK_INSTRUCTION
+        final_prompt = generate_final_prompt(messages, prompt)
+        return await chat_w_model_async(final_prompt)
+    except Exception as e:
+        log("Error in answer_query_generic_async", traceback.format_exc())
+        return None
+
+
+@traced("answer_query_generic_stream")
+def answer_query_generic_stream(messages, prompt="", small_talk=True):
+    """
+        Streaming variant of answer_query_generic and answer_query_generic_ncert.
+
+        Args:
+            messages (list): A list of messages representing the conversation history.
+            prompt (str, optional): An optional prompt to guide the response generation. Defaults to an empty string.
+            small_talk (bool, optional): Whether to restrict the response to small talk. Defaults to True.
+
+        Yields:
+            str: Text tokens of the generated response.
+    """
+    try:
+        if small_talk:
+            prompt += SMALL_TALK_INSTRUCTION
+        final_prompt = generate_final_prompt(messages, prompt)
+        yield from chat_w_model_stream(final_prompt)
+    except Exception as e:
+        log("Error in answer_query_generic_stream", traceback.format_exc())
+
+@traced("answer_query_generic_ncert")
 def answer_query_generic_ncert(messages, prompt=""):
     try:
         final_prompt = generate_final_prompt(messages, prompt)
@@ -156,6 +286,7 @@ def answer_query_generic_ncert(messages, prompt=""):
 
 
 # Answer with RAG
+@traced("answer_query_with_context")
 def answer_query_with_context(messages: list,
                               conversation: str,
                               standalone_question: str,
@@ -167,7 +298,8 @@ def answer_query_with_context(messages: list,
                               sender_city=None,
                               sender_country=None,
                               unsure_msg="I don't know",
-                              buckets: list = []
+                              buckets: list = [],
+                              query_embedding=None
                               ):
     """
         This function processes a standalone question by querying a Pinecone index to find relevant document sections.
@@ -187,6 +319,7 @@ def answer_query_with_context(messages: list,
             sender_country (str, optional): The country of the sender, to be included in the prompt. Default is None.
             unsure_msg (str, optional): A fallback message if no relevant context is found. Default is "I don't know".
             buckets (list, optional): A list of buckets to filter results by bucket ID and sort by bucket priority. Default is an empty list.
+            query_embedding (list, optional): The embedding of the standalone question, if it was already computed. Default is None.
 
         Returns:
             tuple: A tuple containing:
@@ -196,15 +329,22 @@ def answer_query_with_context(messages: list,
                 - list: A list of the relevant document sections and their metadata.
     """
     try:
+        if sender_city is not None and sender_country is not None:
+            prompt += f"\n\nSender City: {sender_city}\nSender Country: {sender_country}"
+        if query_embedding is None:
+            query_embedding = create_embedding(standalone_question)
+        cache_scope = answer_cache_scope(pinecone_index, namespace, prompt, buckets)
+        cached = get_cached_answer(cache_scope, query_embedding)
+        if cached is not None:
+            return cached["response"], cached["relevant_sections"], cached["action_id"]
+
         if buckets and len(buckets) > 0:
             log(f"---initial_bucket_details: {buckets}")
             buckets = get_relevant_buckets(standalone_question, buckets)
             log(f"---selected_buckets: {buckets}")
         relevant_sections = fetch_prompt_context(
             standalone_question, pinecone_index, namespace,
-            host_url, filters, unsure_msg, buckets)
-        if sender_city is not None and sender_country is not None:
-            prompt += f"\n\nSender City: {sender_city}\nSender Country: {sender_country}"
+            host_url, filters, unsure_msg, buckets, query_embedding)
         try:
             refined_gpt_response, action_id = get_response_with_citations(
                 prompt, standalone_question, messages,
@@ -217,12 +357,136 @@ def answer_query_with_context(messages: list,
                 prompt, standalone_question, messages,
                 conversation, relevant_sections, unsure_msg
             )
+        if refined_gpt_response and refined_gpt_response != unsure_msg:
+            cache_answer(cache_scope, query_embedding, refined_gpt_response, relevant_sections, action_id)
+        return refined_gpt_response, relevant_sections, action_id
+    except Exception as e:
+        log(f"Error in answering query with context", traceback.format_exc())
+        return None, None, None
+
+
+@traced("answer_query_with_context_async")
+async def answer_query_with_context_async(messages: list,
+                                          conversation: str,
+                                          standalone_question: str,
+                                          pinecone_index: str,
+                                          filters: dict,
+                                          host_url: str,
+                                          prompt: str,
+                                          namespace: str,
+                                          sender_city=None,
+                                          sender_country=None,
+                                          unsure_msg="I don't know",
+                                          buckets: list = [],
+                                          query_embedding=None
+                                          ):
+    """
+        Async variant of answer_query_with_context, takes the same arguments and returns the same values.
+    """
+    try:
+        if sender_city is not None and sender_country is not None:
+            prompt += f"\n\nSender City: {sender_city}\nSender Country: {sender_country}"
+        if query_embedding is None:
+            query_embedding = await create_embedding_async(standalone_question)
+        cache_scope = answer_cache_scope(pinecone_index, namespace, prompt, buckets)
+        cached = get_cached_answer(cache_scope, query_embedding)
+        if cached is not None:
+            return cached["response"], cached["relevant_sections"], cached["action_id"]
+
+        if buckets and len(buckets) > 0:
+            log(f"---initial_bucket_details: {buckets}")
+            buckets = get_relevant_buckets(standalone_question, buckets)
+            log(f"---selected_buckets: {buckets}")
+        relevant_sections = await fetch_prompt_context_async(
+            standalone_question, pinecone_index, namespace,
+            host_url, filters, unsure_msg, buckets, query_embedding)
+        try:
+            refined_gpt_response, action_id = await get_response_with_citations_async(
+                prompt, standalone_question, messages,
+                conversation, relevant_sections, unsure_msg
+            )
+        except Exception as e:
+            log(f"Error in getting response from GPT-3", traceback.format_exc())
+            refined_gpt_response, action_id = await get_response_with_citations_async(
+                prompt, standalone_question, messages,
+                conversation, relevant_sections, unsure_msg
+            )
+        if refined_gpt_response and refined_gpt_response != unsure_msg:
+            cache_answer(cache_scope, query_embedding, refined_gpt_response, relevant_sections, action_id)
         return refined_gpt_response, relevant_sections, action_id
     except Exception as e:
         log(f"Error in answering query with context", traceback.format_exc())
         return None, None, None
 
 
+@traced("answer_query_with_context_stream")
+def answer_query_with_context_stream(messages: list,
+                                     conversation: str,
+                                     standalone_question: str,
+                                     pinecone_index: str,
+                                     filters: dict,
+                                     host_url: str,
+                                     prompt: str,
+                                     namespace: str,
+                                     sender_city=None,
+                                     sender_country=None,
+                                     unsure_msg="I don't know",
+                                     buckets: list = [],
+                                     query_embedding=None
+                                     ):
+    """
+        Streaming variant of answer_query_with_context, takes the same arguments.
+
+        Yields:
+            str: Sentences of the response as soon as they are generated.
+
+        Returns:
+            tuple: A tuple containing:
+                - list: A list of the relevant document sections and their metadata.
+                - int or None: The action ID.
+    """
+    if sender_city is not None and sender_country is not None:
+        prompt += f"\n\nSender City: {sender_city}\nSender Country: {sender_country}"
+    if query_embedding is None:
+        query_embedding = create_embedding(standalone_question)
+    cache_scope = answer_cache_scope(pinecone_index, namespace, prompt, buckets)
+    cached = get_cached_answer(cache_scope, query_embedding)
+    if cached is not None:
+        yield from split_sentences(cached["response"])
+        return cached["relevant_sections"], cached["action_id"]
+
+    if buckets and len(buckets) > 0:
+        log(f"---initial_bucket_details: {buckets}")
+        buckets = get_relevant_buckets(standalone_question, buckets)
+        log(f"---selected_buckets: {buckets}")
+    relevant_sections = fetch_prompt_context(
+        standalone_question, pinecone_index, namespace,
+        host_url, filters, unsure_msg, buckets, query_embedding)
+    response_sentences = []
+    action_id = yield from collect_sentences(stream_response_with_citations(
+        prompt, standalone_question, messages,
+        conversation, relevant_sections, unsure_msg
+    ), response_sentences)
+    response = " ".join(response_sentences)
+    if response and response != unsure_msg:
+        cache_answer(cache_scope, query_embedding, response, relevant_sections, action_id)
+    return relevant_sections, action_id
+
+
+def collect_sentences(sentences, collected):
+    """
+        Yields the sentences of a generator and appends them to collected, returns the generator's return value.
+    """
+    iterator = iter(sentences)
+    while True:
+        try:
+            sentence = next(iterator)
+        except StopIteration as stop:
+            return stop.value
+        collected.append(sentence.strip())
+        yield sentence
+
+
 def normalize_json_response(response):
     """
          This function takes a JSON response string, parses it into a Python dictionary, 
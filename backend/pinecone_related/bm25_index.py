@@ -0,0 +1,138 @@
+import re
+
+import numpy as np
+
+from constants.misc import BM25_B, BM25_K1, BM25_RARE_TERM_IDF
+
+# Words, numbers, prices and codes ("ab-123", "1,000", "3.5", "24/7") are kept whole
+TOKEN_PATTERN = re.compile(r"\w+(?:[.,\-/]\w+)*")
+PART_PATTERN = re.compile(r"[.,\-/]")
+STOP_WORDS = {"a", "about", "an", "and", "are", "as", "at", "be", "by", "can", "do", "does", "for", "from", "have",
+              "how", "i", "if", "in", "is", "it", "me", "my", "of", "on", "or", "our", "so", "that", "the", "their",
+              "there", "this", "to", "was", "we", "what", "when", "where", "which", "who", "why", "will", "with",
+              "you", "your"}
+
+
+def tokenize(text):
+    """
+        Lowercased terms of a text without stop words. Compound terms also yield their parts,
+        so that "AB-123" matches "AB 123".
+    """
+    terms = []
+    for token in TOKEN_PATTERN.findall((text or "").lower()):
+        # Single letters are mostly left from contractions ("what's")
+        if token in STOP_WORDS or (len(token) == 1 and token.isalpha()):
+            continue
+        terms.append(token)
+        parts = PART_PATTERN.split(token)
+        if len(parts) > 1:
+            terms.extend(part for part in parts if part and part not in STOP_WORDS)
+    return terms
+
+
+class BM25Index:
+    """
+        Okapi BM25 inverted index over the texts of a namespace, with the postings of every term in NumPy arrays:
+        the rows and frequencies of term number i are rows[offsets[i]:offsets[i + 1]] and
+        frequencies[offsets[i]:offsets[i + 1]]. Built with from_texts, stored with save and read back with load.
+
+        Args:
+            terms (list): The terms, in the order of their postings.
+            offsets (np.ndarray): Start of the postings of every term, and the end of the last one.
+            rows (np.ndarray): The rows of the postings.
+            frequencies (np.ndarray): The frequency of the term in every row of the postings.
+            lengths (np.ndarray): The number of terms of every row of the namespace.
+    """
+
+    def __init__(self, terms, offsets, rows, frequencies, lengths):
+        self.terms = {term: number for number, term in enumerate(terms)}
+        self.offsets = offsets
+        self.rows = rows
+        self.frequencies = frequencies
+        self.lengths = lengths
+        self.size = len(lengths)
+        average_length = float(lengths.mean()) if self.size and lengths.mean() > 0 else 1
+        # Length normalization of every row, k1 * (1 - b + b * length / average length)
+        self.normalization = BM25_K1 * (1 - BM25_B + BM25_B * lengths / average_length)
+        counts = np.diff(offsets)
+        self.idf = np.log(1 + (self.size - counts + 0.5) / (counts + 0.5)).tolist()
+
+    @classmethod
+    def from_texts(cls, texts):
+        """
+            Builds the index of the texts, the text of every row of the namespace.
+        """
+        postings = {}
+        lengths = np.zeros(len(texts), dtype=np.float32)
+        for row, text in enumerate(texts):
+            terms = tokenize(text)
+            lengths[row] = len(terms)
+            frequencies = {}
+            for term in terms:
+                frequencies[term] = frequencies.get(term, 0) + 1
+            for term, frequency in frequencies.items():
+                postings.setdefault(term, ([], []))
+                postings[term][0].append(row)
+                postings[term][1].append(frequency)
+
+        terms = sorted(postings)
+        offsets = np.zeros(len(terms) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(postings[term][0]) for term in terms])
+        rows = np.fromiter((row for term in terms for row in postings[term][0]), dtype=np.int32, count=offsets[-1])
+        frequencies = np.fromiter((frequency for term in terms for frequency in postings[term][1]),
+                                  dtype=np.float32, count=offsets[-1])
+        return cls(terms, offsets, rows, frequencies, lengths)
+
+    @classmethod
+    def load(cls, path):
+        """
+            Reads an index written by save.
+        """
+        with np.load(path) as arrays:
+            terms = str(arrays["terms"])
+            return cls(terms.split("\n") if terms else [], arrays["offsets"], arrays["rows"], arrays["frequencies"],
+                       arrays["lengths"])
+
+    def save(self, path):
+        """
+            Writes the index to a .npz file. Terms never contain a newline, they are stored as one string.
+        """
+        np.savez(path, terms=np.array("\n".join(self.terms)), offsets=self.offsets, rows=self.rows,
+                 frequencies=self.frequencies, lengths=self.lengths)
+
+    def query(self, text, top_k, mask=None):
+        """
+            Best rows for a query.
+
+            Args:
+                text (str): The query.
+                top_k (int): Maximum number of rows returned.
+                mask (np.ndarray, optional): Boolean mask of the rows that may be returned. Defaults to None.
+
+            Returns:
+                list: (row, score, relative score) tuples sorted by score. The relative score is the score divided by
+                the sum of the idf of the query terms found in the namespace, around 1 for a row of average length
+                containing each of them once, and 0 for a row without any rare term (idf of at least BM25_RARE_TERM_IDF),
+                since common words alone do not make an exact match.
+        """
+        terms = [self.terms[term] for term in dict.fromkeys(tokenize(text)) if term in self.terms]
+        if not terms or self.size == 0:
+            return []
+        scores = np.zeros(self.size, dtype=np.float32)
+        rare = np.zeros(self.size, dtype=bool)
+        for term in terms:
+            rows = self.rows[self.offsets[term]:self.offsets[term + 1]]
+            frequencies = self.frequencies[self.offsets[term]:self.offsets[term + 1]]
+            scores[rows] += self.idf[term] * frequencies * (BM25_K1 + 1) / (frequencies + self.normalization[rows])
+            if self.idf[term] >= BM25_RARE_TERM_IDF:
+                rare[rows] = True
+        if mask is not None:
+            scores[~mask] = 0
+        matched = np.flatnonzero(scores)
+        if len(matched) == 0:
+            return []
+        top_k = min(top_k, len(matched))
+        best = matched[np.argpartition(-scores[matched], top_k - 1)[:top_k]]
+        best = best[np.argsort(-scores[best], kind="stable")]
+        total_idf = sum(self.idf[term] for term in terms)
+        return [(int(row), float(scores[row]), float(scores[row]) / total_idf if rare[row] else 0.0) for row in best]
@@ -0,0 +1,129 @@
+import zlib
+
+import numpy as np
+
+from constants.misc import (CONTEXT_BUCKET_DECAY, CONTEXT_DIVERSITY_PENALTY, CONTEXT_DUPLICATE_SIMILARITY,
+                            CONTEXT_HASH_DIMENSION)
+from pinecone_related.bm25_index import tokenize
+
+CHOSEN = "chosen"
+NEAR_DUPLICATE = "near_duplicate"
+OVER_BUDGET = "over_budget"
+TOO_LONG = "too_long"
+
+
+def text_vectors(texts):
+    """
+        Normalized hashed vectors of the terms and term pairs of texts, so that sections can be compared without
+        their embeddings (Pinecone is queried without values).
+
+        Returns:
+            np.ndarray: One row per text.
+    """
+    vectors = np.zeros((len(texts), CONTEXT_HASH_DIMENSION), dtype=np.float32)
+    for row, text in enumerate(texts):
+        terms = tokenize(text)
+        features = terms + [f"{first} {second}" for first, second in zip(terms, terms[1:])]
+        if features:
+            columns = [zlib.crc32(feature.encode()) % CONTEXT_HASH_DIMENSION for feature in features]
+            np.add.at(vectors[row], columns, 1)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return vectors / norms
+
+
+def bucket_weights(sections, buckets):
+    """
+        Relevance factor of every section, CONTEXT_BUCKET_DECAY per priority level of its bucket below the first.
+    """
+    if not buckets or not isinstance(buckets, list):
+        return np.ones(len(sections), dtype=np.float32)
+    priorities = {int(bucket['id']): bucket.get('priority', 1) for bucket in buckets if 'id' in bucket}
+    levels = {priority: level for level, priority in enumerate(sorted(set(priorities.values())))}
+    weights = []
+    for section in sections:
+        try:
+            level = levels[priorities[int(section.get("metadata", {}).get("bucket_id"))]]
+        except (KeyError, TypeError, ValueError):
+            level = len(levels)
+        weights.append(CONTEXT_BUCKET_DECAY ** level)
+    return np.asarray(weights, dtype=np.float32)
+
+
+def knapsack(costs, values, budget):
+    """
+        0/1 knapsack: the items of highest total value whose total cost fits the budget.
+
+        Args:
+            costs (list): Integer cost of every item.
+            values (np.ndarray): Value of every item.
+            budget (int): Maximum total cost.
+
+        Returns:
+            set: Indexes of the chosen items.
+    """
+    best = np.zeros(budget + 1)
+    taken = np.zeros((len(costs), budget + 1), dtype=bool)
+    for item, (cost, value) in enumerate(zip(costs, values)):
+        if cost > budget:
+            continue
+        candidate = np.full(budget + 1, -np.inf)
+        candidate[cost:] = best[:budget + 1 - cost] + value
+        taken[item] = candidate > best
+        best = np.maximum(best, candidate)
+
+    chosen = set()
+    remaining = int(np.argmax(best))
+    for item in range(len(costs) - 1, -1, -1):
+        if taken[item, remaining]:
+            chosen.add(item)
+            remaining -= costs[item]
+    return chosen
+
+
+def pack_sections(sections, budget, buckets=[]):
+    """
+        Chooses the sections that maximize the total relevance within the token budget. The relevance of a section is
+        its rank score (fused score of hybrid search, otherwise its score) weighted by the priority of its bucket and
+        lowered by its similarity to better sections. Near duplicates of better sections are dropped.
+
+        Args:
+            sections (list): The matches, sorted by bucket priority and score.
+            budget (int): The token budget.
+            buckets (list, optional): The buckets of the request, with their priorities. Default is an empty list.
+
+        Returns:
+            list: One (reason, details) tuple per section, the reason being CHOSEN, NEAR_DUPLICATE, OVER_BUDGET or TOO_LONG.
+    """
+    if not sections:
+        return []
+    costs = [max(0, int(section.get("metadata", {}).get("tokens", 0) or 0)) for section in sections]
+    relevance = np.asarray([section.get("rrf_score", section.get("score")) or 0 for section in sections],
+                           dtype=np.float32)
+    # Sections are sorted best first, rank scores only decide the values of the sections relative to each other
+    relevance = relevance / relevance.max() if relevance.max() > 0 else np.ones(len(sections), dtype=np.float32)
+    values = relevance * bucket_weights(sections, buckets)
+
+    vectors = text_vectors([section.get("metadata", {}).get("text", "") for section in sections])
+    similarities = np.tril(vectors @ vectors.T, k=-1)  # similarity of every section to the better sections
+    reasons = [None] * len(sections)
+    kept = np.ones(len(sections), dtype=bool)
+    for index in range(1, len(sections)):
+        duplicate_of = np.flatnonzero(kept[:index] & (similarities[index, :index] >= CONTEXT_DUPLICATE_SIMILARITY))
+        if len(duplicate_of):
+            kept[index] = False
+            original = sections[duplicate_of[0]]
+            reasons[index] = (NEAR_DUPLICATE, {"duplicate_of": original.get("metadata", {}).get("id", original.get("id")),
+                                               "similarity": round(float(similarities[index, duplicate_of[0]]), 3)})
+
+    redundancy = (similarities * kept[np.newaxis, :]).max(axis=1)
+    values = values * (1 - CONTEXT_DIVERSITY_PENALTY * redundancy)
+    candidates = [index for index in range(len(sections)) if kept[index]]
+    chosen = knapsack([costs[index] for index in candidates], values[candidates], budget)
+    for position, index in enumerate(candidates):
+        details = {"value": round(float(values[index]), 4), "redundancy": round(float(redundancy[index]), 3)}
+        if position in chosen:
+            reasons[index] = (CHOSEN, details)
+        else:
+            reasons[index] = (TOO_LONG if costs[index] > budget else OVER_BUDGET, details)
+    return reasons
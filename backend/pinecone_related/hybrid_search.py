@@ -0,0 +1,82 @@
+import traceback
+
+from constants.misc import HYBRID_RRF_K, HYBRID_SPARSE_MIN_SCORE, HYBRID_SPARSE_TOP_K
+from constants.sources import LEXICAL_MATCHES
+from utils.helpers import add_message_source_to_g, log
+from utils.tracing import set_span_attributes
+
+
+def fetch_missing_metadata(index, ids, namespace):
+    """
+        Fetches from Pinecone the metadata of vectors missing from the local copy (added since it was exported).
+
+        Returns:
+            dict: Vector id -> metadata.
+    """
+    if not ids or not hasattr(index, "fetch"):
+        return {}
+    try:
+        fetched = index.fetch(ids=ids, namespace=namespace)
+        log(f"--fetched metadata of {len(ids)} vectors missing from the local copy")
+        return {vector_id: dict(vector.metadata or {}) for vector_id, vector in fetched.vectors.items()}
+    except Exception as e:
+        log("Error in fetch_missing_metadata", traceback.format_exc())
+        return {}
+
+
+def hybrid_matches(local_namespace, index, namespace, dense_matches, query, query_embedding, metadata_filter=None):
+    """
+        Fuses the dense matches of a query with the BM25 matches of the local copy of the namespace,
+        by reciprocal rank fusion. Dense matches are queried without metadata, it is read from the local copy.
+
+        Args:
+            local_namespace (LocalNamespace): The local copy of the namespace.
+            index (Pinecone.Index or LocalIndex): The index the dense matches come from.
+            namespace (str): The namespace.
+            dense_matches (list): The matches of the dense query, sorted by score.
+            query (str): The text of the query.
+            query_embedding (list): The embedding of the query.
+            metadata_filter (dict, optional): The metadata filter of the dense query. Defaults to None.
+
+        Returns:
+            list: The fused matches ("id", "score", "metadata", "rrf_score", "lexical_match"), sorted by rrf_score.
+            "score" is the dense score, computed from the local copy for the matches only found by BM25, and
+            "lexical_match" tells whether the match is relevant on its BM25 score alone.
+    """
+    mask = local_namespace.get_filter_mask(metadata_filter) if metadata_filter else None
+    sparse_matches = local_namespace.bm25_index.query(query, HYBRID_SPARSE_TOP_K, mask) if query else []
+
+    fused = {}
+    for rank, match in enumerate(dense_matches, 1):
+        fused[match["id"]] = {"id": match["id"], "score": float(match["score"]), "metadata": None,
+                              "rrf_score": 1 / (HYBRID_RRF_K + rank), "lexical_match": False}
+    lexical_only = []
+    for rank, (row, _, relative_score) in enumerate(sparse_matches, 1):
+        vector_id = local_namespace.ids[row]
+        if vector_id not in fused:
+            fused[vector_id] = {"id": vector_id, "score": None, "metadata": None, "rrf_score": 0,
+                                "lexical_match": False}
+            lexical_only.append(row)
+        fused[vector_id]["rrf_score"] += 1 / (HYBRID_RRF_K + rank)
+        fused[vector_id]["lexical_match"] = relative_score >= HYBRID_SPARSE_MIN_SCORE
+
+    for row, score in zip(lexical_only, local_namespace.score_rows(query_embedding, lexical_only)):
+        fused[local_namespace.ids[row]]["score"] = float(score)
+
+    missing = []
+    for vector_id, match in fused.items():
+        row = local_namespace.rows.get(vector_id)
+        if row is None:
+            missing.append(vector_id)
+        else:
+            match["metadata"] = local_namespace.metadata[row]
+    for vector_id, metadata in fetch_missing_metadata(index, missing, namespace).items():
+        fused[vector_id]["metadata"] = metadata
+
+    matches = sorted((match for match in fused.values() if match["metadata"] is not None),
+                     key=lambda match: match["rrf_score"], reverse=True)
+    log(f"--hybrid search: {len(dense_matches)} dense, {len(sparse_matches)} lexical, {len(lexical_only)} only lexical")
+    add_message_source_to_g(LEXICAL_MATCHES, [match["id"] for match in matches if match["lexical_match"]])
+    set_span_attributes(dense_matches=len(dense_matches), lexical_matches=len(sparse_matches),
+                        lexical_only_matches=len(lexical_only))
+    return matches
@@ -1,9 +1,13 @@
 from openai import OpenAI
+import threading
+import time
+
 from pinecone.grpc import PineconeGRPC as Pinecone
-from pinecone.exceptions import NotFoundException
 from constants.credentials import OPENAI_API_KEY, OPENAI_ORGANIZATION, PINECONE_API_KEY
 # from ml_models.gpt_helpers import create_embedding_for_list
 import traceback
+from constants.cache_related import PINECONE_INDEX_HANDLE_TTL, PINECONE_INDEX_HOSTS_TTL, PINECONE_INDEX_MISS_REFRESH
+from pinecone_related.local_index import get_local_index, is_local_index, local_index_exists, warm_local_indexes
 from utils.helpers import log
 
 client = OpenAI(api_key=OPENAI_API_KEY,
@@ -14,37 +18,120 @@ pc_client = Pinecone(api_key=PINECONE_API_KEY)
 # def create_sample_embedding():
 #     return create_embedding_for_list("Sample document text goes here")
 
+# Per-process registry of the indexes, their hosts and their Index handles
+index_hosts = {}
+index_hosts_fetched_at = None
+index_handles = {}
+registry_lock = threading.RLock()
+refresh_lock = threading.Lock()  # a single list_indexes call in flight, registry_lock is not held during it
+
+
+def refresh_index_hosts(force=False):
+    """
+        Fetches the list of indexes and their hosts, unless it was fetched less than PINECONE_INDEX_HOSTS_TTL seconds ago.
+        While another thread fetches it, the stale list is returned; only the first fetch and forced ones wait for it.
+
+        Args:
+            force (bool, optional): Fetch the list even if it is still fresh. Defaults to False.
+
+        Returns:
+            dict: Index name -> host.
+    """
+    global index_hosts, index_hosts_fetched_at
+    with registry_lock:
+        fetched_at = index_hosts_fetched_at
+        if not force and fetched_at is not None and time.monotonic() - fetched_at < PINECONE_INDEX_HOSTS_TTL:
+            return index_hosts
+    if not refresh_lock.acquire(blocking=force or fetched_at is None):
+        return index_hosts
+    try:
+        # Fetched by another thread while this one waited
+        if index_hosts_fetched_at != fetched_at:
+            return index_hosts
+        hosts = {index.get('name'): index.get('host') for index in pc_client.list_indexes()}
+        with registry_lock:
+            index_hosts = hosts
+            index_hosts_fetched_at = time.monotonic()
+        log(f"Fetched Pinecone indexes: {list(hosts.keys())}")
+    except Exception as e:
+        log("Error in refresh_index_hosts", traceback.format_exc())
+        if index_hosts_fetched_at is None:
+            raise e
+    finally:
+        refresh_lock.release()
+    return index_hosts
+
+
 def check_index_exists(index_name):
-    # Get the list of all existing indexes
-    indexes = pc_client.list_indexes()
+    """
+        Checks whether an index exists, using the cached list of indexes. An unknown index refreshes the list,
+        at most once every PINECONE_INDEX_MISS_REFRESH seconds, so that new indexes are found.
+        Local indexes (LOCAL_INDEX_PREFIX) exist when their directory exists.
+
+        Args:
+            index_name (str): The name of the Pinecone index.
+
+        Returns:
+            bool: True if the index exists.
+    """
     try:
-        for index in indexes:
-            if index.get('name') == index_name:
-                return True
-        return False
+        if is_local_index(index_name):
+            return local_index_exists(index_name)
+        if index_name in refresh_index_hosts():
+            return True
+        if time.monotonic() - index_hosts_fetched_at < PINECONE_INDEX_MISS_REFRESH:
+            return False
+        return index_name in refresh_index_hosts(force=True)
     except Exception as e:
         log("Error in check_index_exists", traceback.format_exc())
         raise e
 
 
-
 def get_pinecone_index(pinecone_index):
     """
-        This function attempts to retrieve an existing Pinecone index specified by `pinecone_index`.
-        If the index does not exist, it is created with dimensions based on a sample embedding.
+        This function returns the Index handle of the Pinecone index specified by `pinecone_index`.
+        Handles are created from the index host (no host lookup per request) and reused for
+        PINECONE_INDEX_HANDLE_TTL seconds, so that their gRPC channel stays open.
+        Names starting with LOCAL_INDEX_PREFIX return the in-process LocalIndex instead.
 
         Args:
-            pinecone_index (str): The name of the Pinecone index to retrieve or create.
+            pinecone_index (str): The name of the Pinecone index to retrieve.
 
         Returns:
-            Pinecone.Index: The Pinecone index object.
+            Pinecone.Index or LocalIndex: The Pinecone index object.
     """
-    try:
-        # if pinecone_index not in pc_client.list_indexes():
-    #     pc_client.create_index(pinecone_index, dimension=len(create_sample_embedding()))
-        # TODO: use host name to create index (improves performance)
-        index = pc_client.Index(pinecone_index)
+    if is_local_index(pinecone_index):
+        return get_local_index(pinecone_index)
+    with registry_lock:
+        handle = index_handles.get(pinecone_index)
+        if handle is not None and time.monotonic() - handle[1] < PINECONE_INDEX_HANDLE_TTL:
+            return handle[0]
+
+    # The list of indexes may be fetched, without holding the registry
+    if not check_index_exists(pinecone_index):
+        raise Exception(f"Index {pinecone_index} not found")
+    with registry_lock:
+        index = pc_client.Index(name=pinecone_index, host=index_hosts[pinecone_index])
+        index_handles[pinecone_index] = (index, time.monotonic())
         return index
-    except NotFoundException as e:
-        raise f"Index {pinecone_index} not found" 
 
+
+def warm_pinecone_indexes(index_names=None):
+    """
+        Resolves the index hosts and opens the connections of the indexes, and loads their local copies,
+        to be called when a worker starts.
+
+        Args:
+            index_names (list, optional): The indexes to warm. Defaults to every index.
+    """
+    warm_local_indexes(index_names)
+    try:
+        index_names = index_names or list(refresh_index_hosts().keys())
+        for index_name in index_names:
+            try:
+                get_pinecone_index(index_name).describe_index_stats()
+            except Exception as e:
+                log(f"Error in warming Pinecone index {index_name}", traceback.format_exc())
+        log(f"Warmed Pinecone indexes: {index_names}")
+    except Exception as e:
+        log("Error in warm_pinecone_indexes", traceback.format_exc())
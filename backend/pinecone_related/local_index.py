@@ -0,0 +1,472 @@
+"""
+    In-process vector indexes, served instead of Pinecone for the pinecone_index names starting with LOCAL_INDEX_PREFIX.
+    A LocalIndex answers query() like a Pinecone Index handle, so query_from_pinecone works with either.
+
+    Every namespace is a directory settings.VECTOR_DATAS_DIR/<index>/<namespace>/ holding one build:
+        manifest.json              build id, metric, dimension, count and number of IVF lists
+        vectors-<build>.npy        float32 vectors, one row per vector, normalized for the cosine metric (memory-mapped)
+        metadata-<build>.jsonl     {"id": ..., "metadata": {...}} per row
+        centroids-<build>.npy      IVF centroids, only for namespaces of at least LOCAL_INDEX_IVF_MIN_VECTORS vectors
+        assignments-<build>.npy    IVF list of every row
+        bm25-<build>.npz           BM25 index of the "text" metadata, see pinecone_related/bm25_index.py
+
+    python -m pinecone_related.local_index export <pinecone_index> <namespace>
+"""
+import argparse
+import json
+import os
+import threading
+import time
+import traceback
+from collections import OrderedDict
+from pathlib import Path
+
+import numpy as np
+
+import settings
+from constants.misc import (LOCAL_INDEX_FILTER_CACHE_SIZE, LOCAL_INDEX_IVF_MIN_VECTORS, LOCAL_INDEX_IVF_NPROBE,
+                            LOCAL_INDEX_KMEANS_ITERATIONS, LOCAL_INDEX_KMEANS_SAMPLE, LOCAL_INDEX_PREFIX)
+from pinecone_related.bm25_index import BM25Index
+from utils.cache import bump_namespace_generation
+from utils.helpers import log
+
+DEFAULT_NAMESPACE_DIR = "__default__"  # directory of the "" namespace
+METRICS = ["cosine", "dotproduct"]
+BLOCK_SIZE = 65536  # rows scored at once when assigning vectors to IVF lists
+
+
+def get_vector_datas_dir():
+    directory = Path(settings.VECTOR_DATAS_DIR)
+    return directory if directory.is_absolute() else Path(settings.cwd) / directory
+
+
+def get_namespace_dir(index_name, namespace):
+    return get_vector_datas_dir() / index_name / (namespace or DEFAULT_NAMESPACE_DIR)
+
+
+def normalize_rows(vectors):
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return vectors / norms
+
+
+def matches_condition(metadata, key, condition):
+    """
+        Whether a metadata field satisfies a condition of a Pinecone metadata filter. A bare value means $eq,
+        a list field satisfies $eq and $in when one of its items does.
+    """
+    if not isinstance(condition, dict):
+        condition = {"$eq": condition}
+    present = key in metadata
+    values = metadata.get(key) if isinstance(metadata.get(key), list) else [metadata.get(key)]
+    for operator, operand in condition.items():
+        if operator == "$exists":
+            satisfied = present == bool(operand)
+        elif operator == "$eq":
+            satisfied = present and any(value == operand for value in values)
+        elif operator == "$ne":
+            satisfied = not present or all(value != operand for value in values)
+        elif operator == "$in":
+            satisfied = present and any(value in operand for value in values)
+        elif operator == "$nin":
+            satisfied = not present or all(value not in operand for value in values)
+        elif operator in ["$gt", "$gte", "$lt", "$lte"]:
+            numbers = [value for value in values if isinstance(value, (int, float)) and not isinstance(value, bool)]
+            compare = {"$gt": lambda value: value > operand, "$gte": lambda value: value >= operand,
+                       "$lt": lambda value: value < operand, "$lte": lambda value: value <= operand}[operator]
+            satisfied = any(compare(value) for value in numbers)
+        else:
+            raise ValueError(f"Unsupported metadata filter operator {operator}")
+        if not satisfied:
+            return False
+    return True
+
+
+def matches_filter(metadata, metadata_filter):
+    """
+        Whether metadata satisfies a Pinecone metadata filter ($eq, $ne, $gt, $gte, $lt, $lte, $in, $nin, $exists,
+        $and, $or).
+    """
+    for key, condition in metadata_filter.items():
+        if key == "$and":
+            if not all(matches_filter(metadata, sub_filter) for sub_filter in condition):
+                return False
+        elif key == "$or":
+            if not any(matches_filter(metadata, sub_filter) for sub_filter in condition):
+                return False
+        elif not matches_condition(metadata, key, condition):
+            return False
+    return True
+
+
+def train_kmeans(vectors, nlist, iterations=LOCAL_INDEX_KMEANS_ITERATIONS, sample_size=LOCAL_INDEX_KMEANS_SAMPLE):
+    """
+        Spherical k-means on a sample of the vectors, the centroids of the IVF lists.
+
+        Args:
+            vectors (np.ndarray): Normalized vectors, one per row.
+            nlist (int): Number of lists.
+
+        Returns:
+            tuple: The centroids (nlist rows) and the list of every vector.
+    """
+    generator = np.random.default_rng(0)
+    sample = vectors[np.sort(generator.choice(len(vectors), min(sample_size, len(vectors)), replace=False))]
+    centroids = sample[generator.choice(len(sample), nlist, replace=False)].copy()
+    for _ in range(iterations):
+        assignments = np.argmax(sample @ centroids.T, axis=1)
+        counts = np.bincount(assignments, minlength=nlist)
+        empty = counts == 0
+        starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+        sums = np.zeros_like(centroids)
+        sums[~empty] = np.add.reduceat(sample[np.argsort(assignments, kind="stable")], starts[~empty])
+        # Empty lists restart from random vectors of the sample
+        sums[empty] = sample[generator.choice(len(sample), int(empty.sum()), replace=False)]
+        centroids = normalize_rows(sums).astype(np.float32)
+    assignments = np.concatenate([np.argmax(vectors[start:start + BLOCK_SIZE] @ centroids.T, axis=1)
+                                  for start in range(0, len(vectors), BLOCK_SIZE)]).astype(np.int32)
+    return centroids, assignments
+
+
+class LocalNamespace:
+    """
+        One build of a namespace, its vectors are memory-mapped, its metadata and BM25 index kept in memory.
+
+        Args:
+            directory (Path): The directory of the namespace.
+            manifest (dict): The manifest of the build.
+    """
+
+    def __init__(self, directory, manifest):
+        build = manifest["build"]
+        self.metric = manifest["metric"]
+        self.vectors = np.load(directory / f"vectors-{build}.npy", mmap_mode="r")
+        self.ids = []
+        self.metadata = []
+        with open(directory / f"metadata-{build}.jsonl") as file:
+            for line in file:
+                row = json.loads(line)
+                self.ids.append(row["id"])
+                self.metadata.append(row.get("metadata") or {})
+        if len(self.ids) != len(self.vectors):
+            raise Exception(f"Build {build} of {directory} has {len(self.vectors)} vectors and {len(self.ids)} ids")
+
+        self.centroids = None
+        self.lists = None
+        if manifest.get("nlist"):
+            self.centroids = np.load(directory / f"centroids-{build}.npy")
+            assignments = np.load(directory / f"assignments-{build}.npy")
+            order = np.argsort(assignments, kind="stable")
+            bounds = np.searchsorted(assignments[order], np.arange(len(self.centroids) + 1))
+            self.lists = [order[bounds[index]:bounds[index + 1]] for index in range(len(self.centroids))]
+        self.rows = {vector_id: row for row, vector_id in enumerate(self.ids)}
+        # Builds written before the BM25 index was stored with them build it here
+        bm25_path = directory / f"bm25-{build}.npz"
+        if bm25_path.exists():
+            self.bm25_index = BM25Index.load(bm25_path)
+        else:
+            self.bm25_index = BM25Index.from_texts([metadata.get("text", "") for metadata in self.metadata])
+        self._filter_masks = OrderedDict()
+        self._lock = threading.Lock()
+
+    def normalize_query(self, vector):
+        query_vector = np.asarray(vector, dtype=np.float32)
+        if self.metric == "cosine":
+            norm = np.linalg.norm(query_vector)
+            query_vector = query_vector / norm if norm > 0 else query_vector
+        return query_vector
+
+    def score_rows(self, vector, rows):
+        """
+            Scores of the given rows for a query vector, as the query would score them.
+        """
+        if len(rows) == 0:
+            return np.zeros(0, dtype=np.float32)
+        return self.vectors[np.asarray(rows)] @ self.normalize_query(vector)
+
+    def get_filter_mask(self, metadata_filter):
+        """
+            Rows matching a metadata filter, as a boolean mask. The masks of the last filters are kept,
+            requests of an organization mostly reuse the same filter.
+        """
+        key = json.dumps(metadata_filter, sort_keys=True, default=str)
+        with self._lock:
+            mask = self._filter_masks.get(key)
+            if mask is not None:
+                self._filter_masks.move_to_end(key)
+                return mask
+        mask = np.fromiter((matches_filter(metadata, metadata_filter) for metadata in self.metadata),
+                           dtype=bool, count=len(self.metadata))
+        with self._lock:
+            self._filter_masks[key] = mask
+            while len(self._filter_masks) > LOCAL_INDEX_FILTER_CACHE_SIZE:
+                self._filter_masks.popitem(last=False)
+        return mask
+
+    def candidate_rows(self, query_vector, top_k, mask):
+        """
+            Rows to score: the vectors of the nearest IVF lists, or None (every row) for a brute-force search.
+        """
+        if self.lists is not None:
+            nprobe = min(LOCAL_INDEX_IVF_NPROBE, len(self.lists))
+            probed = np.argpartition(-(self.centroids @ query_vector), nprobe - 1)[:nprobe]
+            rows = np.sort(np.concatenate([self.lists[index] for index in probed]))
+            if mask is not None:
+                rows = rows[mask[rows]]
+            # A selective filter can leave too few rows in the probed lists, every matching row is scored instead
+            if len(rows) >= top_k or mask is None:
+                return rows
+        return np.flatnonzero(mask) if mask is not None else None
+
+    def query(self, vector, top_k, metadata_filter=None, include_values=False, include_metadata=False):
+        query_vector = self.normalize_query(vector)
+        mask = self.get_filter_mask(metadata_filter) if metadata_filter else None
+        rows = self.candidate_rows(query_vector, top_k, mask)
+        if rows is not None and len(rows) == 0:
+            return []
+
+        scores = (self.vectors[rows] if rows is not None else self.vectors) @ query_vector
+        top_k = min(top_k, len(scores))
+        if top_k <= 0:
+            return []
+        best = np.argpartition(-scores, top_k - 1)[:top_k]
+        best = best[np.argsort(-scores[best], kind="stable")]
+        matches = []
+        for position in best:
+            row = int(rows[position]) if rows is not None else int(position)
+            match = {"id": self.ids[row], "score": float(scores[position])}
+            if include_values:
+                match["values"] = self.vectors[row].tolist()
+            if include_metadata:
+                match["metadata"] = self.metadata[row]
+            matches.append(match)
+        return matches
+
+
+class LocalIndex:
+    """
+        In-process stand-in for a Pinecone Index handle, with the same query contract.
+        A namespace is loaded on its first query and reloaded when write_namespace replaces its build.
+
+        Args:
+            name (str): The name of the index, without LOCAL_INDEX_PREFIX.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.directory = get_vector_datas_dir() / name
+        self._namespaces = {}
+        self._lock = threading.Lock()
+
+    def get_namespace(self, namespace):
+        """
+            Returns the current build of a namespace, or None if the namespace does not exist.
+        """
+        directory = self.directory / (namespace or DEFAULT_NAMESPACE_DIR)
+        try:
+            modified_at = (directory / "manifest.json").stat().st_mtime_ns
+        except FileNotFoundError:
+            return None
+        loaded = self._namespaces.get(namespace)
+        if loaded is not None and loaded[0] == modified_at:
+            return loaded[1]
+        with self._lock:
+            loaded = self._namespaces.get(namespace)
+            if loaded is None or loaded[0] != modified_at:
+                manifest = json.loads((directory / "manifest.json").read_text())
+                loaded = (modified_at, LocalNamespace(directory, manifest))
+                self._namespaces[namespace] = loaded
+                log(f"Loaded local namespace {self.name}/{namespace}: {len(loaded[1].ids)} vectors, "
+                    f"{'IVF' if loaded[1].lists is not None else 'brute force'}")
+            return loaded[1]
+
+    def query(self, vector=None, top_k=10, namespace="", filter=None, include_values=False, include_metadata=False,
+              **kwargs):
+        """
+            Same arguments and response as Index.query of Pinecone (only queries by vector).
+
+            Returns:
+                dict: {"matches": [{"id", "score", "metadata", "values"}], "namespace"}, matches sorted by score.
+        """
+        local_namespace = self.get_namespace(namespace)
+        if local_namespace is None or vector is None:
+            return {"matches": [], "namespace": namespace}
+        return {"matches": local_namespace.query(vector, top_k, filter, include_values, include_metadata),
+                "namespace": namespace}
+
+    def describe_index_stats(self, **kwargs):
+        """
+            Loads every namespace of the index and returns their sizes.
+        """
+        namespaces = {}
+        dimension = None
+        for directory in sorted(self.directory.iterdir()) if self.directory.is_dir() else []:
+            namespace = "" if directory.name == DEFAULT_NAMESPACE_DIR else directory.name
+            local_namespace = self.get_namespace(namespace)
+            if local_namespace is not None:
+                namespaces[namespace] = {"vector_count": len(local_namespace.ids)}
+                dimension = local_namespace.vectors.shape[1]
+        return {"dimension": dimension, "namespaces": namespaces,
+                "total_vector_count": sum(stats["vector_count"] for stats in namespaces.values())}
+
+
+local_indexes = {}
+local_indexes_lock = threading.Lock()
+
+
+def is_local_index(pinecone_index):
+    return isinstance(pinecone_index, str) and pinecone_index.startswith(LOCAL_INDEX_PREFIX)
+
+
+def local_index_exists(pinecone_index):
+    return (get_vector_datas_dir() / pinecone_index[len(LOCAL_INDEX_PREFIX):]).is_dir()
+
+
+def get_local_index(pinecone_index):
+    """
+        Returns the LocalIndex of a pinecone_index starting with LOCAL_INDEX_PREFIX, one per process.
+    """
+    with local_indexes_lock:
+        if pinecone_index not in local_indexes:
+            if not local_index_exists(pinecone_index):
+                raise Exception(f"Index {pinecone_index} not found")
+            local_indexes[pinecone_index] = LocalIndex(pinecone_index[len(LOCAL_INDEX_PREFIX):])
+        return local_indexes[pinecone_index]
+
+
+def get_local_namespace(pinecone_index, namespace):
+    """
+        Returns the local copy of a namespace, for a local index or a Pinecone index exported with
+        export_namespace_from_pinecone, or None if there is no local copy.
+    """
+    name = pinecone_index if is_local_index(pinecone_index) else LOCAL_INDEX_PREFIX + pinecone_index
+    try:
+        if name not in local_indexes and not local_index_exists(name):
+            return None
+        return get_local_index(name).get_namespace(namespace)
+    except Exception as e:
+        log("Error in get_local_namespace", traceback.format_exc())
+        return None
+
+
+def warm_local_indexes(index_names=None):
+    """
+        Loads every namespace of the local indexes, their metadata and BM25 index, to be called when a worker starts
+        so that no query waits for them.
+
+        Args:
+            index_names (list, optional): The indexes, local or Pinecone indexes with a local copy. Defaults to every
+            local index.
+    """
+    try:
+        directory = get_vector_datas_dir()
+        if index_names:
+            names = [name if is_local_index(name) else LOCAL_INDEX_PREFIX + name for name in index_names]
+        else:
+            names = [LOCAL_INDEX_PREFIX + path.name for path in sorted(directory.iterdir()) if path.is_dir()] \
+                if directory.is_dir() else []
+        for name in names:
+            if local_index_exists(name):
+                stats = get_local_index(name).describe_index_stats()
+                log(f"Warmed local index {name}: {stats['total_vector_count']} vectors")
+    except Exception as e:
+        log("Error in warm_local_indexes", traceback.format_exc())
+
+
+def write_namespace(index_name, namespace, ids, vectors, metadatas, metric="cosine"):
+    """
+        Writes a new build of a namespace and invalidates its cached results. Processes serving the namespace
+        switch to the new build on their next query, the files of the previous build are removed.
+
+        Args:
+            index_name (str): The name of the index, without LOCAL_INDEX_PREFIX.
+            namespace (str): The namespace.
+            ids (list): The ids of the vectors.
+            vectors (list or np.ndarray): The vectors, in the order of ids.
+            metadatas (list): The metadata of the vectors, in the order of ids.
+            metric (str, optional): "cosine" or "dotproduct", the metric of the Pinecone index. Defaults to "cosine".
+
+        Returns:
+            dict: The manifest of the build.
+    """
+    if metric not in METRICS:
+        raise ValueError(f"Unsupported metric {metric}, expected one of {METRICS}")
+    vectors = np.asarray(vectors, dtype=np.float32)
+    if vectors.ndim != 2 or len(vectors) != len(ids) or len(ids) != len(metadatas) or len(ids) == 0:
+        raise ValueError("ids, vectors and metadatas must be non-empty and of the same length")
+    if metric == "cosine":
+        vectors = normalize_rows(vectors).astype(np.float32)
+
+    directory = get_namespace_dir(index_name, namespace)
+    directory.mkdir(parents=True, exist_ok=True)
+    build = f"{int(time.time())}-{os.urandom(4).hex()}"
+    np.save(directory / f"vectors-{build}.npy", vectors)
+    with open(directory / f"metadata-{build}.jsonl", "w") as file:
+        for vector_id, metadata in zip(ids, metadatas):
+            file.write(json.dumps({"id": str(vector_id), "metadata": metadata or {}}) + "\n")
+
+    nlist = 0
+    if len(vectors) >= LOCAL_INDEX_IVF_MIN_VECTORS:
+        nlist = int(4 * np.sqrt(len(vectors)))
+        centroids, assignments = train_kmeans(vectors if metric == "cosine" else normalize_rows(vectors), nlist)
+        np.save(directory / f"centroids-{build}.npy", centroids)
+        np.save(directory / f"assignments-{build}.npy", assignments)
+    BM25Index.from_texts([(metadata or {}).get("text", "") for metadata in metadatas]).save(
+        directory / f"bm25-{build}.npz")
+
+    manifest = {"build": build, "metric": metric, "dimension": int(vectors.shape[1]), "count": len(ids), "nlist": nlist}
+    # The manifest is replaced last, readers never see a partial build
+    (directory / "manifest.json.tmp").write_text(json.dumps(manifest))
+    os.replace(directory / "manifest.json.tmp", directory / "manifest.json")
+    for path in directory.iterdir():
+        if path.suffix in [".npy", ".npz", ".jsonl"] and build not in path.name:
+            # Processes still reading the previous build keep their open memory maps
+            path.unlink()
+
+    # Cached results of the local index and of the Pinecone index using this copy for hybrid search
+    bump_namespace_generation(LOCAL_INDEX_PREFIX + index_name, namespace)
+    bump_namespace_generation(index_name, namespace)
+    log(f"Wrote local namespace {index_name}/{namespace}: {len(ids)} vectors, {nlist} IVF lists")
+    return manifest
+
+
+def export_namespace_from_pinecone(pinecone_index, namespace, batch_size=100):
+    """
+        Copies a namespace of a Pinecone index to the local index of the same name.
+
+        Args:
+            pinecone_index (str): The name of the Pinecone index.
+            namespace (str): The namespace to copy.
+            batch_size (int, optional): Vectors fetched per request. Defaults to 100.
+
+        Returns:
+            dict: The manifest of the local build.
+    """
+    from pinecone_related.init import get_pinecone_index, pc_client
+
+    try:
+        index = get_pinecone_index(pinecone_index)
+        metric = pc_client.describe_index(pinecone_index).metric
+        vector_ids = [vector_id for page in index.list(namespace=namespace) for vector_id in page]
+        ids, vectors, metadatas = [], [], []
+        for start in range(0, len(vector_ids), batch_size):
+            fetched = index.fetch(ids=vector_ids[start:start + batch_size], namespace=namespace)
+            for vector_id, vector in fetched.vectors.items():
+                ids.append(vector_id)
+                vectors.append(vector.values)
+                metadatas.append(dict(vector.metadata or {}))
+        log(f"Fetched {len(ids)} vectors of {pinecone_index}/{namespace} from Pinecone")
+        return write_namespace(pinecone_index, namespace, ids, vectors, metadatas, metric)
+    except Exception as e:
+        log("Error in export_namespace_from_pinecone", traceback.format_exc())
+        raise e
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Manage the local vector indexes.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    export = subparsers.add_parser("export", help="Copy a namespace of a Pinecone index to the local index.")
+    export.add_argument("pinecone_index")
+    export.add_argument("namespace")
+    args = parser.parse_args()
+    print(export_namespace_from_pinecone(args.pinecone_index, args.namespace))
@@ -1,19 +1,34 @@
+import asyncio
+import hashlib
+import json
 import traceback
 
+import numpy as np
+
 from openai import OpenAI
-from constants.misc import CHATGPT_MAX_TOKENS, SEPARATOR, MAX_TOKEN_BUFFER
+from constants.misc import CHATGPT_MAX_TOKENS, HYBRID_DENSE_TOP_K, HYBRID_SEARCH_ENABLED, SEPARATOR, MAX_TOKEN_BUFFER
 import constants.credentials as creds
-from ml_models.gpt_helpers import create_embedding
+from ml_models.gpt_helpers import create_embedding, create_embedding_async
 from pinecone_related.init import check_index_exists
 
 client = OpenAI(api_key=creds.OPENAI_API_KEY,
                 organization=creds.OPENAI_ORGANIZATION)
 from pinecone_related.init import get_pinecone_index
+from pinecone_related.context_packing import CHOSEN, NEAR_DUPLICATE, OVER_BUDGET, pack_sections
+from pinecone_related.hybrid_search import hybrid_matches
+from pinecone_related.local_index import get_local_namespace
 from utils.helpers import add_message_source_to_g, log
-from constants.sources import TOTAL_TOKENS_FETCHED, TOTAL_TOKENS_USED, VECTOR_IDS, VECTORS_INFO
+from constants.cache_related import RETRIEVAL_CACHE_MAXSIZE, RETRIEVAL_CACHE_QUANTIZATION, RETRIEVAL_CACHE_TTL
+from constants.sources import RETRIEVAL_CACHE_HIT, TOTAL_TOKENS_FETCHED, TOTAL_TOKENS_USED, VECTOR_IDS, VECTORS_INFO
+from utils.cache import TTLCache, get_namespace_generation
+from utils.tracing import set_span_attributes, span, traced
+
+retrieval_cache = TTLCache("retrieval", maxsize=RETRIEVAL_CACHE_MAXSIZE, ttl=RETRIEVAL_CACHE_TTL)
+
 
 # TODO: What if we get no results because of buckets
-def query_from_pinecone(pinecone_index, namespace, query="Who are you?", _top_k=50, host_url=None, filters=None, buckets=[]):
+@traced("query_from_pinecone")
+def query_from_pinecone(pinecone_index, namespace, query="Who are you?", _top_k=50, host_url=None, filters=None, buckets=[], query_embedding=None):
     """
         This function retrieves a Pinecone index and generates an embedding for the input query.
         It applies optional metadata filters and sorts the results by relevance and optionally by bucket priority.
@@ -26,13 +41,15 @@ def query_from_pinecone(pinecone_index, namespace, query="Who are you?", _top_k=
             host_url (str): The URL of the organization user is querying about.
             filters (dict, optional): Additional metadata filters to apply to the query. Default is None.
             buckets (list, optional): A list of buckets to filter results by bucket ID and sort by bucket priority. Default is an empty list.
+            query_embedding (list, optional): The embedding of the query, if it was already computed. Default is None.
 
         Returns:
             list: A list of the most relevant document sections, sorted by score or by bucket priority and score.
     """
     try:
+        index_name = pinecone_index
         pinecone_index = get_pinecone_index(pinecone_index)
-        xq = create_embedding(query)
+        xq = query_embedding if query_embedding is not None else create_embedding(query)
         metadata_filter = {} 
         most_relevant_document_sections = []
         # if filters is not None and isinstance(filters, dict):
@@ -42,38 +59,172 @@ def query_from_pinecone(pinecone_index, namespace, query="Who are you?", _top_k=
         # if len(buckets) > 0 and isinstance(buckets, list):
         #     metadata_filter["bucket_id"] = {"$in":[bucket['id'] for bucket in buckets]}
 
-        fetched_vectors = pinecone_index.query(
-            vector=xq,
-            top_k=_top_k,
-            filter=metadata_filter,
-            include_metadata=True,
-            include_values=False,
-            namespace=namespace
-          )
-        calculate_total_tokens_fetched(fetched_vectors["matches"])
-        most_relevant_document_sections = [v for v in fetched_vectors["matches"] if v['score'] >= 0.7]
-
-        if len(buckets) > 0 and isinstance(buckets, list):
-            try:
-                log("--SORTING BY: BUCKET PRIORITY, SCORE")
-                bucket_priorities = {bucket['id']: bucket.get('priority', 1) for bucket in buckets}
-                # log(bucket_priorities)
-                # log(sorted(
-                #     map(lambda x:{"bucket_id":x['metadata']['bucket_id'], "score":x["score"], "id":x["id"]}, most_relevant_document_sections),
-                #     key=lambda v: (bucket_priorities[int(v['bucket_id'])], -v['score']),
-                # ))
-                return sorted(
-                    most_relevant_document_sections,
-                    key=lambda v: (bucket_priorities[int(v['metadata']['bucket_id'])], -v['score']),
-                )
-            except Exception as e:
-                log("Error in sorting by bucket priority", traceback.format_exc())  
-
-        log("--SORTING BY: SCORE")
-        return sorted(most_relevant_document_sections, key=lambda doc: doc['score'], reverse=True)
+        set_span_attributes(pinecone_index=index_name, namespace=namespace, top_k=_top_k)
+        cache_key = retrieval_cache_key(index_name, namespace, metadata_filter, _top_k, xq)
+        cached = get_cached_matches(cache_key)
+        if cached is not None:
+            return sort_relevant_matches(cached, buckets)
+
+        # With a local copy of the namespace, fewer dense matches are fetched (without metadata) and fused with BM25
+        local_copy = get_local_namespace(index_name, namespace) if HYBRID_SEARCH_ENABLED else None
+        with span("pinecone.query"):
+            fetched_vectors = pinecone_index.query(
+                vector=xq,
+                top_k=min(_top_k, HYBRID_DENSE_TOP_K) if local_copy is not None else _top_k,
+                filter=metadata_filter,
+                include_metadata=local_copy is None,
+                include_values=False,
+                namespace=namespace
+              )
+        matches = fetched_vectors["matches"]
+        if local_copy is not None:
+            matches = hybrid_matches(local_copy, pinecone_index, namespace, matches, query, xq, metadata_filter)
+        total_tokens_fetched = calculate_total_tokens_fetched(matches)
+        return sort_relevant_matches(cache_matches(cache_key, matches, total_tokens_fetched), buckets)
     except Exception as e:
         log("Error in query_from_pinecone", traceback.format_exc())
         return []
+
+
+@traced("query_from_pinecone_async")
+async def query_from_pinecone_async(pinecone_index, namespace, query="Who are you?", _top_k=50, host_url=None, filters=None, buckets=[], query_embedding=None):
+    """
+        Async variant of query_from_pinecone, takes the same arguments.
+        The gRPC client has no asyncio interface, so the query runs on the default executor.
+    """
+    try:
+        index_name = pinecone_index
+        pinecone_index = get_pinecone_index(pinecone_index)
+        xq = query_embedding if query_embedding is not None else await create_embedding_async(query)
+        metadata_filter = {}
+
+        set_span_attributes(pinecone_index=index_name, namespace=namespace, top_k=_top_k)
+        cache_key = retrieval_cache_key(index_name, namespace, metadata_filter, _top_k, xq)
+        cached = get_cached_matches(cache_key)
+        if cached is not None:
+            return sort_relevant_matches(cached, buckets)
+
+        local_copy = await asyncio.to_thread(get_local_namespace, index_name, namespace) if HYBRID_SEARCH_ENABLED else None
+        with span("pinecone.query"):
+            fetched_vectors = await asyncio.to_thread(
+                pinecone_index.query,
+                vector=xq,
+                top_k=min(_top_k, HYBRID_DENSE_TOP_K) if local_copy is not None else _top_k,
+                filter=metadata_filter,
+                include_metadata=local_copy is None,
+                include_values=False,
+                namespace=namespace
+              )
+        matches = fetched_vectors["matches"]
+        if local_copy is not None:
+            matches = await asyncio.to_thread(
+                hybrid_matches, local_copy, pinecone_index, namespace, matches, query, xq, metadata_filter)
+        total_tokens_fetched = calculate_total_tokens_fetched(matches)
+        return sort_relevant_matches(cache_matches(cache_key, matches, total_tokens_fetched), buckets)
+    except Exception as e:
+        log("Error in query_from_pinecone_async", traceback.format_exc())
+        return []
+
+
+def retrieval_cache_key(index_name, namespace, metadata_filter, top_k, xq):
+    """
+        Key of a query in the retrieval cache. The query vector is quantized, so that embeddings of the same
+        text that differ by floating point noise share the same key. The namespace generation is part of the
+        key, bumping it when the namespace is re-synced invalidates its cached results.
+    """
+    try:
+        quantized = np.round(np.asarray(xq, dtype=np.float32) * RETRIEVAL_CACHE_QUANTIZATION).astype(np.int16)
+        return (
+            index_name,
+            namespace,
+            get_namespace_generation(index_name, namespace),
+            json.dumps(metadata_filter, sort_keys=True, default=str),
+            top_k,
+            hashlib.sha1(quantized.tobytes()).hexdigest(),
+        )
+    except Exception as e:
+        log("Error in retrieval_cache_key", traceback.format_exc())
+        return None
+
+
+def get_cached_matches(cache_key):
+    """
+        Returns the cached relevant matches of a query, or None.
+    """
+    if cache_key is None:
+        return None
+    cached = retrieval_cache.get(cache_key)
+    add_message_source_to_g(RETRIEVAL_CACHE_HIT, cached is not None)
+    set_span_attributes(retrieval_cache_hit=cached is not None)
+    if cached is None:
+        return None
+    matches, total_tokens_fetched = cached
+    log(f"--retrieval cache hit, total_tokens_fetched: {total_tokens_fetched}")
+    add_message_source_to_g(TOTAL_TOKENS_FETCHED, total_tokens_fetched)
+    return matches
+
+
+def is_relevant(match):
+    """
+        Whether a match is relevant enough for the context: a score of at least 0.7,
+        or a strong BM25 match of hybrid search (product codes, prices, names).
+    """
+    return match.get('lexical_match', False) or (match['score'] is not None and match['score'] >= 0.7)
+
+
+def rank_score(match):
+    """
+        Score the matches are ranked by: the fused score of hybrid search, otherwise the dense score.
+    """
+    return match.get('rrf_score', match['score'])
+
+
+def cache_matches(cache_key, matches, total_tokens_fetched):
+    """
+        Caches the relevant matches (see is_relevant), they are sorted for the buckets of each request.
+
+        Returns:
+            list: The relevant matches.
+    """
+    relevant_matches = [v for v in matches if is_relevant(v)]
+    if cache_key is not None:
+        retrieval_cache.set(cache_key, (relevant_matches, total_tokens_fetched))
+    return relevant_matches
+
+
+def sort_relevant_matches(matches, buckets=[]):
+    """
+        Keeps the relevant matches (see is_relevant) and sorts them by bucket priority and score,
+        or only by score when no buckets are given. Hybrid search matches are sorted by their fused score.
+
+        Args:
+            matches (list): The matches returned by the Pinecone query.
+            buckets (list, optional): A list of buckets with their priorities. Default is an empty list.
+
+        Returns:
+            list: The relevant matches, sorted.
+    """
+    most_relevant_document_sections = [v for v in matches if is_relevant(v)]
+
+    if len(buckets) > 0 and isinstance(buckets, list):
+        try:
+            log("--SORTING BY: BUCKET PRIORITY, SCORE")
+            bucket_priorities = {bucket['id']: bucket.get('priority', 1) for bucket in buckets}
+            # log(bucket_priorities)
+            # log(sorted(
+            #     map(lambda x:{"bucket_id":x['metadata']['bucket_id'], "score":x["score"], "id":x["id"]}, most_relevant_document_sections),
+            #     key=lambda v: (bucket_priorities[int(v['bucket_id'])], -v['score']),
+            # ))
+            return sorted(
+                most_relevant_document_sections,
+                key=lambda v: (bucket_priorities[int(v['metadata']['bucket_id'])], -rank_score(v)),
+            )
+        except Exception as e:
+            log("Error in sorting by bucket priority", traceback.format_exc())  
+
+    log("--SORTING BY: SCORE")
+    return sorted(most_relevant_document_sections, key=rank_score, reverse=True)
+
     
 def extract_section_values(section_index):
     try:
@@ -129,7 +280,8 @@ def extract_section_values(section_index):
         }
 
 
-def fetch_prompt_context_array(question, pinecone_index, namespace, host_url=None, filters={}, unsure_msg="I don't know", buckets=[]):
+@traced("fetch_prompt_context_array")
+def fetch_prompt_context_array(question, pinecone_index, namespace, host_url=None, filters={}, unsure_msg="I don't know", buckets=[], query_embedding=None):
     """
         This function queries a Pinecone index to find the most relevant document sections based on the provided question.
         It processes the results, ensuring that the total token count does not exceed the maximum allowed by the ChatGPT model.
@@ -143,6 +295,7 @@ def fetch_prompt_context_array(question, pinecone_index, namespace, host_url=Non
             filters (dict, optional): Additional metadata filters to apply to the query. Default is an empty dictionary.
             unsure_msg (str, optional): A fallback message to use if no relevant sections are found. Default is "I don't know".
             buckets (list, optional): A list of buckets to filter results by bucket ID and sort by bucket priority. Default is an empty list.
+            query_embedding (list, optional): The embedding of the question, if it was already computed. Default is None.
 
         Returns:
             list: A list of dictionaries containing the relevant document sections and their metadata. Each dictionary includes:
@@ -159,42 +312,77 @@ def fetch_prompt_context_array(question, pinecone_index, namespace, host_url=Non
     """
     if host_url is None:
         return ""
-    most_relevant_document_sections = query_from_pinecone(pinecone_index, namespace, question, host_url=host_url, filters=filters, buckets=buckets)
+    most_relevant_document_sections = query_from_pinecone(pinecone_index, namespace, question, host_url=host_url, filters=filters, buckets=buckets, query_embedding=query_embedding)
+    return pack_prompt_context(most_relevant_document_sections, unsure_msg, buckets)
+
+
+@traced("fetch_prompt_context_array_async")
+async def fetch_prompt_context_array_async(question, pinecone_index, namespace, host_url=None, filters={}, unsure_msg="I don't know", buckets=[], query_embedding=None):
+    """
+        Async variant of fetch_prompt_context_array, takes the same arguments.
+    """
+    if host_url is None:
+        return ""
+    most_relevant_document_sections = await query_from_pinecone_async(pinecone_index, namespace, question, host_url=host_url, filters=filters, buckets=buckets, query_embedding=query_embedding)
+    return pack_prompt_context(most_relevant_document_sections, unsure_msg, buckets)
+
+
+def pack_prompt_context(most_relevant_document_sections, unsure_msg="I don't know", buckets=[]):
+    """
+        Picks the sections that maximize the total relevance within CHATGPT_MAX_TOKENS (see pack_sections),
+        in the order they were retrieved. The reason every section was chosen or rejected is logged in VECTORS_INFO.
+
+        Args:
+            most_relevant_document_sections (list): The sorted matches returned by query_from_pinecone.
+            unsure_msg (str, optional): A fallback message to use if no relevant sections are found. Default is "I don't know".
+            buckets (list, optional): A list of buckets with their priorities. Default is an empty list.
+
+        Returns:
+            list: The chosen sections with their metadata, see fetch_prompt_context_array.
+    """
+    try:
+        reasons = pack_sections(most_relevant_document_sections, CHATGPT_MAX_TOKENS, buckets)
+    except Exception as e:
+        log("Error in pack_sections", traceback.format_exc())
+        reasons = greedy_pack_sections(most_relevant_document_sections, CHATGPT_MAX_TOKENS)
 
     chosen_sections = []
     chosen_sections_len = 0
     vector_ids = []
     vector_info = []
-    for _, section_index in enumerate(most_relevant_document_sections):
+    for section_index, (reason, details) in zip(most_relevant_document_sections, reasons):
         metadata:dict = section_index.get("metadata", {})
         tokens_count = metadata.get("tokens", 0)
         vector_id = int(metadata.get("id", section_index.get('id', -1)))
-        #  Check if adding this section would exceed the max token limit
-        if (chosen_sections_len + tokens_count) > CHATGPT_MAX_TOKENS:
-            continue
-        chosen_sections_len += tokens_count
         try:
-            vector_ids.append(vector_id)
-            vector_info.append({  
+            vector_info.append({
                 "vector_id": vector_id,
                 "bucket": next((bucket.get('title', None) for bucket in buckets if
                                 int(bucket.get("id", -1)) == int(metadata.get("bucket_id", -2))),
                                 "Bucket Not Used"),
                 "score": section_index.get("score", None),
-                "tokens_count": metadata.get("tokens", None)
+                "tokens_count": metadata.get("tokens", None),
+                "chosen": reason == CHOSEN,
+                "reason": reason,
+                **details,
               })
         except:
-            log("Error in fetch_prompt_context_array (appending vector id and info)", traceback.format_exc())
+            log("Error in fetch_prompt_context_array (appending vector info)", traceback.format_exc())
+        if reason != CHOSEN:
+            continue
+        chosen_sections_len += tokens_count
+        vector_ids.append(vector_id)
         # TODO: If metadata doesn't have text / empty text, save it in vector_id list and fetch it from DB.
         chosen_sections.append({**metadata,"score": section_index.get("score", 0), "id": vector_id})
-        if (CHATGPT_MAX_TOKENS - chosen_sections_len) < MAX_TOKEN_BUFFER:
-            break
 
     # log the number of tokens used
-    log(f"--total_tokens_used: {chosen_sections_len}")
+    log(f"--total_tokens_used: {chosen_sections_len}, sections: {len(chosen_sections)}/{len(most_relevant_document_sections)}")
     add_message_source_to_g(TOTAL_TOKENS_USED, chosen_sections_len)
     add_message_source_to_g(VECTOR_IDS, vector_ids)
     add_message_source_to_g(VECTORS_INFO, vector_info)
+    set_span_attributes(sections_fetched=len(most_relevant_document_sections), sections_used=len(chosen_sections),
+                        tokens_used=chosen_sections_len,
+                        near_duplicates=sum(1 for reason, _ in reasons if reason == NEAR_DUPLICATE))
     if len(chosen_sections) == 0:
         return [{"read_more_link": "", "score": "", "id": -1,
                 "text": SEPARATOR + unsure_msg
@@ -202,6 +390,26 @@ def fetch_prompt_context_array(question, pinecone_index, namespace, host_url=Non
 
     return chosen_sections
 
+
+def greedy_pack_sections(most_relevant_document_sections, budget):
+    """
+        Previous packing, kept as a fallback: the sections that fit, in order, until less than MAX_TOKEN_BUFFER is left.
+
+        Returns:
+            list: One (reason, details) tuple per section, see pack_sections.
+    """
+    reasons = []
+    used = 0
+    for section_index in most_relevant_document_sections:
+        tokens_count = section_index.get("metadata", {}).get("tokens", 0)
+        if (budget - used) < MAX_TOKEN_BUFFER or used + tokens_count > budget:
+            reasons.append((OVER_BUDGET, {}))
+            continue
+        used += tokens_count
+        reasons.append((CHOSEN, {}))
+    return reasons
+
+
 def calculate_total_tokens_fetched(most_relevant_document_sections):
     """
         This function iterates over a list of document sections, extracts the token count from each section's metadata,
@@ -212,16 +420,18 @@ def calculate_total_tokens_fetched(most_relevant_document_sections):
                 Each section dictionary should have a 'metadata' key containing a 'tokens' entry.
 
         Returns:
-            None
+            int or None: The total number of tokens, None if it could not be calculated.
     """
     try:
         total_tokens_fetched = sum([int(section_index.get('metadata',{}).get('tokens', 0)) for section_index in most_relevant_document_sections])
         log(f"--total_tokens_fetched: {total_tokens_fetched}")
         add_message_source_to_g(TOTAL_TOKENS_FETCHED, total_tokens_fetched)
+        return total_tokens_fetched
     except:
         log("Error in calculate_total_tokens_fetched", traceback.format_exc())
+        return None
 
-def fetch_prompt_context(question, pinecone_index, namespace, host_url=None, filters=None, unsure_msg="", buckets=[]):
+def fetch_prompt_context(question, pinecone_index, namespace, host_url=None, filters=None, unsure_msg="", buckets=[], query_embedding=None):
     """
         This function checks if the specified Pinecone index exists, then fetches the most relevant document sections
         for the input question. It processes the sections to ensure they do not exceed the maximum token limit and
@@ -235,6 +445,7 @@ def fetch_prompt_context(question, pinecone_index, namespace, host_url=None, fil
             filters (dict, optional): Additional metadata filters to apply to the query. Default is None.
             unsure_msg (str, optional): A fallback message to use if no relevant sections are found. Default is an empty string.
             buckets (list, optional): A list of buckets to filter results by bucket ID and sort by bucket priority. Default is an empty list.
+            query_embedding (list, optional): The embedding of the question, if it was already computed. Default is None.
 
         Returns:
             tuple: A tuple containing:
@@ -253,7 +464,7 @@ def fetch_prompt_context(question, pinecone_index, namespace, host_url=None, fil
         if not check_index_exists(pinecone_index):
             raise Exception(f"Index {pinecone_index} does not exist")            
             
-        chosen_sections = fetch_prompt_context_array(question, pinecone_index, namespace, host_url, filters, unsure_msg, buckets)
+        chosen_sections = fetch_prompt_context_array(question, pinecone_index, namespace, host_url, filters, unsure_msg, buckets, query_embedding)
         
         return chosen_sections
     except Exception as e:
@@ -261,6 +472,20 @@ def fetch_prompt_context(question, pinecone_index, namespace, host_url=None, fil
         raise e
 
 
+async def fetch_prompt_context_async(question, pinecone_index, namespace, host_url=None, filters=None, unsure_msg="", buckets=[], query_embedding=None):
+    """
+        Async variant of fetch_prompt_context, takes the same arguments.
+    """
+    try:
+        if not await asyncio.to_thread(check_index_exists, pinecone_index):
+            raise Exception(f"Index {pinecone_index} does not exist")
+
+        return await fetch_prompt_context_array_async(question, pinecone_index, namespace, host_url, filters, unsure_msg, buckets, query_embedding)
+    except Exception as e:
+        log("Error in fetch_prompt_context_async", traceback.format_exc())
+        raise e
+
+
 # def query_pinecone_with_buckets(pinecone_index, namespace, question, host_url, filters, bucket_ids, _top_k=5):
 #     most_relevant_document_sections = []
 #     for bucket_id in bucket_ids:
@@ -3,12 +3,19 @@ module.exports = {
     {
     name   : "flask",
     // -w means workers (2 x CPU Cores) + 1, see how many threads your prod server has in each Core
-    script: "./venv/bin/gunicorn -w 15 --threads 2 -b 0.0.0.0:8000 app:app",
+    script: "./venv/bin/gunicorn -c gunicorn.conf.py -w 15 --threads 2 -b 0.0.0.0:8000 app:app",
     max_restarts:10,
   },
   {
-    name   : "redis-logging-queue",
-    script: "./venv/bin/rq worker logging_queue",
+    name   : "asgi",
+    // async entry point (asgi.py), one process holds many concurrent conversations
+    script: "./venv/bin/uvicorn asgi:app --host 0.0.0.0 --port 8001 --workers 2",
+    max_restarts:10,
+  },
+  {
+    name   : "redis-analytics-queue",
+    // analytics jobs (utils/analytics_jobs.py), minutes of CPU each, kept away from the web workers
+    script: "./venv/bin/rq worker analytics_queue",
     max_restarts:10,
   },
 ]
@@ -14,3 +14,14 @@ DEBUG = True # Should be true if testing locally
 
 VECTOR_DATAS_DIR = "vector_datas"
 
+# Uploaded messages and results of the analytics jobs, shared by the web and analytics queue workers
+ANALYTICS_JOBS_DIR = "analytics_jobs"
+# Clusters and daily rollups of the analytics of every organization (utils/analytics_state.py)
+ANALYTICS_STATE_DIR = "analytics_state"
+
+# Pinecone indexes whose connections are opened when a worker starts, empty means every index
+PINECONE_WARM_INDEXES = []
+
+# Tracing of the request stages (utils/tracing.py): "file" (logs/traces_*.jsonl), "otlp" (collector) or None
+TRACING_EXPORTER = "file"
+TRACING_OTLP_ENDPOINT = "http://localhost:4318/v1/traces"
@@ -1,15 +1,12 @@
-import os
-
 import numpy as np
-from dotenv import load_dotenv
 from flask import request, jsonify
-from langchain import OpenAI
-from scipy.spatial.distance import cosine
-
-from ml_models.gpt_helpers import create_embedding
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
 
-load_dotenv()
-client = OpenAI(api_key=os.environ.get('OPENAI_KEY'), organization=os.environ.get('OPENAI_ORG'))
+from constants.misc import (ANALYTICS_EMBEDDING_CHUNK, QUESTION_CLUSTER_BLOCK_SIZE, QUESTION_CLUSTER_IVF_MIN, QUESTION_CLUSTER_KMEANS_ITERATIONS,
+                            QUESTION_CLUSTER_KMEANS_SAMPLE, QUESTION_CLUSTER_NPROBE, QUESTION_CLUSTER_SIMILARITY)
+from ml_models.gpt_helpers import create_embeddings
+from pinecone_related.local_index import normalize_rows, train_kmeans
 
 
 def is_unanswered(text):
@@ -88,73 +85,172 @@ def get_top_questions_by_times_asked(qna_list, top_n=10):
     return sorted(qna_list, key=lambda x: x["times_asked"], reverse=True)[:top_n]
 
 
-def generate_unique_questions(qna_list):
-    import pandas as pd
-    df = pd.DataFrame(qna_list)
-    df['ada_embedding'] = df["question"].apply(lambda x: create_embedding(x))
-    df['identifier'] = np.nan
-    df.reset_index(inplace=True)
-
-    def search_question_in_dataframe(row):
-        question = row['question']
-        embedding = create_embedding(question)
-        # TODO: Compare embedding with df['ada_embedding'] and get second most matching row
-        df['similarity_score'] = df['ada_embedding'].apply(lambda x: compare_cosine_similarity(embedding, x))
-
-        top_matches = df.sort_values('similarity_score', ascending=False).head(2)
-
-        if top_matches.iloc[1]["similarity_score"] >= 0.88:
-            if not pd.isna(df.at[top_matches.index[0], 'identifier']):
-                df.at[top_matches.index[1], 'identifier'] = df['identifier'].iloc[top_matches.index[0]]
-            elif not pd.isna(df.at[top_matches.index[1], 'identifier']):
-                df.at[top_matches.index[0], 'identifier'] = df['identifier'].iloc[top_matches.index[1]]
-            else:
-                random_num = np.random.rand()
-                df.at[top_matches.index[0], 'identifier'] = random_num
-                df.at[top_matches.index[1], 'identifier'] = random_num
-        else:
-            random_num = np.random.rand()
-            df.at[top_matches.index[0], 'identifier'] = random_num
-
-        if row["index"] not in [top_matches.index[0], top_matches.index[1]]:
-            df.at[row["index"], 'identifier'] = df['identifier'].iloc[top_matches.index[0]]
+def link_components(rows, columns, mask, edges):
+    """
+        Reduces the similar pairs of a block to one edge per question, from each question to the first of its group
+        within the block, so that large groups of near duplicates do not produce a quadratic number of edges.
+
+        Args:
+            rows (np.ndarray): Indexes of the questions of the rows of the block.
+            columns (np.ndarray): Indexes of the questions of the columns of the block.
+            mask (np.ndarray): Boolean matrix of the similar pairs of the block.
+            edges (list): The (questions, their group's first question) arrays found so far, extended in place.
+    """
+    pair_rows, pair_columns = np.nonzero(mask)
+    if len(pair_rows) == 0:
+        return
+    nodes, inverse = np.unique(np.concatenate([rows[pair_rows], columns[pair_columns]]), return_inverse=True)
+    graph = coo_matrix((np.ones(len(pair_rows), dtype=np.int8), (inverse[:len(pair_rows)], inverse[len(pair_rows):])),
+                       shape=(len(nodes), len(nodes)))
+    _, labels = connected_components(graph, directed=False)
+    _, first = np.unique(labels, return_index=True)
+    edges.append((nodes, nodes[first][labels]))
+
+
+def exact_similar_pairs(vectors, threshold, edges):
+    """
+        Compares every pair of questions, by blocks of QUESTION_CLUSTER_BLOCK_SIZE rows and columns of the upper triangle.
+    """
+    indexes = np.arange(len(vectors))
+    for start in range(0, len(vectors), QUESTION_CLUSTER_BLOCK_SIZE):
+        rows = indexes[start:start + QUESTION_CLUSTER_BLOCK_SIZE]
+        for column_start in range(start, len(vectors), QUESTION_CLUSTER_BLOCK_SIZE):
+            columns = indexes[column_start:column_start + QUESTION_CLUSTER_BLOCK_SIZE]
+            mask = vectors[rows] @ vectors[columns].T >= threshold
+            if column_start == start:
+                mask &= columns[np.newaxis, :] > rows[:, np.newaxis]
+            link_components(rows, columns, mask, edges)
+
+
+def ivf_similar_pairs(vectors, threshold, edges):
+    """
+        Compares every question only to the questions of its QUESTION_CLUSTER_NPROBE nearest k-means lists (IVF), about
+        sqrt(n) lists of sqrt(n) questions: approximate, but n * sqrt(n) instead of n ** 2 comparisons.
+    """
+    nlist = int(np.sqrt(len(vectors)))
+    sample = np.random.default_rng(0).choice(len(vectors), min(QUESTION_CLUSTER_KMEANS_SAMPLE, len(vectors)), replace=False)
+    centroids, _ = train_kmeans(vectors[np.sort(sample)], nlist, QUESTION_CLUSTER_KMEANS_ITERATIONS)
+    nprobe = min(QUESTION_CLUSTER_NPROBE, nlist)
+    probes = []
+    assignments = []
+    for start in range(0, len(vectors), QUESTION_CLUSTER_BLOCK_SIZE):
+        scores = vectors[start:start + QUESTION_CLUSTER_BLOCK_SIZE] @ centroids.T
+        probes.append(np.argpartition(-scores, nprobe - 1, axis=1)[:, :nprobe])
+        assignments.append(np.argmax(scores, axis=1))
+    probes = np.concatenate(probes)
+    assignments = np.concatenate(assignments)
+
+    members = np.argsort(assignments, kind="stable")
+    member_bounds = np.searchsorted(assignments[members], np.arange(nlist + 1))
+    probe_lists = probes.ravel()
+    probing = np.repeat(np.arange(len(vectors)), nprobe)[np.argsort(probe_lists, kind="stable")]
+    probe_bounds = np.searchsorted(np.sort(probe_lists), np.arange(nlist + 1))
+    for ivf_list in range(nlist):
+        columns = members[member_bounds[ivf_list]:member_bounds[ivf_list + 1]]
+        queries = probing[probe_bounds[ivf_list]:probe_bounds[ivf_list + 1]]
+        if len(columns) == 0:
+            continue
+        for start in range(0, len(queries), QUESTION_CLUSTER_BLOCK_SIZE):
+            rows = queries[start:start + QUESTION_CLUSTER_BLOCK_SIZE]
+            mask = (vectors[rows] @ vectors[columns].T >= threshold) & (rows[:, np.newaxis] != columns[np.newaxis, :])
+            link_components(rows, columns, mask, edges)
+
+
+def cluster_embeddings(embeddings, threshold=QUESTION_CLUSTER_SIMILARITY):
+    """
+        Groups near duplicate questions: two questions whose embeddings have a cosine similarity of at least threshold
+        are in the same group, and so are their groups (connected components, as a union-find would merge them).
+        Similarities are float32 matrix products by blocks, over every pair below QUESTION_CLUSTER_IVF_MIN questions,
+        over the pairs of neighbouring k-means lists above.
 
-    df.apply(search_question_in_dataframe, axis=1)
+        Args:
+            embeddings (list or np.ndarray): One embedding per question.
+            threshold (float, optional): Minimum cosine similarity. Defaults to QUESTION_CLUSTER_SIMILARITY.
 
-    df.drop(columns=["ada_embedding", "similarity_score"])
+        Returns:
+            np.ndarray: The group of every question, numbered from 0.
+    """
+    vectors = normalize_rows(np.asarray(embeddings, dtype=np.float32))
+    edges = []
+    if len(vectors) >= QUESTION_CLUSTER_IVF_MIN:
+        ivf_similar_pairs(vectors, threshold, edges)
+    else:
+        exact_similar_pairs(vectors, threshold, edges)
+    if not edges:
+        return np.arange(len(vectors))
+    sources = np.concatenate([nodes for nodes, _ in edges])
+    targets = np.concatenate([firsts for _, firsts in edges])
+    graph = coo_matrix((np.ones(len(sources), dtype=np.int8), (sources, targets)), shape=(len(vectors), len(vectors)))
+    return connected_components(graph, directed=False)[1]
+
+
+def generate_unique_questions(qna_list, progress=None):
+    """
+        Merges the near duplicate questions of qna_list. Identical questions are embedded and compared once.
 
-    unique_identifier_dicts = []
-    seen_identifiers = set()
+        Args:
+            qna_list (list): The questions, see convert_to_qna_chucks.
+            progress (callable, optional): Called with the stage and its fraction done, see analyze_messages.
+                Defaults to None.
 
-    for d in df.to_dict(orient='records'):
-        identifier = d['identifier']
-        if identifier not in seen_identifiers:
-            d['times_asked'] = 1
-            unique_identifier_dicts.append(d)
-            seen_identifiers.add(identifier)
+        Returns:
+            list: The first question of every group, in the order of qna_list, with its "index" in qna_list, the
+            "identifier" of its group and the number of questions of the group as "times_asked".
+    """
+    if not qna_list:
+        return []
+    texts, text_of_question = np.unique([qna["question"] for qna in qna_list], return_inverse=True)
+    texts = texts.tolist()
+    embeddings = []
+    for start in range(0, len(texts), ANALYTICS_EMBEDDING_CHUNK):
+        embeddings.extend(create_embeddings(texts[start:start + ANALYTICS_EMBEDDING_CHUNK]))
+        if progress:
+            progress("embedding", 0.1 + 0.6 * len(embeddings) / len(texts))
+    if progress:
+        progress("clustering", 0.7)
+    groups = cluster_embeddings(embeddings)[text_of_question]
+
+    unique_questions = {}
+    for index, (qna, group) in enumerate(zip(qna_list, groups.tolist())):
+        if group in unique_questions:
+            unique_questions[group]["times_asked"] += 1
         else:
-            for index, unique_d in enumerate(unique_identifier_dicts):
-                if unique_d.get("identifier") == identifier:
-                    unique_identifier_dicts[index]["times_asked"] += 1
-                    break
-
-    return unique_identifier_dicts
+            unique_questions[group] = {"index": index, **qna, "identifier": group, "times_asked": 1}
+    return list(unique_questions.values())
 
 
-def compare_cosine_similarity(answer_embed, context_embed):
-    return 1 - cosine(answer_embed, context_embed)
+def analyze_messages(messages, progress=None):
+    """
+        The analytics of the messages of an organization: its most asked questions and its worst answered ones.
 
+        Args:
+            messages (list): The messages, in the order of the conversations.
+            progress (callable, optional): Called with the stage ("questions", "embedding", "clustering", "ranking")
+                and the fraction of the analysis done, between 0 and 1. Defaults to None.
 
-def analysis_main():
-    req_data = request.get_json()
-    qna_list = convert_to_qna_chucks(req_data['messages'])
+        Returns:
+            dict: "top_unanswered" and "top_questions".
+    """
+    if progress:
+        progress("questions", 0)
+    qna_list = convert_to_qna_chucks(messages)
 
-    merged_msgs = generate_unique_questions(qna_list)
+    merged_msgs = generate_unique_questions(qna_list, progress)
 
+    if progress:
+        progress("ranking", 0.95)
     # merged_messages = merge_similar_questions_using_nlp(qna_list)  # more accurate
     top_messages = get_top_questions_by_times_asked(merged_msgs, 10)
 
     ## Aggregating the data
     aggregated_data = get_top_negative_score_questions(merged_msgs, 10)
 
-    return jsonify({"top_unanswered": aggregated_data, "top_questions": top_messages})
+    return {"top_unanswered": aggregated_data, "top_questions": top_messages}
+
+
+def analysis_main():
+    """
+        Analyses the messages of the request while the client waits, see utils/analytics_jobs.py for large histories.
+    """
+    req_data = request.get_json()
+    return jsonify(analyze_messages(req_data['messages']))
@@ -0,0 +1,227 @@
+"""
+    Analytics jobs: the messages of an organization are uploaded in chunks, then analysed by a worker process
+    (the RQ analytics_queue, or the analytics lane of the web worker in DEBUG) while the client polls the job.
+
+    Every job is a directory settings.ANALYTICS_JOBS_DIR/<job_id>/, shared by the web and queue workers:
+        job.json            status, stage, progress, chunks received, number of messages, timestamps, error
+        chunks/<index>.json the messages of a chunk, deleted once the job ran
+        result.json         {"analysis": ..., "report": ...}, see run_job
+"""
+import json
+import os
+import shutil
+import time
+import traceback
+import uuid
+from pathlib import Path
+
+import settings
+from constants.misc import ANALYTICS_JOB_TIMEOUT, ANALYTICS_JOB_TTL
+from utils.analytics import analyze_messages
+from utils.analytics_state import get_report, ingest_messages
+from utils.executor import LaneFullError
+from utils.helpers import analytics_queue, log, start_background_thread
+
+UPLOADING = "uploading"
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+
+class JobError(Exception):
+    """
+        A request that does not fit the state of the job, answered with a 4xx status.
+    """
+
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+
+def get_jobs_dir():
+    directory = Path(settings.ANALYTICS_JOBS_DIR)
+    return directory if directory.is_absolute() else Path(settings.cwd) / directory
+
+
+def get_job_dir(job_id):
+    # Job ids are generated by create_job, anything else could escape the jobs directory
+    if not isinstance(job_id, str) or not job_id.isalnum():
+        raise JobError(f"Unknown analytics job {job_id}", 404)
+    return get_jobs_dir() / job_id
+
+
+def write_json(path, data):
+    # Written to a temporary file first, so that a reader in another process never sees half a file
+    temporary = path.with_name(f".{path.name}.{os.getpid()}.tmp")
+    with open(temporary, "w") as file:
+        json.dump(data, file)
+    os.replace(temporary, path)
+
+
+def get_job(job_id):
+    """
+        Returns the state of a job. A job running for more than ANALYTICS_JOB_TIMEOUT seconds was killed by the queue
+        worker without updating its state, it is reported as failed.
+
+        Raises:
+            JobError: If there is no such job.
+    """
+    try:
+        with open(get_job_dir(job_id) / "job.json") as file:
+            job = json.load(file)
+    except FileNotFoundError:
+        raise JobError(f"Unknown analytics job {job_id}", 404)
+    if job["status"] == RUNNING and time.time() - job.get("started_at", job["updated_at"]) > ANALYTICS_JOB_TIMEOUT:
+        return {**job, "status": FAILED, "stage": None,
+                "error": f"Not done within {ANALYTICS_JOB_TIMEOUT} seconds"}
+    return job
+
+
+def update_job(job_id, **changes):
+    job = {**get_job(job_id), **changes, "updated_at": time.time()}
+    write_json(get_job_dir(job_id) / "job.json", job)
+    return job
+
+
+def delete_expired_jobs():
+    """
+        Deletes the jobs not updated for ANALYTICS_JOB_TTL seconds, results included.
+    """
+    jobs_dir = get_jobs_dir()
+    if not jobs_dir.is_dir():
+        return
+    for job_dir in jobs_dir.iterdir():
+        try:
+            if time.time() - (job_dir / "job.json").stat().st_mtime > ANALYTICS_JOB_TTL:
+                shutil.rmtree(job_dir, ignore_errors=True)
+        except FileNotFoundError:
+            continue
+
+
+def create_job(org_id=None):
+    """
+        Creates a job waiting for its chunks.
+
+        Args:
+            org_id (int, optional): The organization whose messages are analysed. Defaults to None.
+
+        Returns:
+            dict: The job, with its "job_id".
+    """
+    delete_expired_jobs()
+    job_id = uuid.uuid4().hex
+    job_dir = get_job_dir(job_id)
+    (job_dir / "chunks").mkdir(parents=True)
+    job = {"job_id": job_id, "org_id": org_id, "status": UPLOADING, "stage": None, "progress": 0, "chunks": [],
+           "messages": 0, "error": None, "created_at": time.time(), "updated_at": time.time()}
+    write_json(job_dir / "job.json", job)
+    return job
+
+
+def add_chunk(job_id, index, messages):
+    """
+        Stores a chunk of messages. Chunks are analysed in the order of their index, a chunk sent again replaces the
+        previous one, so that a failed upload can be retried.
+
+        Args:
+            job_id (str): The job.
+            index (int): The position of the chunk, from 0.
+            messages (list): The messages of the chunk, in the format of convert_to_qna_chucks.
+
+        Returns:
+            dict: The job.
+    """
+    job = get_job(job_id)
+    if job["status"] != UPLOADING:
+        raise JobError(f"Analytics job {job_id} is {job['status']}, chunks can only be added before it starts", 409)
+    write_json(get_job_dir(job_id) / "chunks" / f"{index}.json", messages)
+    # Another worker may store a chunk at the same time, the list of chunks is read back from the directory
+    chunks = sorted(int(path.stem) for path in (get_job_dir(job_id) / "chunks").glob("*.json"))
+    return update_job(job_id, chunks=chunks)
+
+
+def start_job(job_id, chunks):
+    """
+        Queues the analysis of a job once its chunks are uploaded.
+
+        Args:
+            job_id (str): The job.
+            chunks (int): The number of chunks sent, all of them must have been received.
+
+        Returns:
+            dict: The job.
+
+        Raises:
+            JobError: If chunks are missing or the job already started.
+            LaneFullError: If the job runs in this process (DEBUG) and the analytics lane is full or shutting down.
+    """
+    job = get_job(job_id)
+    if job["status"] != UPLOADING:
+        raise JobError(f"Analytics job {job_id} is already {job['status']}", 409)
+    missing = sorted(set(range(chunks)) - set(job["chunks"]))
+    if missing:
+        raise JobError(f"Chunks {missing} of analytics job {job_id} were not received")
+    job = update_job(job_id, status=QUEUED, chunks=list(range(chunks)))
+    try:
+        if analytics_queue is not None:
+            analytics_queue.enqueue(run_job, job_id, job_timeout=ANALYTICS_JOB_TIMEOUT, description=f"analytics {job_id}")
+        elif not start_background_thread(run_job, job_id, lane="analytics"):
+            # The lane is shutting down, the job would stay queued forever
+            raise LaneFullError(f"Analytics job {job_id} could not be queued")
+    except Exception as e:
+        update_job(job_id, status=UPLOADING)
+        raise
+    return job
+
+
+def run_job(job_id):
+    """
+        Analyses the messages of a job, see analyze_messages, or adds them to the incremental analytics of its
+        organization (utils/analytics_state.py) when it has one. Run by the analytics queue worker.
+
+        The result always has both keys, exactly one of them set:
+            "analysis": analyze_messages of the messages of a job without org_id, its entries are questions of the
+                messages (message_id, chat_id, created_at, answer_vote, times_asked of their group...).
+            "report": get_report of the organization of a job with an org_id, its entries are question clusters
+                (times_asked, unanswered, vote_sum, negative_votes summed over the cluster).
+    """
+    try:
+        job = update_job(job_id, status=RUNNING, stage="loading", progress=0.05, started_at=time.time())
+        messages = []
+        for index in job["chunks"]:
+            with open(get_job_dir(job_id) / "chunks" / f"{index}.json") as file:
+                messages.extend(json.load(file))
+        update_job(job_id, messages=len(messages))
+
+        def progress(stage, value):
+            update_job(job_id, stage=stage, progress=round(0.1 + 0.85 * value, 3))
+
+        if job.get("org_id") is not None:
+            # Only the new messages are analysed, the report covers the whole history of the organization
+            progress("ingesting", 0)
+            ingest_messages(job["org_id"], messages)
+            result = {"analysis": None, "report": get_report(job["org_id"])}
+        else:
+            result = {"analysis": analyze_messages(messages, progress), "report": None}
+        write_json(get_job_dir(job_id) / "result.json", result)
+        shutil.rmtree(get_job_dir(job_id) / "chunks", ignore_errors=True)
+        update_job(job_id, status=DONE, stage=None, progress=1)
+        log(f"Analytics job {job_id} done, {len(messages)} messages")
+    except Exception as e:
+        log("Error in run_job", traceback.format_exc())
+        update_job(job_id, status=FAILED, error=str(e))
+
+
+def get_job_result(job_id):
+    """
+        Returns the result of a finished job.
+
+        Raises:
+            JobError: If the job is not done.
+    """
+    job = get_job(job_id)
+    if job["status"] != DONE:
+        raise JobError(f"Analytics job {job_id} is {job['status']}", 409)
+    with open(get_job_dir(job_id) / "result.json") as file:
+        return json.load(file)
@@ -0,0 +1,232 @@
+"""
+    Incremental analytics of an organization: the questions already analysed are kept as clusters and daily rollups,
+    so that new messages are only compared to the clusters and reports only read the rollups.
+
+    Every organization is a directory settings.ANALYTICS_STATE_DIR/<org_id>/:
+        state.json             last message id analysed, number of clusters, time of the last update
+        clusters.npz           per cluster: sum of the normalized embeddings of its questions (its centroid once
+                               normalized), number of questions, first question
+        rollups/<date>.npz     per cluster asked that day (columns): cluster, times_asked, unanswered, vote_sum,
+                               negative_votes
+"""
+import fcntl
+import json
+import os
+import re
+import time
+from contextlib import contextmanager
+from datetime import date
+from pathlib import Path
+
+import numpy as np
+
+import settings
+from constants.misc import QUESTION_CLUSTER_BLOCK_SIZE, QUESTION_CLUSTER_SIMILARITY
+from ml_models.gpt_helpers import create_embeddings
+from pinecone_related.local_index import normalize_rows
+from utils.analytics import cluster_embeddings, convert_to_qna_chucks
+from utils.helpers import log
+
+ROLLUP_COLUMNS = ["times_asked", "unanswered", "vote_sum", "negative_votes"]
+DATE_PATTERN = re.compile(r"\d{4}-\d{2}-\d{2}")
+
+
+def get_org_dir(org_id):
+    directory = Path(settings.ANALYTICS_STATE_DIR)
+    directory = directory if directory.is_absolute() else Path(settings.cwd) / directory
+    return directory / str(int(org_id))
+
+
+@contextmanager
+def org_lock(org_id):
+    """
+        Serializes the updates of an organization across processes.
+    """
+    org_dir = get_org_dir(org_id)
+    (org_dir / "rollups").mkdir(parents=True, exist_ok=True)
+    with open(org_dir / ".lock", "w") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield org_dir
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def save_npz(path, **arrays):
+    # np.savez adds .npz to names without it, the temporary name keeps it
+    temporary = path.with_name(f".{os.getpid()}.{path.name}")
+    np.savez(temporary, **arrays)
+    os.replace(temporary, path)
+
+
+def load_state(org_dir):
+    try:
+        with open(org_dir / "state.json") as file:
+            state = json.load(file)
+    except FileNotFoundError:
+        state = {"last_message_id": None, "clusters": 0, "updated_at": None}
+    try:
+        with np.load(org_dir / "clusters.npz") as clusters:
+            sums, counts, questions = clusters["sums"], clusters["counts"], clusters["questions"]
+    except FileNotFoundError:
+        sums, counts, questions = None, np.zeros(0, dtype=np.int64), np.zeros(0, dtype=str)
+    return state, sums, counts, questions
+
+
+def get_day(created_at):
+    """
+        The day of a message, from its created_at ("2024-03-01 10:00:00", "2024-03-01T10:00:00.000000Z"...).
+    """
+    match = DATE_PATTERN.match(str(created_at or ""))
+    return match.group(0) if match else date.today().isoformat()
+
+
+def assign_to_clusters(vectors, sums, threshold=QUESTION_CLUSTER_SIMILARITY):
+    """
+        The most similar existing cluster of every vector, -1 where no centroid is at least threshold similar.
+    """
+    if sums is None or len(sums) == 0:
+        return np.full(len(vectors), -1)
+    centroids = normalize_rows(sums)
+    assignments = []
+    for start in range(0, len(vectors), QUESTION_CLUSTER_BLOCK_SIZE):
+        similarities = vectors[start:start + QUESTION_CLUSTER_BLOCK_SIZE] @ centroids.T
+        best = np.argmax(similarities, axis=1)
+        assignments.append(np.where(similarities[np.arange(len(best)), best] >= threshold, best, -1))
+    return np.concatenate(assignments)
+
+
+def ingest_messages(org_id, messages):
+    """
+        Adds new messages to the analytics of an organization. Questions join the cluster of their most similar
+        centroid, the others are clustered together (see cluster_embeddings) into new clusters. Messages with an id up
+        to the last one analysed are skipped, so that a history can be sent again.
+
+        Args:
+            org_id (int): The organization.
+            messages (list): The messages, in the order of the conversations, see convert_to_qna_chucks.
+
+        Returns:
+            int: The number of new questions analysed.
+    """
+    with org_lock(org_id) as org_dir:
+        state, sums, counts, questions = load_state(org_dir)
+        last_message_id = state["last_message_id"]
+        qna_list = [qna for qna in convert_to_qna_chucks(messages)
+                    if last_message_id is None or qna["message_id"] > last_message_id]
+        if not qna_list:
+            return 0
+
+        texts, text_of_question = np.unique([qna["question"] for qna in qna_list], return_inverse=True)
+        vectors = normalize_rows(np.asarray(create_embeddings(texts.tolist()), dtype=np.float32))
+        clusters = assign_to_clusters(vectors, sums)
+
+        new = np.flatnonzero(clusters < 0)
+        if len(new):
+            groups = cluster_embeddings(vectors[new])
+            clusters[new] = len(counts) + groups
+            group_count = int(groups.max()) + 1
+            # The first question of a new cluster, in the order of the messages, names it
+            first_text = np.full(group_count, -1)
+            for text in text_of_question:
+                group = clusters[text] - len(counts)
+                if group >= 0 and first_text[group] < 0:
+                    first_text[group] = text
+            questions = np.concatenate([questions, texts[first_text]])
+            counts = np.concatenate([counts, np.zeros(group_count, dtype=np.int64)])
+            new_sums = np.zeros((group_count, vectors.shape[1]), dtype=np.float32)
+            sums = new_sums if sums is None else np.concatenate([sums, new_sums])
+
+        question_clusters = clusters[text_of_question]
+        np.add.at(sums, question_clusters, vectors[text_of_question])
+        np.add.at(counts, question_clusters, 1)
+        save_npz(org_dir / "clusters.npz", sums=sums, counts=counts, questions=questions)
+
+        days = {}
+        for qna, cluster in zip(qna_list, question_clusters.tolist()):
+            vote = qna.get("answer_vote")
+            vote = vote if isinstance(vote, int) else 0
+            days.setdefault(get_day(qna.get("created_at")), []).append(
+                (cluster, 1, int(bool(qna.get("unanswered"))), vote, int(vote < 0)))
+        for day, rows in days.items():
+            add_to_rollup(org_dir / "rollups" / f"{day}.npz", np.asarray(rows, dtype=np.int64))
+
+        newest = max(qna["message_id"] for qna in qna_list)
+        state = {"last_message_id": newest if last_message_id is None else max(last_message_id, newest),
+                 "clusters": len(counts), "updated_at": time.time()}
+        with open(org_dir / ".state.json.tmp", "w") as file:
+            json.dump(state, file)
+        os.replace(org_dir / ".state.json.tmp", org_dir / "state.json")
+        log(f"Analytics of org {org_id}: {len(qna_list)} questions added, {len(new)} in new clusters")
+        return len(qna_list)
+
+
+def add_to_rollup(path, rows):
+    """
+        Adds (cluster, times_asked, unanswered, vote_sum, negative_votes) rows to a daily rollup, one row per cluster.
+    """
+    columns = [rows[:, 0]] + [rows[:, position + 1] for position in range(len(ROLLUP_COLUMNS))]
+    if path.exists():
+        with np.load(path) as rollup:
+            columns = [np.concatenate([rollup[name], column])
+                       for name, column in zip(["cluster"] + ROLLUP_COLUMNS, columns)]
+    clusters, inverse = np.unique(columns[0], return_inverse=True)
+    totals = {name: np.bincount(inverse, weights=column, minlength=len(clusters)).astype(np.int64)
+              for name, column in zip(ROLLUP_COLUMNS, columns[1:])}
+    save_npz(path, cluster=clusters.astype(np.int32), **totals)
+
+
+def read_rollups(org_dir, start=None, end=None):
+    """
+        Totals of every cluster over the days from start to end (ISO dates, both included, None for no bound).
+
+        Returns:
+            dict: One array per column of ROLLUP_COLUMNS, indexed by cluster.
+    """
+    clusters = []
+    columns = {name: [] for name in ROLLUP_COLUMNS}
+    for path in sorted((org_dir / "rollups").glob("*.npz")):
+        day = path.stem
+        if (start and day < start) or (end and day > end):
+            continue
+        with np.load(path) as rollup:
+            clusters.append(rollup["cluster"])
+            for name in ROLLUP_COLUMNS:
+                columns[name].append(rollup[name])
+    if not clusters:
+        return {name: np.zeros(0, dtype=np.int64) for name in ROLLUP_COLUMNS}
+    clusters = np.concatenate(clusters)
+    return {name: np.bincount(clusters, weights=np.concatenate(values)).astype(np.int64)
+            for name, values in columns.items()}
+
+
+def get_report(org_id, start=None, end=None, limit=10):
+    """
+        The most asked questions and the worst answered ones of an organization, from its rollups only.
+        A question is scored like get_top_negative_score_questions, summed over the times it was asked:
+        -2.5 per unanswered question and -1 per negative vote.
+
+        Args:
+            org_id (int): The organization.
+            start (str, optional): First day, ISO date. Defaults to None.
+            end (str, optional): Last day, ISO date. Defaults to None.
+            limit (int, optional): Questions per list. Defaults to 10.
+
+        Returns:
+            dict: "top_unanswered" and "top_questions", and the "last_message_id" analysed.
+    """
+    org_dir = get_org_dir(org_id)
+    state, _, _, questions = load_state(org_dir)
+    totals = read_rollups(org_dir, start, end)
+    scores = -2.5 * totals["unanswered"] - totals["negative_votes"]
+
+    def entry(cluster):
+        return {"identifier": int(cluster), "question": str(questions[cluster]),
+                **{name: int(totals[name][cluster]) for name in ROLLUP_COLUMNS}, "score": float(scores[cluster])}
+
+    asked = np.flatnonzero(totals["times_asked"])
+    top_questions = asked[np.argsort(-totals["times_asked"][asked], kind="stable")][:limit]
+    top_unanswered = asked[np.argsort(scores[asked], kind="stable")][:limit]
+    return {"top_unanswered": [entry(cluster) for cluster in top_unanswered],
+            "top_questions": [entry(cluster) for cluster in top_questions],
+            "last_message_id": state["last_message_id"]}
@@ -0,0 +1,190 @@
+import threading
+import time
+from collections import OrderedDict
+
+from constants.cache_related import NAMESPACE_GENERATION_TTL
+from utils.helpers import log, redis_conn
+
+# Every cache registers itself here, so that their counters can be reported together
+caches = {}
+
+
+class TTLCache:
+    """
+        Thread safe in-process LRU cache, bounded by number of entries, with a TTL per entry and hit/miss counters.
+
+        Args:
+            name (str): Name of the cache, used in the stats.
+            maxsize (int): Maximum number of entries, the least recently used entry is evicted first.
+            ttl (int or float): Seconds an entry stays valid. None means entries never expire.
+    """
+
+    def __init__(self, name, maxsize, ttl=None):
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        caches[name] = self
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+            value, expires_at = entry
+            if expires_at is not None and expires_at < time.monotonic():
+                del self._entries[key]
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        expires_at = time.monotonic() + ttl if ttl is not None else None
+        with self._lock:
+            self._entries[key] = (value, expires_at)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        return {
+            "size": len(self._entries),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+
+class RedisCache:
+    """
+        Shared cache tier on the Redis server used by the analytics queue. Values are stored as bytes.
+        Every call is a no-op (a miss) when Redis is not configured (DEBUG) or not reachable.
+
+        Args:
+            name (str): Name of the cache, used in the stats and as key prefix.
+            ttl (int): Seconds an entry stays valid.
+    """
+
+    def __init__(self, name, ttl):
+        self.name = name
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.errors = 0
+        caches[name] = self
+
+    def _key(self, key):
+        return f"cache:{self.name}:{key}"
+
+    def get(self, key):
+        if redis_conn is None:
+            return None
+        try:
+            value = redis_conn.get(self._key(key))
+        except Exception as e:
+            # Not logged as an error, every cache read would ship an error log to Laravel while Redis is down
+            log(f"Redis cache {self.name} unavailable: {e}")
+            self.errors += 1
+            return None
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    def set(self, key, value):
+        if redis_conn is None:
+            return
+        try:
+            redis_conn.set(self._key(key), value, ex=self.ttl)
+        except Exception as e:
+            log(f"Redis cache {self.name} unavailable: {e}")
+            self.errors += 1
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "errors": self.errors,
+        }
+
+
+def get_cache_stats():
+    """
+        Returns the counters of every cache of this process.
+    """
+    return {name: cache.stats() for name, cache in caches.items()}
+
+
+# Namespace generations, bumped whenever the vectors of a namespace are re-synced.
+# Caches include the generation in their keys, so bumping it invalidates their entries in every process.
+namespace_generations = TTLCache("namespace_generations", maxsize=10000, ttl=NAMESPACE_GENERATION_TTL)
+local_generations = {}
+
+
+def get_namespace_generation(pinecone_index, namespace):
+    """
+        Returns the current generation of a namespace. Shared through Redis, with a short in-process copy.
+
+        Args:
+            pinecone_index (str): The name of the Pinecone index.
+            namespace (str): The namespace within the index.
+
+        Returns:
+            int: The generation of the namespace.
+    """
+    key = f"{pinecone_index}:{namespace}"
+    generation = namespace_generations.get(key)
+    if generation is not None:
+        return generation
+
+    generation = local_generations.get(key, 0)
+    if redis_conn is not None:
+        try:
+            generation = int(redis_conn.get(f"namespace_generation:{key}") or 0)
+        except Exception as e:
+            log(f"Redis unavailable for namespace generation of {key}: {e}")
+    namespace_generations.set(key, generation)
+    return generation
+
+
+def bump_namespace_generation(pinecone_index, namespace):
+    """
+        Invalidates every cached entry of a namespace.
+
+        Args:
+            pinecone_index (str): The name of the Pinecone index.
+            namespace (str): The namespace within the index.
+
+        Returns:
+            int: The new generation of the namespace.
+    """
+    key = f"{pinecone_index}:{namespace}"
+    generation = local_generations.get(key, 0) + 1
+    if redis_conn is not None:
+        try:
+            generation = int(redis_conn.incr(f"namespace_generation:{key}"))
+        except Exception as e:
+            log(f"Redis unavailable for namespace generation of {key}: {e}")
+    local_generations[key] = generation
+    namespace_generations.set(key, generation)
+    log(f"Namespace {key} is now at generation {generation}")
+    return generation
@@ -0,0 +1,205 @@
+import atexit
+import os
+import threading
+import time
+from collections import deque
+
+from loguru import logger
+
+from constants.misc import BACKGROUND_DRAIN_TIMEOUT, BACKGROUND_LANES
+
+DROP_NEWEST = "drop_newest"  # the submitted task is dropped
+DROP_OLDEST = "drop_oldest"  # the oldest queued task is dropped to make room
+CALLER_RUNS = "caller_runs"  # the submitted task runs in the calling thread, slowing the caller down
+REJECT = "reject"  # LaneFullError is raised, for callers that answer with an error
+
+# Every lane registers itself here, so that their counters can be reported together
+lanes = {}
+
+
+class LaneFullError(Exception):
+    pass
+
+
+class Lane:
+    """
+        Bounded pool of background threads of this process, with a bounded queue. Threads are started as tasks
+        arrive, up to workers, and stay for the next tasks. A task submitted while max_queue tasks wait is handled
+        by the overflow policy. Not logged with utils.helpers.log, which imports this module.
+
+        Args:
+            name (str): Name of the lane, used in the stats and thread names.
+            workers (int): Maximum number of threads.
+            max_queue (int): Maximum number of tasks waiting for a thread.
+            overflow (str): DROP_NEWEST, DROP_OLDEST, CALLER_RUNS or REJECT.
+    """
+
+    def __init__(self, name, workers, max_queue, overflow=DROP_NEWEST):
+        self.name = name
+        self.workers = workers
+        self.max_queue = max_queue
+        self.overflow = overflow
+        self._condition = threading.Condition()
+        self._reset()
+        lanes[name] = self
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._queue = deque()
+        self._threads = 0
+        self._idle = 0
+        self._running = 0
+        self._closed = False
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.dropped = 0
+        self.rejected = 0
+        self.ran_in_caller = 0
+        self.max_depth = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.total_run = 0.0
+        self.max_run = 0.0
+
+    def submit(self, function, *args, **kwargs):
+        """
+            Queues function(*args, **kwargs).
+
+            Returns:
+                bool: Whether the task was queued or ran, False if it was dropped.
+
+            Raises:
+                LaneFullError: If the queue is full and the overflow policy is REJECT.
+        """
+        with self._condition:
+            # Threads are not inherited by a forked process (gunicorn, RQ), tasks queued before the fork neither
+            if self._pid != os.getpid():
+                self._reset()
+            if self._closed:
+                self.dropped += 1
+                logger.warning(f"Dropping {getattr(function, '__name__', function)}, lane {self.name} is shut down")
+                return False
+            self.submitted += 1
+            if len(self._queue) >= self.max_queue:
+                if self.overflow == REJECT:
+                    self.rejected += 1
+                    raise LaneFullError(f"Lane {self.name} has {len(self._queue)} tasks waiting")
+                if self.overflow == DROP_NEWEST:
+                    self.dropped += 1
+                    logger.warning(f"Lane {self.name} is full, dropping {getattr(function, '__name__', function)}")
+                    return False
+                if self.overflow == DROP_OLDEST:
+                    dropped = self._queue.popleft()[0]
+                    self.dropped += 1
+                    logger.warning(f"Lane {self.name} is full, dropping {getattr(dropped, '__name__', dropped)}")
+            if len(self._queue) < self.max_queue:
+                self._queue.append((function, args, kwargs, time.monotonic()))
+                self.max_depth = max(self.max_depth, len(self._queue))
+                if self._idle:
+                    self._condition.notify()
+                elif self._threads < self.workers:
+                    self._threads += 1
+                    threading.Thread(target=self._work, name=f"{self.name}-{self._threads}", daemon=True).start()
+                return True
+            # CALLER_RUNS
+            self.ran_in_caller += 1
+            self._running += 1
+        self._run(function, args, kwargs, time.monotonic())
+        return True
+
+    def _work(self):
+        while True:
+            with self._condition:
+                while not self._queue:
+                    if self._closed:
+                        self._threads -= 1
+                        self._condition.notify_all()
+                        return
+                    self._idle += 1
+                    self._condition.wait()
+                    self._idle -= 1
+                function, args, kwargs, queued_at = self._queue.popleft()
+                self._running += 1
+            self._run(function, args, kwargs, queued_at)
+
+    def _run(self, function, args, kwargs, queued_at):
+        start = time.monotonic()
+        failed = False
+        try:
+            function(*args, **kwargs)
+        except Exception:
+            failed = True
+            logger.exception(f"Error in background task {getattr(function, '__name__', function)} of lane {self.name}")
+        end = time.monotonic()
+        with self._condition:
+            self._running -= 1
+            self.completed += 1
+            self.failed += failed
+            self.total_wait += start - queued_at
+            self.max_wait = max(self.max_wait, start - queued_at)
+            self.total_run += end - start
+            self.max_run = max(self.max_run, end - start)
+            self._condition.notify_all()
+
+    def drain(self, timeout):
+        """
+            Stops accepting tasks and waits for the queued and running ones, up to timeout seconds.
+
+            Returns:
+                int: Number of tasks left unfinished.
+        """
+        deadline = time.monotonic() + timeout
+        with self._condition:
+            if self._pid != os.getpid():
+                return 0
+            self._closed = True
+            self._condition.notify_all()
+            while (self._queue or self._running) and time.monotonic() < deadline:
+                self._condition.wait(deadline - time.monotonic())
+            return len(self._queue) + self._running
+
+    def stats(self):
+        with self._condition:
+            done = self.completed or 1
+            return {
+                "depth": len(self._queue),
+                "max_depth": self.max_depth,
+                "threads": self._threads,
+                "running": self._running,
+                "submitted": self.submitted,
+                "completed": self.completed,
+                "failed": self.failed,
+                "dropped": self.dropped,
+                "rejected": self.rejected,
+                "ran_in_caller": self.ran_in_caller,
+                "average_wait_seconds": round(self.total_wait / done, 4),
+                "max_wait_seconds": round(self.max_wait, 4),
+                "average_run_seconds": round(self.total_run / done, 4),
+                "max_run_seconds": round(self.max_run, 4),
+            }
+
+
+def get_lane(name):
+    return lanes[name]
+
+
+def get_executor_stats():
+    return {name: lane.stats() for name, lane in lanes.items()}
+
+
+def drain_lanes(timeout=BACKGROUND_DRAIN_TIMEOUT):
+    """
+        Lets the background tasks of this process finish before it exits, within timeout seconds for all lanes.
+    """
+    deadline = time.monotonic() + timeout
+    for lane in lanes.values():
+        unfinished = lane.drain(max(0, deadline - time.monotonic()))
+        if unfinished:
+            logger.warning(f"Exiting with {unfinished} unfinished tasks in lane {lane.name}")
+
+
+for lane_name, lane_config in BACKGROUND_LANES.items():
+    Lane(lane_name, **lane_config)
+
+atexit.register(drain_lanes)
@@ -1,9 +1,15 @@
+import bisect
+import contextvars
+import json
 import re
+import threading
 import time
 import traceback
 from datetime import datetime
 from constants.misc import ERROR_LOG_PATH, INFO_LOG_PATH
-import requests
+from utils.log_shipper import log_shipper
+# Imported after the log shipper: atexit drains the background tasks first, then flushes the logs they shipped
+from utils.executor import LaneFullError, get_lane
 from redis import Redis
 from rq import Queue
 from loguru import logger
@@ -28,11 +34,14 @@ logger.add(
     enqueue=True
 )
 
+# Message sources of the current request outside of a Flask application context, see add_message_source_to_g
+message_sources = contextvars.ContextVar("message_sources", default=None)
+
 redis_conn = None
-logging_queue = None
+analytics_queue = None
 if settings.DEBUG != True:
     redis_conn = Redis(host=settings.REDIS_HOST, port=settings.REDIS_PORT)
-    logging_queue = Queue(connection=redis_conn, name="logging_queue")
+    analytics_queue = Queue(connection=redis_conn, name="analytics_queue")
 
 
 def log(message:str, error_message=None)->None:
@@ -41,30 +50,7 @@ def log(message:str, error_message=None)->None:
     if error_message is not None:
         logger.exception(message)
         if (settings.DEBUG != True):
-            add_task_to_logging_queue(save_error_log, message, error_message)
-
-def add_task_to_logging_queue(task, *args, **kwargs):
-    """
-    Enqueue a task with a variable number of arguments and named keyword arguments.
-
-    :param task: The task function to be executed.
-    :param *args: A variable number of arguments to be passed to the task.
-    :param **kwargs: A variable number of named keyword arguments to be passed to the task.
-    :return: The result of the queue's enqueue method, typically a job object.
-    """
-    try:
-        if logging_queue is None:
-            log("ERROR: Invalid queue. Starting a thread instead")
-            return start_background_thread(task, *args, **kwargs)
-        job = logging_queue.enqueue(task, *args, **kwargs, description="")
-        log(F"Started Logging Job {job.id}")
-        return job.id
-    except Exception as e:
-        log("Error in add_task_to_logging_queue starting background thread", traceback.format_exc())
-        try:
-            return start_background_thread(task, *args, **kwargs)
-        except Exception as e:
-            log("Error in add_task_to_logging_queue in starting thread", traceback.format_exc())
+            save_error_log(message, error_message)
 
 
 def is_integer(string):
@@ -130,26 +116,55 @@ def generate_final_prompt(messages: list, prompt, prompt_context=None):
         return None
 
 
-def start_background_thread(function, *args):
+def start_background_thread(function, *args, lane="default", **kwargs):
     """
-        This function checks if the provided function is callable and then starts a new thread to execute 
-        the function with the supplied arguments.
+        This function checks if the provided function is callable and then queues it on a lane of bounded
+        background threads (utils/executor.py) with the supplied arguments.
 
         Args:
-            function (callable): The function to be executed in the background thread.
+            function (callable): The function to be executed in the background.
             *args: The arguments to be passed to the function.
+            lane (str, optional): The lane of BACKGROUND_LANES to run it on. Defaults to "default".
+            **kwargs: The keyword arguments to be passed to the function.
 
         Returns:
-            None
+            bool: Whether the function was queued, False if the lane was full and dropped it.
+
+        Raises:
+            LaneFullError: If the lane is full and rejects tasks.
     """
     try:
         if not callable(function):
             log(f"Function {function} is not callable")
-            return
-        import threading
-        threading.Thread(target=lambda: function(*args)).start()
+            return False
+        return get_lane(lane).submit(function, *args, **kwargs)
+    except LaneFullError:
+        raise
     except Exception as e:
         log(f"Error in start_background_thread for Function {function}", traceback.format_exc())
+        return False
+
+
+def submit_in_context(executor, function, *args, **kwargs):
+    """
+        Submits a function to an executor, running it in a copy of the current context.
+        This keeps the flask application context (and g) of the request available in the worker thread.
+
+        Args:
+            executor (concurrent.futures.Executor): The executor to run the function on.
+            function (callable): The function to be executed.
+            *args: The arguments to be passed to the function.
+            **kwargs: The keyword arguments to be passed to the function.
+
+        Returns:
+            concurrent.futures.Future: The future of the function's result.
+    """
+    context = contextvars.copy_context()
+    return executor.submit(context.run, function, *args, **kwargs)
+
+
+# Hashtags that are not part of URLs
+HASHTAG_PATTERN = re.compile(r'(?<![\w/.-])(#\w+)(?![\w.-])')
 
 
 def remove_hashtags(message: str) -> str:
@@ -157,16 +172,12 @@ def remove_hashtags(message: str) -> str:
     Remove hashtags from a message, except those that are part of a URL.
     """
     try:
-        # Pattern to identify hashtags that are not part of URLs
-        pattern = r'(?<![\w/.-])(#\w+)(?![\w.-])'
-
         # Remove hashtags that match the pattern
-        text_without_hashtags = re.sub(pattern, '', message)
-
-        # Replace multiple spaces with a single space
-        cleaned_text = re.sub(r'\s+', ' ', text_without_hashtags)
+        if '#' in message:
+            message = HASHTAG_PATTERN.sub('', message)
 
-        return cleaned_text.strip()
+        # Replace multiple spaces with a single space, same as re.sub(r'\s+', ' ', message).strip()
+        return ' '.join(message.split())
     except Exception as e:
         log("Error in remove_hashtags", traceback.format_exc())
         return message
@@ -193,6 +204,7 @@ def add_message_source_to_g(key, value):
     """
     
         Add a message source to the Flask application context's.
+        Outside of a Flask application context (the ASGI app), the sources are stored in message_sources.
         
         Args:
             key (str): Identifier for the message to be stored.
@@ -203,43 +215,168 @@ def add_message_source_to_g(key, value):
     """
 
     try:
-        from flask import g
-        if 'sources' not in g:
-            g.sources = {}
-        g.sources[key] = value
+        from flask import g, has_app_context
+        if not has_app_context():
+            get_message_sources()[key] = value
+            return
+        # setdefault keeps this safe when pipeline stages add sources from several threads
+        g.setdefault('sources', {})[key] = value
     except:
         # Handle the error here
         log(f"Error in add_message_source_to_g", traceback.format_exc())
 
 
+def get_message_sources():
+    """
+        Returns the message sources of the current request when running outside of a Flask application context.
+        The ASGI app calls message_sources.set({}) at the start of every request, so that the tasks started
+        by the request share the same dict.
+    """
+    sources = message_sources.get()
+    if sources is None:
+        sources = {}
+        message_sources.set(sources)
+    return sources
+
+
 # Find and format plain emails
 def replace_email(match):
     email = match.group(1)
     return f"[{email}](mailto:{email})"
 
 
+# Links that are already in Markdown format
+MARKDOWN_LINK_PATTERN = re.compile(r"\[.*?\]\(.*?\)")
+URL_PATTERN = re.compile(r"(https?://[^\s]+)")
+EMAIL_PATTERN = re.compile(r"\b[A-Za-z0-9._%+-]+@[A-Za-z0-9.-]+\.[A-Z|a-z]{2,}\b")
+WORD_CHARACTER = re.compile(r"\w")
+CLOSING_PARENTHESIS = re.compile(r"\)")
+NEW_LINE = re.compile(r"\n")
+
+
 def format_links_and_emails_as_markdown(text):
     """
         This function searches the input text for URLs and email addresses and converts them 
         to Markdown link format if they are not already formatted as such. URLs are converted 
         to "[Read More](URL)" and email addresses are converted to "[email](mailto:email)".
 
+        The replacements are found in one scan of the text and spliced in one pass. The few texts where the
+        replacements of format_links_and_emails_one_by_one depend on each other are left to it, so that the
+        output is the same.
+
         Args:
             text (str): The input text containing URLs and email addresses.
 
         Returns:
             str: The text with URLs and email addresses formatted as Markdown links.
     """
+    try:
+        replacements = get_markdown_replacements(text)
+        if replacements is None:
+            return format_links_and_emails_one_by_one(text)
+        parts = []
+        position = 0
+        for start, end, replacement in sorted(replacements):
+            parts.append(text[position:start])
+            parts.append(replacement)
+            position = end
+        parts.append(text[position:])
+        return "".join(parts)
+    except:
+        log("Error in format_links_and_emails_as_markdown", traceback.format_exc())
+        return text
+
+
+def get_markdown_replacements(text):
+    """
+        The (start, end, markdown) replacements format_links_and_emails_one_by_one makes in text, without running
+        a substitution per URL and email: a URL is replaced where it starts and ends on a word boundary and no ")"
+        follows it on its line, an email where it is not already a Markdown link.
+
+        Returns:
+            list or None: The replacements, None when URLs or emails contain, overlap or touch one another, or
+            an email appears more than once.
+    """
+    urls = URL_PATTERN.finditer(text)
+    emails = EMAIL_PATTERN.finditer(text)
+    markdown_links = set(MARKDOWN_LINK_PATTERN.findall(text)) if "](" in text else set()
+
+    url_matches = {}
+    for match in urls:
+        url = match.group(1)
+        separator = url.index("://")
+        # Another URL inside this one, or an email, would be replaced inside it
+        if "@" in url or url.find("://", separator + 1) != -1:
+            return None
+        url_matches.setdefault(url, []).append(match)
+    distinct_urls = sorted(url_matches)
+    for index, url in enumerate(distinct_urls):
+        # A URL also matches at the start of the longer URLs it begins, where it ends on a word boundary
+        for longer in distinct_urls[index + 1:]:
+            if not longer.startswith(url):
+                break
+            if bool(WORD_CHARACTER.match(url[-1])) != bool(WORD_CHARACTER.match(longer[len(url)])):
+                return None
+
+    email_matches = {}
+    for match in emails:
+        email_matches.setdefault(match.group(0), []).append(match)
+
+    # An email right after a URL or another email is no longer on a word boundary once they are formatted
+    spans = sorted(match.span() for matches in [*url_matches.values(), *email_matches.values()] for match in matches)
+    if any(end >= start for (_, end), (start, _) in zip(spans, spans[1:])):
+        return None
+
+    replacements = []
+    closing = [match.start() for match in CLOSING_PARENTHESIS.finditer(text)]
+    new_lines = [match.start() for match in NEW_LINE.finditer(text)]
+    # Per line, the position of the last URL formatted so far: its ")" stops the URLs before it from matching
+    last_formatted = {}
+    for url, matches in url_matches.items():
+        markdown_version = f"[Read More]({url})"
+        if markdown_version in markdown_links or not WORD_CHARACTER.match(url[-1]):
+            continue
+        formatted = []
+        for match in matches:
+            start, end = match.span()
+            if start > 0 and WORD_CHARACTER.match(text[start - 1]):
+                continue
+            line = bisect.bisect_left(new_lines, end)
+            line_end = new_lines[line] if line < len(new_lines) else len(text)
+            parenthesis = bisect.bisect_left(closing, end)
+            if parenthesis < len(closing) and closing[parenthesis] < line_end:
+                continue
+            if start < last_formatted.get(line, -1):
+                continue
+            formatted.append((line, start))
+            replacements.append((start, end, markdown_version))
+        for line, start in formatted:
+            last_formatted[line] = max(start, last_formatted.get(line, -1))
+
+    for email, matches in email_matches.items():
+        markdown_email = f"[{email}](mailto:{email})"
+        if markdown_email in markdown_links:
+            continue
+        # Replaced wherever it appears, inside other emails too
+        start, end = matches[0].span()
+        if len(matches) > 1 or text.find(email) != start or text.find(email, start + 1) != -1:
+            return None
+        replacements.append((start, end, markdown_email))
+    return replacements
+
+
+def format_links_and_emails_one_by_one(text):
+    """
+        format_links_and_emails_as_markdown with a substitution over the whole text for every URL and email.
+    """
     try:
         # This regex matches links that are already in Markdown format
-        markdown_links = re.findall(r"\[.*?\]\(.*?\)", text)
+        markdown_links = MARKDOWN_LINK_PATTERN.findall(text)
         # This regex finds all URLs
-        urls = re.findall(r"(https?://[^\s]+)", text)
+        urls = URL_PATTERN.findall(text)
 
         # This regex finds all email addresses
-        emails = re.findall(
-            r"\b[A-Za-z0-9._%+-]+@[A-Za-z0-9.-]+\.[A-Z|a-z]{2,}\b", text
-        )
+        emails = EMAIL_PATTERN.findall(text)
 
         # We convert each URL to markdown only if it is not already in markdown
         for url in urls:
@@ -257,10 +394,30 @@ def format_links_and_emails_as_markdown(text):
 
         return text
     except:
-        log("Error in format_links_and_emails_as_markdown", traceback.format_exc())
+        log("Error in format_links_and_emails_one_by_one", traceback.format_exc())
         return text
 
 
+def post_process_response(text):
+    """
+        Formats a response, or a sentence of a streamed response, for the user: removes its hashtags and
+        formats its URLs and emails as Markdown links.
+    """
+    return format_links_and_emails_as_markdown(remove_hashtags(text))
+
+
+# PySBD segmenters keep the text being segmented, every thread gets its own
+segmenters = threading.local()
+
+
+def get_segmenter():
+    segmenter = getattr(segmenters, "segmenter", None)
+    if segmenter is None:
+        from pysbd import Segmenter
+        segmenter = segmenters.segmenter = Segmenter(language='en', clean=False)
+    return segmenter
+
+
 def split_sentences(message: str) -> list:
     """
     Split a message into sentences using the PySBD sentence tokenizer.
@@ -275,10 +432,7 @@ def split_sentences(message: str) -> list:
     if message is None or message == "":
         return message
     try:
-        from pysbd import Segmenter
-        segmenter = Segmenter(language='en', clean=False)
-
-        return segmenter.segment(message)
+        return get_segmenter().segment(message)
     except ImportError:
         log("PySBD not installed. Please install PySBD to use this function.")
         return [message]
@@ -287,30 +441,74 @@ def split_sentences(message: str) -> list:
         return [message]
 
 
+# Matches the end of a sentence followed by the whitespace that starts the next one
+SENTENCE_BOUNDARY = re.compile(r'[.!?]["\')\]]*\s')
+
+
+def stream_sentences(tokens):
+    """
+    Group a stream of tokens into sentences using split_sentences.
+
+    A sentence is only yielded once the start of the next sentence has been received,
+    whatever is left in the buffer is yielded when the token stream ends.
+
+    Args:
+    tokens (iterable): Text tokens, in the order they were generated.
+
+    Yields:
+    str: Complete sentences.
+    """
+    buffer = ""
+    for token in tokens:
+        buffer += token
+        # Only look for boundaries formed by the latest token
+        if not SENTENCE_BOUNDARY.search(buffer, max(0, len(buffer) - len(token) - 4)):
+            continue
+        sentences = split_sentences(buffer)
+        if len(sentences) > 1:
+            for sentence in sentences[:-1]:
+                yield sentence
+            buffer = sentences[-1]
+
+    if buffer.strip() != "":
+        for sentence in split_sentences(buffer):
+            yield sentence
+
+
+def format_sse(event, data):
+    """
+    Format an event for a text/event-stream (Server-Sent Events) response.
+
+    Args:
+    event (str): Name of the event.
+    data: JSON serializable payload of the event.
+
+    Returns:
+    str: The formatted event.
+    """
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
 def save_error_log(subject, error_log, platform="Flask"):
+    """
+        Queues an error log for the Laravel API, sent in a batch by the log shipper.
+    """
     try:
-        log("SAVING ERROR LOG")
-        requests.post(f"{settings.LARAVEL_BASEURL}/save_error_log",
-                      json={"subject": subject, "error_log": str(error_log), "platform": platform})
+        log_shipper.ship("error", {"subject": subject, "error_log": str(error_log), "platform": platform})
     except Exception as e:
-        log(traceback.format_exc())
+        logger.exception("Error in save_error_log")
         return False
 
 
 def save_message_data_to_db(message_id, values):
+    """
+        Queues the message data for the Laravel API, one record per value, sent in a batch by the log shipper.
+    """
     try:
-        log("SAVING MESSAGE DATA TO DB")
         for x in values:
             if x is None:
                 continue
-            #     TODO: Don't call API 5 times back-to-back. Using for loop here is very inefficient.
-            try:
-                response = requests.post(f"{settings.LARAVEL_BASEURL}/save_flask_log",
-                                         json={"message_id": message_id, "data": str(x)})
-                response.raise_for_status()
-            except Exception as e:
-                log("Error in save_message_data", traceback.format_exc())
-
+            log_shipper.ship("flask", {"message_id": message_id, "data": str(x)})
     except Exception as e:
         log("Error in save_message_data", traceback.format_exc())
         return False
@@ -348,20 +546,21 @@ def process_messages(messages):
     return messages_array
 
 
+URL_REGEX = re.compile(
+    r'^(?:http|ftp)s?://'  # http:// or https://
+    r'|(www\.[a-z0-9\.-]+)'  # www.domain
+    r'(?:(?:[A-Z0-9](?:[A-Z0-9-]{0,61}[A-Z0-9])?\.)+(?:[A-Z]{2,6}\.?|[A-Z0-9-]{2,}\.?)|'  # domain...
+    r'localhost|'  # localhost...
+    r'\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3}|'  # ...or ipv4
+    r'\[?[A-F0-9]*:[A-F0-9:]+\]?)'  # ...or ipv6
+    r'(?::\d+)?'  # optional port
+    r'(?:/?|[/?]\S+)$', re.IGNORECASE)
+
+
 # Define a function to check if a text is a URL
 def is_url(text):
     try:
-        regex = re.compile(
-            r'^(?:http|ftp)s?://'  # http:// or https://
-            r'|(www\.[a-z0-9\.-]+)'  # www.domain
-            r'(?:(?:[A-Z0-9](?:[A-Z0-9-]{0,61}[A-Z0-9])?\.)+(?:[A-Z]{2,6}\.?|[A-Z0-9-]{2,}\.?)|'  # domain...
-            r'localhost|'  # localhost...
-            r'\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3}|'  # ...or ipv4
-            r'\[?[A-F0-9]*:[A-F0-9:]+\]?)'  # ...or ipv6
-            r'(?::\d+)?'  # optional port
-            r'(?:/?|[/?]\S+)$', re.IGNORECASE)
-
-        return re.match(regex, text) is not None
+        return URL_REGEX.match(text) is not None
     except Exception as e:
         log("Error in is_url", traceback.format_exc())
         return False
@@ -1,7 +1,7 @@
 import json
-import requests
 import traceback
 from utils.helpers import log
+from utils.log_shipper import log_shipper
 import settings
 
 
@@ -16,12 +16,8 @@ def save_sources_log(message_id, sources={}):
         log("Skipping save_sources_log")
         return
     """
-        Saves the sources log for a given message to a Laravel backend.
-        
-        This function sends a POST request to the specified Laravel backend URL with the
-        message ID and sources data. The sources data is serialized to JSON format before
-        being sent. If the request is successful, a success message is logged. If an error
-        occurs during the request, an error message is logged along with the exception details.
+        Queues the sources log of a message for the Laravel backend, sent in a batch by the log shipper.
+        The sources data is serialized to JSON when queued, later changes to it are not sent.
 
         Args:
             message_id (str): The ID of the message for which the sources log is being saved.
@@ -31,18 +27,10 @@ def save_sources_log(message_id, sources={}):
         Returns:
             None
     """
-    try:  
-        res = requests.post(
-            f"{settings.LARAVEL_BASEURL}/store_message_sources",
-            data={
-                "message_id": message_id,
-                "sources": json.dumps(sources if isinstance(sources, dict) else {}, default=serialize)
-            }
-        )
-        res.raise_for_status()  # Raise exception if response status is not ok
-        log(f"Sources log saved successfully for {message_id}")
-    except requests.exceptions.RequestException as e:
-        log("Error in send_sources_log", e)
+    try:
+        log_shipper.ship("sources", {
+            "message_id": message_id,
+            "sources": json.dumps(sources if isinstance(sources, dict) else {}, default=serialize)
+        })
     except:
         log("Error in send_sources_log", traceback.format_exc())
-
@@ -0,0 +1,244 @@
+import atexit
+import json
+import os
+import threading
+import time
+from pathlib import Path
+
+from loguru import logger
+
+from apis_dir.functions import post
+from apis_dir.urls import (endpoint_save_error_log, endpoint_save_error_logs_bulk, endpoint_save_flask_log,
+                           endpoint_save_flask_logs_bulk, endpoint_store_message_sources,
+                           endpoint_store_message_sources_bulk)
+from constants.misc import (LOG_SHIPPER_BATCH_SIZE, LOG_SHIPPER_MAX_AGE, LOG_SHIPPER_MAX_BUFFER,
+                            LOG_SHIPPER_REPLAY_INTERVAL, LOG_SHIPPER_SPOOL_DIR)
+
+# Kind of record -> (bulk endpoint, endpoint of a single record, whether a single record is sent as form fields)
+KINDS = {
+    "error": (endpoint_save_error_logs_bulk, endpoint_save_error_log, False),
+    "flask": (endpoint_save_flask_logs_bulk, endpoint_save_flask_log, False),
+    "sources": (endpoint_store_message_sources_bulk, endpoint_store_message_sources, True),
+}
+STALE_REPLAY_AGE = 10 * 60  # seconds after which a spool file claimed by a process that died is replayed again
+
+
+class LogShipper:
+    """
+        Buffers the log records sent to the Laravel API and sends them in bulk from a background thread, once a kind
+        has LOG_SHIPPER_BATCH_SIZE records or its oldest record waited LOG_SHIPPER_MAX_AGE seconds.
+        Batches that cannot be sent are appended to a spool file of the process, replayed by any process once the
+        Laravel API answers again. Delivery is at least once: a batch failing halfway is spooled whole.
+        Failures are logged with loguru directly, logging them as errors would ship more records.
+
+        Args:
+            spool_dir (str): Directory of the spool files.
+    """
+
+    def __init__(self, spool_dir=LOG_SHIPPER_SPOOL_DIR):
+        self.spool_dir = Path(spool_dir)
+        self.shipped = 0
+        self.spooled = 0
+        self.replayed = 0
+        self.failed_sends = 0
+        self._buffers = {kind: [] for kind in KINDS}
+        self._oldest = {}
+        self._bulk_supported = {kind: True for kind in KINDS}
+        self._last_replay = 0
+        self._condition = threading.Condition()
+        self._spool_lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+        atexit.register(self.close)
+
+    def ship(self, kind, record):
+        """
+            Queues a record, returns at once.
+
+            Args:
+                kind (str): "error", "flask" or "sources", see KINDS.
+                record (dict): The fields of the record, as sent to the endpoint of a single record.
+        """
+        with self._condition:
+            self._start()
+            if sum(len(buffer) for buffer in self._buffers.values()) >= LOG_SHIPPER_MAX_BUFFER:
+                self._spool(kind, [record])
+                return
+            self._buffers[kind].append(record)
+            self._oldest.setdefault(kind, time.monotonic())
+            if len(self._buffers[kind]) >= LOG_SHIPPER_BATCH_SIZE:
+                self._condition.notify()
+
+    def _start(self):
+        # Started on first use in every process, records buffered before a fork belong to the parent
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._buffers = {kind: [] for kind in KINDS}
+            self._oldest = {}
+            self._thread = threading.Thread(target=self._run, name="log-shipper", daemon=True)
+            self._thread.start()
+
+    def _due_batches(self):
+        """
+            Takes the batches that are full or old enough out of the buffers. Must be called with the lock held.
+        """
+        now = time.monotonic()
+        batches = {}
+        for kind, buffer in self._buffers.items():
+            if buffer and (len(buffer) >= LOG_SHIPPER_BATCH_SIZE or now - self._oldest[kind] >= LOG_SHIPPER_MAX_AGE):
+                batches[kind] = buffer[:LOG_SHIPPER_BATCH_SIZE]
+                del buffer[:LOG_SHIPPER_BATCH_SIZE]
+                if buffer:
+                    self._oldest[kind] = now
+                else:
+                    self._oldest.pop(kind, None)
+        return batches
+
+    def _run(self):
+        # The thread is only started again in a new process, an error must not end it
+        while True:
+            try:
+                self._run_once()
+            except Exception as e:
+                logger.exception("Error in the log shipper")
+                time.sleep(LOG_SHIPPER_MAX_AGE)
+
+    def _run_once(self):
+        with self._condition:
+            batches = self._due_batches()
+            if not batches:
+                waits = [LOG_SHIPPER_MAX_AGE - (time.monotonic() - oldest) for oldest in self._oldest.values()]
+                self._condition.wait(max(0.01, min(waits + [LOG_SHIPPER_REPLAY_INTERVAL])))
+                batches = self._due_batches()
+        for kind, records in batches.items():
+            self._send_or_spool(kind, records)
+        # Replaying also probes the Laravel API, an idle process sends its spool once the API answers again
+        if time.monotonic() - self._last_replay >= LOG_SHIPPER_REPLAY_INTERVAL:
+            self.replay()
+
+    def _send(self, kind, records):
+        """
+            Sends records with the bulk endpoint of their kind, or one by one if the Laravel API has no bulk endpoint.
+            Raises on failure.
+        """
+        bulk_endpoint, endpoint, as_form = KINDS[kind]
+        if self._bulk_supported[kind]:
+            response = post(bulk_endpoint, {"records": records})
+            if response.status_code not in [404, 405]:
+                response.raise_for_status()
+                return
+            self._bulk_supported[kind] = False
+            logger.info(f"No bulk endpoint for {kind} logs, sending them one by one")
+        for record in records:
+            response = post(endpoint, form=record) if as_form else post(endpoint, record)
+            response.raise_for_status()
+
+    def _send_or_spool(self, kind, records):
+        try:
+            self._send(kind, records)
+            self.shipped += len(records)
+        except Exception as e:
+            self.failed_sends += 1
+            logger.warning(f"Could not ship {len(records)} {kind} logs, spooling them: {e}")
+            self._spool(kind, records)
+
+    def _spool(self, kind, records):
+        try:
+            with self._spool_lock:
+                self.spool_dir.mkdir(parents=True, exist_ok=True)
+                with open(self.spool_dir / f"spool_{os.getpid()}.jsonl", "a") as file:
+                    for record in records:
+                        file.write(json.dumps({"kind": kind, "record": record}) + "\n")
+            self.spooled += len(records)
+        except Exception as e:
+            logger.warning(f"Could not spool {len(records)} {kind} logs, dropping them: {e}")
+
+    def replay(self):
+        """
+            Sends the records of the spool files, of this process and of the others. A file is claimed by renaming it,
+            so that it is replayed by a single process. Records that still cannot be sent go back to the spool.
+        """
+        self._last_replay = time.monotonic()
+        if not self.spool_dir.is_dir():
+            return
+        paths = [path for path in sorted(self.spool_dir.glob("*.jsonl")) if self._is_replayable(path)]
+        for path in paths:
+            claimed = path.with_name(f"replaying_{os.getpid()}_{time.time_ns()}.jsonl")
+            records = {}
+            # Another process may claim or remove the file at any time
+            try:
+                os.rename(path, claimed)
+                with open(claimed) as file:
+                    lines = file.readlines()
+            except OSError:
+                continue
+            for line in lines:
+                try:
+                    entry = json.loads(line)
+                    records.setdefault(entry["kind"], []).append(entry["record"])
+                except (ValueError, KeyError):
+                    logger.warning(f"Skipping a malformed line of {claimed}")
+            failed = False
+            for kind, kind_records in records.items():
+                for start in range(0, len(kind_records), LOG_SHIPPER_BATCH_SIZE):
+                    batch = kind_records[start:start + LOG_SHIPPER_BATCH_SIZE]
+                    if failed:
+                        self._spool(kind, batch)
+                        continue
+                    try:
+                        self._send(kind, batch)
+                        self.replayed += len(batch)
+                    except Exception as e:
+                        failed = True
+                        logger.warning(f"Could not replay {claimed}, spooling the rest again: {e}")
+                        self._spool(kind, batch)
+            try:
+                os.remove(claimed)
+            except OSError:
+                pass
+            if failed:
+                return
+        if paths:
+            logger.info(f"Replayed {len(paths)} log spool files")
+
+    @staticmethod
+    def _is_replayable(path):
+        """
+            Whether a spool file is waiting to be replayed: not claimed, or claimed by a process that died.
+        """
+        if path.name.startswith("spool_"):
+            return True
+        try:
+            return path.name.startswith("replaying_") and time.time() - path.stat().st_mtime > STALE_REPLAY_AGE
+        except OSError:
+            return False
+
+    def flush(self):
+        """
+            Sends every buffered record now.
+        """
+        with self._condition:
+            batches = [(kind, list(buffer)) for kind, buffer in self._buffers.items() if buffer]
+            for buffer in self._buffers.values():
+                buffer.clear()
+            self._oldest.clear()
+        for kind, records in batches:
+            for start in range(0, len(records), LOG_SHIPPER_BATCH_SIZE):
+                self._send_or_spool(kind, records[start:start + LOG_SHIPPER_BATCH_SIZE])
+
+    def close(self):
+        if self._pid == os.getpid():
+            self.flush()
+
+    def stats(self):
+        return {
+            "buffered": {kind: len(buffer) for kind, buffer in self._buffers.items()},
+            "shipped": self.shipped,
+            "spooled": self.spooled,
+            "replayed": self.replayed,
+            "failed_sends": self.failed_sends,
+            "bulk_supported": dict(self._bulk_supported),
+        }
+
+
+log_shipper = LogShipper()
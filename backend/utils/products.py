@@ -1,28 +1,52 @@
+import hashlib
 import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
 from apis_dir.functions import get
 from apis_dir.urls import endpoint_fetch_products_n_details, endpoint_fetch_one_product_detail
 import traceback
-from utils.helpers import log
+from constants.cache_related import (PRODUCT_CATALOG_FRESH_TTL, PRODUCT_CATALOG_MAX_STALE, PRODUCT_CATALOG_MAXSIZE,
+                                     PRODUCT_DETAIL_CACHE_MAXSIZE, PRODUCT_DETAIL_CACHE_TTL)
+from constants.misc import TOOL_CALL_FALLBACK, TOOL_CALL_MAX_WORKERS, TOOL_CALL_TIMEOUT
+from utils.cache import TTLCache, bump_namespace_generation, get_namespace_generation
+from utils.helpers import log, start_background_thread, submit_in_context
 
-def fetch_products_n_details(host_url):
+# Tools of every host, invalidated across processes with a namespace generation of this scope
+PRODUCT_CATALOG_SCOPE = "product_catalog"
+product_catalogs = TTLCache("product_catalogs", maxsize=PRODUCT_CATALOG_MAXSIZE, ttl=PRODUCT_CATALOG_MAX_STALE)
+catalog_lock = threading.Lock()
+fetch_locks = {}
+revalidating = set()
+product_details = TTLCache("product_details", maxsize=PRODUCT_DETAIL_CACHE_MAXSIZE, ttl=PRODUCT_DETAIL_CACHE_TTL)
+tool_executor = ThreadPoolExecutor(max_workers=TOOL_CALL_MAX_WORKERS, thread_name_prefix="tool-call")
+
+def fetch_products_n_details(host_url, etag=None):
     """
         Sends a GET request to the specified endpoint to fetch products and their details for the host URL provided. It then extracts product names and types of information from the response and returns them.
 
         Args:
             host_url (str): The URL of the host whose product information has to be extracted.
+            etag (str, optional): Version of the catalog already known, sent as If-None-Match. Defaults to None.
         
         Returns:
-            tuple or None: A tuple containing two elements:
+            tuple or None: A tuple containing three elements:
                 - A list of product names extracted from the response.
                 - A list of types of information extracted from the response.
-                If the request is successful and the response contains the expected data, the tuple is returned. If there's an error or the response doesn't contain the expected data, None is returned.
+                - The version of the catalog: its ETag, its "version" field, or a hash of its content.
+                If the request is successful and the response contains the expected data, the tuple is returned. If the catalog did not change since etag (304), or there's an error, or the response doesn't contain the expected data, None is returned.
     """
 
-    response = get(endpoint_fetch_products_n_details, {"host_url": host_url})
+    response = get(endpoint_fetch_products_n_details, {"host_url": host_url},
+                   headers={"If-None-Match": etag} if etag else None)
     if response.status_code == 200:
-        products = response.json()["data"]["products"]
-        types_of_info = response.json()["data"]["types_of_infos"]
-        return [product["name"] for product in products], types_of_info
+        data = response.json()["data"]
+        products = [product["name"] for product in data["products"]]
+        types_of_info = data["types_of_infos"]
+        version = response.headers.get("ETag") or data.get("version")
+        if version is None:
+            version = hashlib.sha1(json.dumps([products, types_of_info]).encode()).hexdigest()
+        return products, types_of_info, str(version)
 
     return None
 
@@ -36,19 +60,24 @@ def get_product_detail(product_name, type_of_info, host_url):
     return ""
 
 
-def make_tool(host_url):
+AVAILABLE_FUNCTIONS = {
+    "get_product_detail": get_product_detail,
+}  # only one function in this example, but you can have multiple
+
+
+def build_tools(products, type_of_info):
     """
-        Fetches product details for the host using the 'fetch_products_n_details' function. It then constructs OpenAI tools where each tool represents a function to retrieve a specific detail of a product.
+        Constructs OpenAI tools where each tool represents a function to retrieve a specific detail of a product.
 
         Args:
-            host_url (str): The URL of the host whose product information has to be extracted.
+            products (list): The names of the products of the host.
+            type_of_info (list): The types of information known about the products.
 
         Returns:
             list: A list of dictionaries representing the generated tools. Each dictionary contains information about a specific OpenAI tool, including its type, name, description, and parameters.
     """
 
-    products, type_of_info = fetch_products_n_details(host_url)
-    tools = [
+    return [
         {
             "type": "function",
             "function": {
@@ -73,15 +102,123 @@ def make_tool(host_url):
         }
     ]
 
-    return tools
+
+def refresh_catalog(host_url, entry=None):
+    """
+        Fetches the catalog of a host, or only checks that it did not change since entry, and caches its tools.
+
+        Args:
+            host_url (str): The URL of the host.
+            entry (dict, optional): The cached catalog, revalidated with its version. Defaults to None.
+
+        Returns:
+            dict: The new cache entry, with the tools, the version, the generation and the time of the check.
+    """
+    generation = get_namespace_generation(PRODUCT_CATALOG_SCOPE, host_url)
+    fetched = fetch_products_n_details(host_url, entry["version"] if entry else None)
+    if fetched is not None:
+        products, type_of_info, version = fetched
+        if entry is None or version != entry["version"]:
+            log(f"Product catalog of {host_url} fetched, version {version}")
+            entry = {"tools": build_tools(products, type_of_info), "version": version}
+    elif entry is None:
+        raise ValueError(f"Could not fetch the product catalog of {host_url}")
+    entry = {**entry, "generation": generation, "checked_at": time.monotonic()}
+    product_catalogs.set(host_url, entry)
+    return entry
+
+
+def revalidate_catalog(host_url, entry):
+    try:
+        refresh_catalog(host_url, entry)
+    except Exception as e:
+        log("Error in revalidate_catalog", traceback.format_exc())
+    finally:
+        with catalog_lock:
+            revalidating.discard(host_url)
+
+
+def make_tool(host_url):
+    """
+        Returns the OpenAI tools of a host, built from its product catalog. The catalog changes rarely, so the tools
+        are cached per host: used as they are for PRODUCT_CATALOG_FRESH_TTL seconds, then used while they are
+        revalidated in the background (stale-while-revalidate, a 304 or the same version keeps them) for up to
+        PRODUCT_CATALOG_MAX_STALE seconds. invalidate_product_catalog drops them in every process.
+
+        Args:
+            host_url (str): The URL of the host whose product information has to be extracted.
+
+        Returns:
+            list: A list of dictionaries representing the generated tools, see build_tools.
+    """
+
+    entry = product_catalogs.get(host_url)
+    if entry is None or entry["generation"] != get_namespace_generation(PRODUCT_CATALOG_SCOPE, host_url):
+        # Concurrent requests of a host wait for a single fetch
+        with catalog_lock:
+            lock = fetch_locks.setdefault(host_url, threading.Lock())
+        with lock:
+            entry = product_catalogs.get(host_url)
+            if entry is None or entry["generation"] != get_namespace_generation(PRODUCT_CATALOG_SCOPE, host_url):
+                entry = refresh_catalog(host_url)
+        return entry["tools"]
+
+    if time.monotonic() - entry["checked_at"] >= PRODUCT_CATALOG_FRESH_TTL:
+        with catalog_lock:
+            stale = host_url not in revalidating
+            revalidating.add(host_url)
+        if stale:
+            try:
+                queued = start_background_thread(revalidate_catalog, host_url, entry)
+            except Exception as e:
+                log("Error in make_tool starting the revalidation", traceback.format_exc())
+                queued = False
+            # A dropped task never runs revalidate_catalog, the next request tries again
+            if not queued:
+                with catalog_lock:
+                    revalidating.discard(host_url)
+    return entry["tools"]
+
+
+def invalidate_product_catalog(host_url):
+    """
+        Drops the cached tools of a host in every process, to be called whenever its catalog changes.
+
+        Returns:
+            int: The new generation of the catalog.
+    """
+    product_catalogs.delete(host_url)
+    return bump_namespace_generation(PRODUCT_CATALOG_SCOPE, host_url)
+
+
+def run_tool_call(function_name, function_args, host_url):
+    """
+        Runs a tool function, reusing the results of the last PRODUCT_DETAIL_CACHE_TTL seconds. Results are cached with
+        the generation of the catalog of the host, invalidating the catalog invalidates them as well.
+    """
+    key = (host_url, get_namespace_generation(PRODUCT_CATALOG_SCOPE, host_url), function_name,
+           json.dumps(function_args, sort_keys=True))
+    result = product_details.get(key)
+    if result is None:
+        result = AVAILABLE_FUNCTIONS[function_name](
+            product_name=function_args.get("product_name"),
+            type_of_info=function_args.get("type_of_info"),
+            host_url=host_url
+        )
+        # Empty results are not cached, they are also returned when Laravel fails
+        if result:
+            product_details.set(key, result)
+    return result
 
 
 def make_tool_call(tool_calls, host_url):
     """
         This function processes tool calls retrieved from the OpenAI chat model response.
-        It maps each tool call to its corresponding function and executes the function
-        with the provided arguments. The function response is then appended to the messages
+        It maps each tool call to its corresponding function and executes the functions concurrently
+        with the provided arguments, identical calls once. The function response is then appended to the messages
         list along with metadata such as the tool call ID and function name.
+        A tool call that fails, or is not done within TOOL_CALL_TIMEOUT seconds, gets TOOL_CALL_FALLBACK as response
+        without failing the others: the model needs a response for every tool call.
 
         Args:
             tool_calls (list): A list of tool call objects containing information about the tool functions to be called.
@@ -90,36 +227,42 @@ def make_tool_call(tool_calls, host_url):
 
         Returns:
             list: A list of dictionaries representing the tool call messages. Each dictionary contains metadata about the tool call (such as ID and name) and the response generated by the corresponding function.
-
-        Raises:
-            Exception: If an error occurs during the tool call execution.
     """
 
-    try:
-        messages = []
+    futures = {}
+    calls = []
+    for tool_call in tool_calls:
+        function_name = tool_call.function.name
+        try:
+            function_args = json.loads(tool_call.function.arguments)
+            if function_name not in AVAILABLE_FUNCTIONS or not isinstance(function_args, dict):
+                raise ValueError(f"Invalid tool call {function_name}({tool_call.function.arguments})")
+            key = (function_name, json.dumps(function_args, sort_keys=True))
+            if key not in futures:
+                futures[key] = submit_in_context(tool_executor, run_tool_call, function_name, function_args, host_url)
+            calls.append((tool_call, futures[key]))
+        except Exception as e:
+            log("Error in make_tool_call", traceback.format_exc())
+            calls.append((tool_call, None))
 
-        available_functions = {
-            "get_product_detail": get_product_detail,
-        }  # only one function in this example, but you can have multiple
+    done, not_done = wait(list(futures.values()), timeout=TOOL_CALL_TIMEOUT)
+    if not_done:
+        log(f"{len(not_done)} tool calls of {host_url} not done in {TOOL_CALL_TIMEOUT} seconds")
 
-        for tool_call in tool_calls:
-            function_name = tool_call.function.name
-            function_to_call = available_functions[function_name]
-            function_args = json.loads(tool_call.function.arguments)
-            function_response = function_to_call(
-                product_name=function_args.get("product_name"),
-                type_of_info=function_args.get("type_of_info"),
-                host_url=host_url
-            )
-            messages.append(
-                {
-                    "tool_call_id": tool_call.id,
-                    "role": "tool",
-                    "name": function_name,
-                    "content": function_response,
-                }
-            )  # extend conversation with function response
-        return messages
-    except Exception as e:
-        log("Error in make_tool_call", traceback.format_exc())
-        raise e
+    messages = []
+    for tool_call, future in calls:
+        function_response = TOOL_CALL_FALLBACK
+        if future in done:
+            try:
+                function_response = future.result() or TOOL_CALL_FALLBACK
+            except Exception as e:
+                log("Error in make_tool_call", traceback.format_exc())
+        messages.append(
+            {
+                "tool_call_id": tool_call.id,
+                "role": "tool",
+                "name": tool_call.function.name,
+                "content": function_response,
+            }
+        )  # extend conversation with function response
+    return messages
@@ -1,5 +1,7 @@
 from marshmallow import Schema, fields, EXCLUDE
-from marshmallow.validate import Range
+from marshmallow.validate import Length, Range
+
+from constants.misc import ANALYTICS_MAX_CHUNK_MESSAGES
 
 ### DATA Schema
 class BucketSchema(Schema):
@@ -56,3 +58,43 @@ class FetchVectorsSchema(Schema):
     pinecone_index = fields.String(required=True)
     message_id = fields.Integer(required=True, validate=Range(min=1))
     namespace = fields.String(required=True)
+
+
+class InvalidateNamespaceSchema(Schema):
+    class Meta:
+        unknown = EXCLUDE
+    pinecone_index = fields.String(required=True)
+    namespace = fields.String(required=True)
+
+
+class InvalidateProductCatalogSchema(Schema):
+    class Meta:
+        unknown = EXCLUDE
+    host_url = fields.String(required=True)
+
+
+class CreateAnalyticsJobSchema(Schema):
+    class Meta:
+        unknown = EXCLUDE
+    org_id = fields.Integer(allow_none=True, missing=None)
+
+
+class AnalyticsChunkSchema(Schema):
+    class Meta:
+        unknown = EXCLUDE
+    index = fields.Integer(required=True, validate=Range(min=0))
+    messages = fields.List(fields.Dict(), required=True, validate=Length(max=ANALYTICS_MAX_CHUNK_MESSAGES))
+
+
+class StartAnalyticsJobSchema(Schema):
+    class Meta:
+        unknown = EXCLUDE
+    chunks = fields.Integer(required=True, validate=Range(min=1))
+
+
+class AnalyticsReportSchema(Schema):
+    class Meta:
+        unknown = EXCLUDE
+    start = fields.Date(missing=None)
+    end = fields.Date(missing=None)
+    limit = fields.Integer(missing=10, validate=Range(min=1, max=100))
@@ -0,0 +1,268 @@
+import contextvars
+import functools
+import inspect
+import json
+import os
+import queue
+import threading
+import time
+import traceback
+from contextlib import contextmanager
+from datetime import datetime
+
+import requests
+
+import settings
+from constants.misc import TRACES_LOG_PATH
+from utils.helpers import log
+
+# Span of the stage being executed. Copied into the pipeline threads and asyncio tasks with the rest of the context,
+# so that their spans are nested under the stage that started them.
+current_span = contextvars.ContextVar("current_span", default=None)
+
+SPAN_STATUS_OK = 1
+SPAN_STATUS_ERROR = 2
+
+
+class Span:
+    """
+        One timed stage of a request, exported in the OTLP span format once its trace is complete.
+
+        Args:
+            name (str): Name of the stage.
+            parent (Span, optional): The enclosing span, None for the root span of a trace.
+    """
+
+    def __init__(self, name, parent=None):
+        self.name = name
+        self.trace_id = parent.trace_id if parent else os.urandom(16).hex()
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent.span_id if parent else None
+        # Finished spans of the trace, shared by every span of the trace and exported when the root span ends
+        self.trace = parent.trace if parent else []
+        self.start_ns = time.time_ns()
+        self.end_ns = None
+        self.attributes = {}
+        self.status = SPAN_STATUS_OK
+        self.status_message = ""
+
+    def set_attribute(self, key, value):
+        if value is not None:
+            self.attributes[key] = value
+
+    def set_attributes(self, attributes):
+        for key, value in attributes.items():
+            self.set_attribute(key, value)
+
+    def record_exception(self, exception):
+        self.status = SPAN_STATUS_ERROR
+        self.status_message = str(exception)
+        self.set_attribute("exception.type", type(exception).__name__)
+
+    def end(self):
+        if self.end_ns is not None:
+            return
+        self.end_ns = time.time_ns()
+        self.trace.append(self)
+        if self.parent_id is None:
+            exporter.export(self.trace)
+
+    def to_otlp(self):
+        span = {
+            "traceId": self.trace_id,
+            "spanId": self.span_id,
+            "name": self.name,
+            "kind": 1,  # SPAN_KIND_INTERNAL
+            "startTimeUnixNano": str(self.start_ns),
+            "endTimeUnixNano": str(self.end_ns),
+            "attributes": [{"key": key, "value": otlp_value(value)} for key, value in self.attributes.items()],
+            "status": {"code": self.status, "message": self.status_message},
+        }
+        if self.parent_id:
+            span["parentSpanId"] = self.parent_id
+        return span
+
+
+def otlp_value(value):
+    """
+        Converts an attribute value to an OTLP AnyValue.
+    """
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    if isinstance(value, (list, tuple)):
+        return {"arrayValue": {"values": [otlp_value(item) for item in value]}}
+    return {"stringValue": str(value)}
+
+
+class TraceExporter:
+    """
+        Exports complete traces from a background thread, as OTLP/JSON requests (ExportTraceServiceRequest).
+        With settings.TRACING_EXPORTER set to "file", every trace is a line of TRACES_LOG_PATH,
+        with "otlp" it is posted to the collector at settings.TRACING_OTLP_ENDPOINT.
+    """
+
+    def __init__(self, mode, endpoint=None, max_queue=1000):
+        self.mode = mode
+        self.endpoint = endpoint
+        self.dropped = 0
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._thread = None
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self.mode in ["file", "otlp"]
+
+    def export(self, spans):
+        if not self.enabled:
+            return
+        self._start()
+        try:
+            self._queue.put_nowait(spans)
+        except queue.Full:
+            # Tracing must never slow down a reply
+            self.dropped += 1
+
+    def _start(self):
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="trace-exporter", daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            spans = self._queue.get()
+            try:
+                payload = {"resourceSpans": [{
+                    "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": "chatbot-backend"}}]},
+                    "scopeSpans": [{"scope": {"name": "utils.tracing"}, "spans": [span.to_otlp() for span in spans]}],
+                }]}
+                if self.mode == "otlp":
+                    requests.post(self.endpoint, json=payload, timeout=5)
+                else:
+                    path = TRACES_LOG_PATH.format(date=datetime.now().strftime("%d-%m-%Y"))
+                    os.makedirs(os.path.dirname(path), exist_ok=True)
+                    with open(path, "a") as file:
+                        file.write(json.dumps(payload) + "\n")
+            except Exception as e:
+                # Not logged as an error, error logs are shipped to the Laravel API
+                log(f"Error in exporting trace: {e}")
+
+
+exporter = TraceExporter(getattr(settings, "TRACING_EXPORTER", None), getattr(settings, "TRACING_OTLP_ENDPOINT", None))
+
+
+def starts_span(root):
+    """
+        Whether a span is recorded: only inside a trace, unless it is the root of a new one. Work outside of a request
+        (analytics jobs, warming, embedding batches flushed after their callers left) would export one trace per span.
+    """
+    return exporter.enabled and (root or current_span.get() is not None)
+
+
+@contextmanager
+def span(name, attributes=None, root=False):
+    """
+        Times the enclosed block as a span nested under the current span.
+
+        Args:
+            name (str): Name of the stage.
+            attributes (dict, optional): Attributes of the span. Defaults to None.
+            root (bool, optional): Start a new trace when there is no current span, instead of recording nothing.
+                Defaults to False.
+
+        Yields:
+            Span: The span, or None when tracing is disabled or there is no trace to record it in.
+    """
+    if not starts_span(root):
+        yield None
+        return
+    current = Span(name, current_span.get())
+    current.set_attributes(attributes or {})
+    token = current_span.set(current)
+    try:
+        yield current
+    except BaseException as e:
+        current.record_exception(e)
+        raise
+    finally:
+        current_span.reset(token)
+        current.end()
+
+
+def set_span_attributes(**attributes):
+    """
+        Adds attributes to the current span, does nothing outside of a span.
+    """
+    current = current_span.get()
+    if current is not None:
+        current.set_attributes(attributes)
+
+
+def traced(name=None, root=False):
+    """
+        Decorator running every call of the function in a span. Works for functions, coroutines and generators,
+        a generator's span lasts until it is exhausted and only covers the time spent inside it.
+
+        Args:
+            name (str, optional): Name of the span. Defaults to the name of the function.
+            root (bool, optional): Whether a call outside of a trace starts one, for the entry points of the requests.
+                Defaults to False.
+    """
+    def decorator(function):
+        span_name = name or function.__name__
+
+        if inspect.iscoroutinefunction(function):
+            @functools.wraps(function)
+            async def traced_coroutine(*args, **kwargs):
+                with span(span_name, root=root):
+                    return await function(*args, **kwargs)
+            return traced_coroutine
+
+        if inspect.isgeneratorfunction(function):
+            @functools.wraps(function)
+            def traced_generator(*args, **kwargs):
+                if not starts_span(root):
+                    return (yield from function(*args, **kwargs))
+                current = Span(span_name, current_span.get())
+                generator = function(*args, **kwargs)
+                try:
+                    resume, argument = generator.send, None
+                    while True:
+                        # The span is only current while the generator runs, the caller keeps its own span in between
+                        token = current_span.set(current)
+                        try:
+                            item = resume(argument)
+                        except StopIteration as stop:
+                            return stop.value
+                        finally:
+                            current_span.reset(token)
+                        try:
+                            resume, argument = generator.send, (yield item)
+                        except GeneratorExit:
+                            generator.close()
+                            raise
+                        except BaseException as e:
+                            # Thrown into the wrapper, the wrapped generator handles it as if it was not wrapped
+                            resume, argument = generator.throw, e
+                except GeneratorExit:
+                    raise
+                except BaseException as e:
+                    current.record_exception(e)
+                    raise
+                finally:
+                    current.end()
+            return traced_generator
+
+        @functools.wraps(function)
+        def traced_function(*args, **kwargs):
+            with span(span_name, root=root):
+                return function(*args, **kwargs)
+        return traced_function
+    return decorator
@@ -30,39 +30,43 @@ function App() {
     setInput("");
 
     try {
-      const response = await fetch("http://127.0.0.1:8000/send_message", {
-        method: "POST",
-        headers: {
-          "Content-Type": "application/json",
-        },
-        body: JSON.stringify({
-          messages: [{ sender: "user", message: input }],
-          message_id: 12345,
-          host_url: "https://example.com/api/chat",
-          prompt: "What are your opening hours?",
-          pinecone_index: "drmalpani",
-          namespace: "ivfindia",
-          closure_msg: "Is there anything else I can assist you with?",
-          conversation_status: "active",
-          org_description:
-            "We are a customer support service for an e-commerce platform.",
-          unsure_msg:
-            "I'm sorry, I'm not sure how to respond to that. Can you please rephrase?",
-          sender_country: "USA",
-          sender_city: "San Francisco",
-          filters: {
-            category: "support",
-            priority: "high",
+      const response = await fetch(
+        "http://127.0.0.1:8000/send_message_stream",
+        {
+          method: "POST",
+          headers: {
+            "Content-Type": "application/json",
           },
-          buckets: [],
-        }),
-      });
+          body: JSON.stringify({
+            messages: [{ sender: "user", message: input }],
+            message_id: 12345,
+            host_url: "https://example.com/api/chat",
+            prompt: "What are your opening hours?",
+            pinecone_index: "drmalpani",
+            namespace: "ivfindia",
+            closure_msg: "Is there anything else I can assist you with?",
+            conversation_status: "active",
+            org_description:
+              "We are a customer support service for an e-commerce platform.",
+            unsure_msg:
+              "I'm sorry, I'm not sure how to respond to that. Can you please rephrase?",
+            sender_country: "USA",
+            sender_city: "San Francisco",
+            filters: {
+              category: "support",
+              priority: "high",
+            },
+            buckets: [],
+          }),
+        },
+      );
 
-      const data = await response.json();
+      if (!response.ok || !response.body) {
+        throw new Error(`Request failed with status ${response.status}`);
+      }
 
-      if (data.status === 200 && data.data.ai_response) {
-        await streamAIResponse(data.data.ai_response[0]);
-      } else {
+      const answered = await readEventStream(response.body);
+      if (!answered) {
         setMessages((prevMessages) => [
           ...prevMessages,
           {
@@ -84,26 +88,57 @@ function App() {
     setDisableButton(false);
   };
 
-  const streamAIResponse = async (responseText: string) => {
+  // Reads the Server-Sent Events sent by /send_message_stream, returns true if any sentence was received
+  const readEventStream = async (body: ReadableStream<Uint8Array>) => {
+    const reader = body.getReader();
+    const decoder = new TextDecoder();
+    let buffer = "";
     let accumulatedText = "";
-    for (const char of responseText) {
-      accumulatedText += char;
-      await new Promise((resolve) => setTimeout(resolve, 30)); // Simulates streaming delay
-      setMessages((prevMessages) => {
-        const updatedMessages = [...prevMessages];
-        const lastMessage = updatedMessages[updatedMessages.length - 1];
-        if (lastMessage?.sender === "bot") {
-          updatedMessages[updatedMessages.length - 1] = {
-            ...lastMessage,
-            text: accumulatedText,
-          };
-        } else {
-          updatedMessages.push({ text: accumulatedText, sender: "bot" });
+
+    for (;;) {
+      const { done, value } = await reader.read();
+      if (done) break;
+      buffer += decoder.decode(value, { stream: true });
+
+      // Events are separated by a blank line
+      const events = buffer.split("\n\n");
+      buffer = events.pop() ?? "";
+      for (const rawEvent of events) {
+        let eventName = "message";
+        let data = "";
+        for (const line of rawEvent.split("\n")) {
+          if (line.startsWith("event: ")) eventName = line.slice(7);
+          else if (line.startsWith("data: ")) data += line.slice(6);
         }
-        return updatedMessages;
-      });
+        if (eventName === "sentence") {
+          accumulatedText = accumulatedText
+            ? `${accumulatedText} ${JSON.parse(data)}`
+            : JSON.parse(data);
+          updateBotMessage(accumulatedText);
+        } else if (eventName === "error") {
+          return false;
+        }
+      }
     }
+    return accumulatedText !== "";
   };
+
+  const updateBotMessage = (text: string) => {
+    setMessages((prevMessages) => {
+      const updatedMessages = [...prevMessages];
+      const lastMessage = updatedMessages[updatedMessages.length - 1];
+      if (lastMessage?.sender === "bot") {
+        updatedMessages[updatedMessages.length - 1] = {
+          ...lastMessage,
+          text,
+        };
+      } else {
+        updatedMessages.push({ text, sender: "bot" });
+      }
+      return updatedMessages;
+    });
+  };
+
   return (
     <>
       <div className="chatbot-button" onClick={toggleChatWindow}>